@@ -1,7 +1,7 @@
 from django.contrib import admin
 
 import condottieri_scenarios.models as scenarios
-from condottieri_scenarios.graphics import make_scenario_map
+from condottieri_scenarios.renderqueue import enqueue_map
 
 class ContenderInline(admin.TabularInline):
 	model = scenarios.Contender
@@ -45,13 +45,18 @@ class SettingAdmin(admin.ModelAdmin):
 class ScenarioAdmin(admin.ModelAdmin):
 	list_display = ('name', 'start_year', 'setting',)
 	inlines = [ContenderInline, CityIncomeInline, DisabledAreaInline, ]
-	actions = ['make_map',]
+	actions = ['make_map', 'force_make_map',]
 	
-	def make_map(self, request, queryset):
+	def make_map(self, request, queryset, force=False):
 		for obj in queryset:
-			make_scenario_map(obj)
+			enqueue_map(obj, force=force)
+		self.message_user(request, "%s maps queued for rendering" % len(queryset))
 	make_map.short_description = "Make initial map"
 
+	def force_make_map(self, request, queryset):
+		self.make_map(request, queryset, force=True)
+	force_make_map.short_description = "Make initial map, even if it is up to date"
+
 class ContenderAdmin(admin.ModelAdmin):
 	inlines = [HomeInline, SetupInline, TreasuryInline,]
 	
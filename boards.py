@@ -0,0 +1,414 @@
+## Copyright (c) 2012 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module keeps in memory the borders between the areas of each setting,
+so that the adjacency of two areas can be known without querying the database.
+
+The graph of a setting is built with two queries the first time that it is
+needed, and it is discarded when a border or an area is saved or deleted.
+Each graph is kept with the version of its setting in the Django cache, as
+snapshots are, so that the change is seen by every process.
+
+Sets of areas are also represented as bitsets, that is, integers in which
+the bit i is set if the area with index i belongs to the set, so that the
+neighbors of many areas can be found with a few integer operations.
+
+The distances between all the areas of a setting, for armies and fleets,
+are computed when they are first needed and saved in a file, named after a
+hash of the areas and the borders, so that they are computed only once.
+"""
+
+from array import array
+from collections import deque
+import hashlib
+import os
+import os.path
+import tempfile
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+
+import condottieri_scenarios.snapshots as snapshots
+
+import logging
+logger = logging.getLogger(__name__)
+
+## directory of the cached distances. It does not need to be served
+DISTANCES_DIR = getattr(settings, 'SCENARIOS_DISTANCES_DIR',
+	os.path.join(tempfile.gettempdir(), 'condottieri_scenarios', 'distances'))
+
+VERSION_KEY = "condottieri_scenarios:board-version:%s"
+GLOBAL_VERSION_KEY = "condottieri_scenarios:board-version"
+
+## the borders that are followed in each layer of the bitset adjacency.
+## 'land' are the land only borders, 'fleet' the borders that fleets can
+## cross, and 'all' both of them.
+LAYERS = ('land', 'fleet', 'all')
+
+def iter_bits(mask):
+	""" Yields the indices of the bits that are set in a bitset """
+	while mask:
+		low = mask & -mask
+		yield low.bit_length() - 1
+		mask ^= low
+
+class BoardGraph(object):
+	""" The borders between the areas of a setting.
+
+	Areas are numbered from 0, in the order of their codes. adjacency holds,
+	for each area, the indices of the areas that it borders. land_only is
+	the set of (i, j) pairs, in both directions, that are joined by a border
+	that cannot be crossed by fleets. accepts holds, for each unit type,
+	the bitset of the areas where that unit can stay.
+	"""
+	def __init__(self, areas, borders, accepts=None):
+		""" areas is an iterable of (id, code) tuples, and borders an
+		iterable of (from id, to id, only_land) tuples. accepts is a
+		dictionary with the ids of the areas that accept each unit type. """
+		areas = sorted(areas, key=lambda a: a[1])
+		self.ids = tuple(a[0] for a in areas)
+		self.codes = tuple(a[1] for a in areas)
+		self.index = dict((pk, i) for i, pk in enumerate(self.ids))
+		self.code_index = dict((code, i) for i, code in enumerate(self.codes))
+		neighbors = [set() for i in self.ids]
+		land_only = set()
+		for from_id, to_id, only_land in borders:
+			i, j = self.index[from_id], self.index[to_id]
+			neighbors[i].add(j)
+			if only_land:
+				land_only.add((i, j))
+				land_only.add((j, i))
+		self.adjacency = tuple(tuple(sorted(n)) for n in neighbors)
+		self.land_only = frozenset(land_only)
+		self._neighbors = tuple(frozenset(n) for n in neighbors)
+		self._fleet_neighbors = tuple(frozenset(j for j in n
+			if (i, j) not in land_only) for i, n in enumerate(neighbors))
+		self._masks = {}
+		self._reverse_masks = {}
+		for layer, sets in (('land', [n - self._fleet_neighbors[i]
+				for i, n in enumerate(self._neighbors)]),
+			('fleet', self._fleet_neighbors),
+			('all', self._neighbors)):
+			masks = tuple(self.mask(n) for n in sets)
+			reverse = [0] * len(masks)
+			for i, n in enumerate(sets):
+				for j in n:
+					reverse[j] |= 1 << i
+			self._masks[layer] = masks
+			self._reverse_masks[layer] = tuple(reverse)
+		self.accepts = dict((t, self.ids_mask(ids))
+			for t, ids in (accepts or {}).items())
+		self.fingerprint = self._get_fingerprint()
+
+	def _get_fingerprint(self):
+		""" Returns a hash of the areas, the borders and the accepted unit
+		types, that does not depend on the ids of the areas """
+		h = hashlib.sha1()
+		for i, code in enumerate(self.codes):
+			h.update(("%s:%s;" % (code, ",".join(self.codes[j]
+				for j in self.adjacency[i]))).encode('utf-8'))
+		for i, j in sorted(self.land_only):
+			h.update(("land %s %s;" % (self.codes[i], self.codes[j])).encode('utf-8'))
+		for t in sorted(self.accepts):
+			h.update(("%s %x;" % (t, self.accepts[t])).encode('utf-8'))
+		return h.hexdigest()
+
+	def __len__(self):
+		return len(self.ids)
+
+	def neighbors(self, i, fleet=False):
+		""" Returns the set of indices of the areas that border the area i.
+		If fleet is True, only the borders that fleets can cross are
+		followed. """
+		if fleet:
+			return self._fleet_neighbors[i]
+		return self._neighbors[i]
+
+	def is_adjacent(self, from_id, to_id, fleet=False):
+		""" Returns True if there is a border from the area from_id to the
+		area to_id. If fleet is True, the border must not be land only, in
+		either direction. """
+		try:
+			i, j = self.index[from_id], self.index[to_id]
+		except KeyError:
+			return False
+		return j in self.neighbors(i, fleet)
+
+	def mask(self, indices):
+		""" Returns the bitset of the given area indices """
+		mask = 0
+		for i in indices:
+			mask |= 1 << i
+		return mask
+
+	def ids_mask(self, ids):
+		""" Returns the bitset of the given area ids """
+		return self.mask(self.index[pk] for pk in ids)
+
+	def indices(self, mask):
+		""" Returns a list with the area indices in a bitset """
+		return list(iter_bits(mask))
+
+	def neighbors_mask(self, i, layer='all'):
+		""" Returns the bitset of the areas that border the area i """
+		return self._masks[layer][i]
+
+	def neighbors_union(self, mask, layer='all'):
+		""" Returns the bitset of the areas that border any of the areas in
+		a bitset """
+		masks = self._masks[layer]
+		union = 0
+		for i in iter_bits(mask):
+			union |= masks[i]
+		return union
+
+	def any_adjacent(self, mask, j, layer='all'):
+		""" Returns True if any of the areas in a bitset borders the area j """
+		return bool(self._reverse_masks[layer][j] & mask)
+
+	def reachable(self, mask, steps, layer='all'):
+		""" Returns the bitset of the areas that can be reached from the
+		areas in a bitset in at most the given number of steps, including
+		the areas themselves """
+		masks = self._masks[layer]
+		reached = frontier = mask
+		for step in range(steps):
+			new = 0
+			for i in iter_bits(frontier):
+				new |= masks[i]
+			frontier = new & ~reached
+			if not frontier:
+				break
+			reached |= frontier
+		return reached
+
+## distances greater than this are stored as unreachable
+UNREACHABLE = 255
+
+class DistanceTable(object):
+	""" The distances and shortest paths between all the areas of a setting
+	for a unit type. Areas are given by their indices in the BoardGraph.
+
+	A unit moves only through the areas that accept its type and are not
+	disabled, and fleets do not cross land only borders.
+	"""
+	def __init__(self, graph, unit_type, distances, previous):
+		self.graph = graph
+		self.unit_type = unit_type
+		## distances[i * n + j] is the distance from i to j
+		self._distances = distances
+		## previous[i * n + j] is the area before j in a path from i
+		self._previous = previous
+
+	def distance(self, i, j):
+		""" Returns the number of moves from the area i to the area j, or
+		None if the unit cannot get there """
+		d = self._distances[i * len(self.graph) + j]
+		if d == UNREACHABLE:
+			return None
+		return d
+
+	def distances_from(self, i):
+		""" Returns a list with the distance from the area i to every area """
+		n = len(self.graph)
+		return [None if d == UNREACHABLE else d
+			for d in self._distances[i * n:(i + 1) * n]]
+
+	def path(self, i, j):
+		""" Returns a list with the indices of the areas in a shortest path
+		from i to j, both included, or None if there is no path """
+		if self.distance(i, j) is None:
+			return None
+		n = len(self.graph)
+		path = [j]
+		while j != i:
+			j = self._previous[i * n + j]
+			path.append(j)
+		path.reverse()
+		return path
+
+	def distance_between(self, from_id, to_id):
+		""" Returns the distance between two areas, given by their ids """
+		index = self.graph.index
+		return self.distance(index[from_id], index[to_id])
+
+	def path_between(self, from_id, to_id):
+		""" Returns a shortest path between two areas as a list of area ids """
+		index = self.graph.index
+		path = self.path(index[from_id], index[to_id])
+		if path is None:
+			return None
+		return [self.graph.ids[i] for i in path]
+
+def compute_distances(graph, unit_type, disabled=0):
+	""" Computes the DistanceTable of a unit type with a breadth first
+	search from every area. disabled is the bitset of the disabled areas. """
+	if unit_type not in ('A', 'F'):
+		raise ValueError("Only armies and fleets can move")
+	n = len(graph)
+	allowed = graph.accepts.get(unit_type, 0) & ~disabled
+	layer = 'fleet' if unit_type == 'F' else 'all'
+	neighbors = [list(iter_bits(graph.neighbors_mask(i, layer) & allowed))
+		if allowed >> i & 1 else [] for i in range(n)]
+	distances = bytearray([UNREACHABLE]) * (n * n)
+	previous = array('h', [-1]) * (n * n)
+	for source in iter_bits(allowed):
+		row = source * n
+		distances[row + source] = 0
+		queue = deque([source])
+		while queue:
+			i = queue.popleft()
+			d = distances[row + i] + 1
+			if d >= UNREACHABLE:
+				break
+			for j in neighbors[i]:
+				if distances[row + j] == UNREACHABLE:
+					distances[row + j] = d
+					previous[row + j] = i
+					queue.append(j)
+	return DistanceTable(graph, unit_type, bytes(distances), previous)
+
+def distances_key(graph, unit_type, disabled=0):
+	""" Returns the name of the cached distances of a unit type """
+	h = hashlib.sha1(graph.fingerprint.encode('ascii'))
+	h.update((" %s %x" % (unit_type, disabled)).encode('ascii'))
+	return h.hexdigest()
+
+def distances_path(key):
+	return os.path.join(DISTANCES_DIR, "%s.dist" % key)
+
+def read_distances(graph, unit_type, key):
+	""" Returns the DistanceTable saved with the given key, or None """
+	n = len(graph)
+	try:
+		with open(distances_path(key), 'rb') as f:
+			data = f.read()
+	except IOError:
+		return None
+	if len(data) != 3 * n * n:
+		logger.warning("Ignoring the corrupt distances file %s" % key)
+		return None
+	previous = array('h')
+	previous.frombytes(data[n * n:])
+	return DistanceTable(graph, unit_type, data[:n * n], previous)
+
+def write_distances(table, key):
+	""" Saves a DistanceTable atomically. The paths are saved in the byte
+	order of the machine. """
+	path = distances_path(key)
+	os.makedirs(DISTANCES_DIR, exist_ok=True)
+	tmp = "%s.%s.tmp" % (path, os.getpid())
+	with open(tmp, 'wb') as f:
+		f.write(table._distances)
+		f.write(table._previous.tobytes())
+	os.replace(tmp, path)
+
+## graphs in memory, by setting id, with the versions they were built with
+_graphs = {}
+_tables = {}
+_lock = threading.Lock()
+
+def build_board_graph(setting_id):
+	from condottieri_scenarios.models import Area, Border
+	areas = list(Area.objects.filter(setting__id=setting_id).only('id', 'code',
+		'is_sea', 'is_coast', 'is_fortified', 'mixed'))
+	borders = Border.objects.filter(from_area__setting__id=setting_id).values_list(
+		'from_area_id', 'to_area_id', 'only_land')
+	accepts = dict((t, [a.id for a in areas if a.accepts_type(t)])
+		for t in ('A', 'F', 'G'))
+	return BoardGraph([(a.id, a.code) for a in areas], borders, accepts)
+
+def get_board_graph(setting_id):
+	""" Returns the BoardGraph of a setting, given by its id, building it if
+	it is not in memory or it is out of date """
+	versions = snapshots.get_versions([GLOBAL_VERSION_KEY, VERSION_KEY % setting_id])
+	cached = _graphs.get(setting_id)
+	if cached is not None and cached[0] == versions:
+		return cached[1]
+	graph = build_board_graph(setting_id)
+	with _lock:
+		if cached is not None:
+			_drop_tables(cached[1])
+		_graphs[setting_id] = (versions, graph)
+	return graph
+
+def get_distance_table(setting_id, unit_type, disabled=()):
+	""" Returns the DistanceTable of a unit type in a setting, given by its
+	id. disabled is an iterable with the ids of the areas that cannot be
+	used.
+
+	The table is read from the cache of distances, or computed and saved in
+	it, and it is kept in memory as long as the BoardGraph.
+	"""
+	graph = get_board_graph(setting_id)
+	disabled = graph.ids_mask(disabled)
+	key = distances_key(graph, unit_type, disabled)
+	table = _tables.get(key)
+	if table is not None:
+		return table
+	table = read_distances(graph, unit_type, key)
+	if table is None:
+		table = compute_distances(graph, unit_type, disabled)
+		try:
+			write_distances(table, key)
+		except (IOError, OSError) as e:
+			logger.error("Could not save the distances %s: %s" % (key, e))
+	with _lock:
+		_tables[key] = table
+	return table
+
+def get_scenario_distance_table(scenario, unit_type):
+	""" Returns the DistanceTable of a unit type in a scenario, without its
+	disabled areas """
+	disabled = scenario.disabledarea_set.values_list('area_id', flat=True)
+	return get_distance_table(scenario.setting_id, unit_type, disabled)
+
+def _drop_tables(graph):
+	for key in [k for k, t in _tables.items() if t.graph is graph]:
+		del _tables[key]
+
+def clear_board_graph(setting_id):
+	""" Discards the BoardGraph of a setting, given by its id, in every
+	process """
+	snapshots.bump_version(VERSION_KEY % setting_id)
+	with _lock:
+		cached = _graphs.pop(setting_id, None)
+		if cached is not None:
+			_drop_tables(cached[1])
+
+def clear_board_graphs():
+	""" Discards the BoardGraph of every setting in every process """
+	snapshots.bump_version(GLOBAL_VERSION_KEY)
+	with _lock:
+		_graphs.clear()
+		_tables.clear()
+
+def signal_handler_clear_board_graphs(sender, instance, **kwargs):
+	""" Discards the BoardGraph of the setting of a saved or deleted area or
+	border """
+	from condottieri_scenarios.models import Area
+	try:
+		if isinstance(instance, Area):
+			setting_id = instance.setting_id
+		else:
+			setting_id = instance.from_area.setting_id
+	except ObjectDoesNotExist:
+		clear_board_graphs()
+	else:
+		clear_board_graph(setting_id)
@@ -19,80 +19,1260 @@
 """ This module defines functions to generate the map. """
 
 from PIL import Image, ImageDraw
+from collections import OrderedDict, defaultdict, namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+import base64
+import hashlib
+import io
+import json
+import mmap
 import os
 import os.path
+import struct
+import tempfile
+import threading
+import time
+
+from xml.sax.saxutils import quoteattr
 
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.utils.module_loading import import_string
+
+import condottieri_scenarios.snapshots as snapshots
+
+try:
+        import fcntl
+except ImportError:
+        fcntl = None
+
+import logging
+logger = logging.getLogger(__name__)
 
 TOKENS_DIR=os.path.join(settings.MEDIA_ROOT, 'scenarios', 'tokens')
 TEMPLATES_DIR=os.path.join(settings.MEDIA_ROOT, 'scenarios', 'token_templates')
 BADGES_DIR=os.path.join(settings.MEDIA_ROOT, 'scenarios', 'badges')
 
+## maximum number of decoded token images kept in memory by each process
+TOKEN_CACHE_SIZE = getattr(settings, 'SCENARIOS_TOKEN_CACHE_SIZE', 256)
+## maximum number of decoded boards kept in memory by each process
+BOARD_CACHE_SIZE = getattr(settings, 'SCENARIOS_BOARD_CACHE_SIZE', 4)
+## if True, boards are decoded once to a raw file that the processes map in
+## memory, instead of being decoded by each process
+BOARD_MMAP = getattr(settings, 'SCENARIOS_BOARD_MMAP', True)
+## memory budget, in bytes, for the cached layers of the scenario maps
+LAYER_CACHE_BYTES = getattr(settings, 'SCENARIOS_LAYER_CACHE_BYTES', 256 * 1024 * 1024)
+## if True, the tokens of the countries are also packed in sprite atlases,
+## and the maps are drawn from them
+TOKEN_ATLAS = getattr(settings, 'SCENARIOS_TOKEN_ATLAS', False)
+
+## function called with the report of each render: a callable or its dotted
+## path
+RENDER_METRICS_CALLBACK = getattr(settings, 'SCENARIOS_RENDER_METRICS_CALLBACK', None)
+## if set, the report of the last render of each map or country is written
+## as JSON in this directory
+RENDER_REPORTS_DIR = getattr(settings, 'SCENARIOS_RENDER_REPORTS_DIR', None)
+
+class RenderMetrics(object):
+        """ The time spent in each phase of a render, with the number of
+        database queries made in the phase, and the counters of the render:
+        queries, tokens pasted and bytes written.
+
+        Phases may be nested; the time of a phase includes its subphases.
+        """
+
+        def __init__(self, operation, subject):
+                self.operation = operation
+                self.subject = subject
+                self.phases = OrderedDict()
+                self.counters = defaultdict(int)
+                self.started = time.time()
+                self.elapsed = None
+                self.error = None
+
+        @contextmanager
+        def phase(self, name):
+                start = time.perf_counter()
+                queries = self.counters['queries']
+                try:
+                        yield
+                finally:
+                        phase = self.phases.setdefault(name, {'time': 0.0, 'queries': 0, 'calls': 0})
+                        phase['time'] += time.perf_counter() - start
+                        phase['queries'] += self.counters['queries'] - queries
+                        phase['calls'] += 1
+
+        def count(self, name, n=1):
+                self.counters[name] += n
+
+        def as_dict(self):
+                return {'operation': self.operation,
+                        'subject': self.subject,
+                        'started': self.started,
+                        'elapsed': self.elapsed,
+                        'error': self.error,
+                        'phases': self.phases,
+                        'counters': dict(self.counters)}
+
+        def __str__(self):
+                phases = ", ".join("%s %.3fs" % (name, phase['time'])
+                        for name, phase in self.phases.items())
+                counters = ", ".join("%s %s" % item for item in sorted(self.counters.items()))
+                return "%s %s: %.3fs (%s; %s)" % (self.operation, self.subject,
+                        self.elapsed, phases, counters)
+
+_metrics = threading.local()
+
+def current_metrics():
+        """ Returns the metrics of the render running in this thread, or
+        None """
+        return getattr(_metrics, 'current', None)
+
+def render_phase(name):
+        """ Returns a context manager that measures a phase of the current
+        render, if any """
+        metrics = current_metrics()
+        if metrics is None:
+                return _null_phase()
+        return metrics.phase(name)
+
+@contextmanager
+def _null_phase():
+        yield
+
+def count_render(name, n=1):
+        metrics = current_metrics()
+        if metrics is not None:
+                metrics.count(name, n)
+
+def count_written(path):
+        """ Adds the size of a file that has just been written to the current
+        render """
+        metrics = current_metrics()
+        if metrics is not None:
+                try:
+                        metrics.count('bytes_written', os.path.getsize(path))
+                except OSError:
+                        pass
+
+@contextmanager
+def measure_render(operation, subject):
+        """ Measures a render made in the block. When it is finished, the
+        metrics are logged, passed to the metrics callback and, optionally,
+        written as JSON. """
+        metrics = RenderMetrics(operation, str(subject))
+        previous = current_metrics()
+        _metrics.current = metrics
+        def count_query(execute, sql, params, many, context):
+                metrics.counters['queries'] += 1
+                return execute(sql, params, many, context)
+        try:
+                with connection.execute_wrapper(count_query):
+                        yield metrics
+        except Exception as e:
+                metrics.error = str(e)
+                raise
+        finally:
+                _metrics.current = previous
+                metrics.elapsed = time.time() - metrics.started
+                publish_metrics(metrics)
+
+def publish_metrics(metrics):
+        logger.info(str(metrics))
+        callback = RENDER_METRICS_CALLBACK
+        if isinstance(callback, str):
+                callback = import_string(callback)
+        if callback is not None:
+                try:
+                        callback(metrics)
+                except Exception:
+                        logger.exception("The render metrics callback failed")
+        if RENDER_REPORTS_DIR:
+                path = os.path.join(RENDER_REPORTS_DIR, "%s-%s.json" %
+                        (metrics.operation, metrics.subject))
+                try:
+                        os.makedirs(RENDER_REPORTS_DIR, exist_ok=True)
+                        tmp = "%s.%s.tmp" % (path, os.getpid())
+                        with open(tmp, 'w') as f:
+                                json.dump(metrics.as_dict(), f, indent=1)
+                        os.replace(tmp, path)
+                except (IOError, OSError) as e:
+                        logger.error("Could not write the render report %s: %s" % (path, e))
+
+class TokenCache(object):
+        """ A bounded LRU cache of decoded RGBA token images.
+
+        Entries are keyed by path and modification time, so a token that has
+        been rewritten on disk is decoded again the next time it is requested.
+        The returned images are shared and must not be modified.
+        """
+
+        def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+                self.maxsize = maxsize
+                self.hits = 0
+                self.misses = 0
+                self._images = OrderedDict()
+                self._lock = threading.Lock()
+
+        def __len__(self):
+                return len(self._images)
+
+        def get(self, path):
+                """ Returns the decoded token stored in path """
+                key = (path, os.path.getmtime(path))
+                with self._lock:
+                        im = self._images.get(key)
+                        if im is not None:
+                                self._images.move_to_end(key)
+                                self.hits += 1
+                                return im
+                        self.misses += 1
+                with render_phase('decode'):
+                        im = Image.open(path).convert("RGBA")
+                with self._lock:
+                        ## drop stale versions of the same file
+                        for old in [k for k in self._images if k[0] == path]:
+                                del self._images[old]
+                        self._images[key] = im
+                        while len(self._images) > self.maxsize:
+                                self._images.popitem(last=False)
+                return im
+
+        def invalidate(self, paths):
+                """ Removes from the cache every version of the given files """
+                paths = set(paths)
+                with self._lock:
+                        for key in [k for k in self._images if k[0] in paths]:
+                                del self._images[key]
+
+        def clear(self):
+                with self._lock:
+                        self._images.clear()
+                        self.hits = 0
+                        self.misses = 0
+
+        def stats(self):
+                return {'hits': self.hits,
+                        'misses': self.misses,
+                        'size': len(self._images),
+                        'maxsize': self.maxsize}
+
+## cache shared by all the renders made in this process
+token_cache = TokenCache()
+
+def get_token(name):
+        """ Returns the decoded token image called name in TOKENS_DIR """
+        if TOKEN_ATLAS:
+                token = get_atlas_token(name)
+                if token is not None:
+                        return token
+        return token_cache.get(os.path.join(TOKENS_DIR, name))
+
+## boards are decoded once and then copied for each render
+board_cache = TokenCache(maxsize=BOARD_CACHE_SIZE)
+
+def get_board(setting):
+        """ Returns the decoded RGBA board of a setting. The image is shared
+        and must not be modified. """
+        path = setting.board.path
+        if BOARD_MMAP:
+                try:
+                        return get_mapped_board(path)
+                except (IOError, OSError, ValueError) as e:
+                        logger.error("Could not map the board %s: %s" % (path, e))
+        return board_cache.get(path)
+
+## header of the raw board files: magic, width and height
+RAW_BOARD_HEADER = struct.Struct("<4sII")
+RAW_BOARD_MAGIC = b"RGBA"
+
+def raw_board_path(path):
+        return "%s.rgba" % path
+
+def write_raw_board(path):
+        """ Decodes a board and writes it next to it as raw RGBA pixels """
+        board = Image.open(path).convert("RGBA")
+        raw_path = raw_board_path(path)
+        tmp = "%s.%s.tmp" % (raw_path, os.getpid())
+        with open(tmp, 'wb') as f:
+                f.write(RAW_BOARD_HEADER.pack(RAW_BOARD_MAGIC, board.width, board.height))
+                f.write(board.tobytes())
+        os.replace(tmp, raw_path)
+
+def raw_board_is_stale(path):
+        """ Returns True if the raw file of a board is missing or older than
+        the board """
+        try:
+                return os.path.getmtime(raw_board_path(path)) < os.path.getmtime(path)
+        except OSError:
+                return True
+
+_mapped_boards = {}
+
+def get_mapped_board(path):
+        """ Returns the board stored in path as an image backed by a read only
+        memory map of its raw file, so all the processes share the same
+        pages. The raw file is written again if the board is newer. """
+        raw_path = raw_board_path(path)
+        if raw_board_is_stale(path):
+                write_raw_board(path)
+        st = os.stat(raw_path)
+        key = (st.st_mtime, st.st_size)
+        cached = _mapped_boards.get(raw_path)
+        if cached is not None and cached[0] == key:
+                return cached[1]
+        with open(raw_path, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, width, height = RAW_BOARD_HEADER.unpack_from(buf)
+        if magic != RAW_BOARD_MAGIC or len(buf) != RAW_BOARD_HEADER.size + width * height * 4:
+                raise ValueError("Wrong raw board file")
+        board = Image.frombuffer("RGBA", (width, height),
+                memoryview(buf)[RAW_BOARD_HEADER.size:], "raw", "RGBA", 0, 1)
+        _mapped_boards[raw_path] = (key, board)
+        return board
+
+def signal_handler_make_raw_board(sender, instance, created, raw, **kwargs):
+        """ Writes the raw file of the board of a saved setting, unless it is
+        up to date """
+        if raw or not BOARD_MMAP or not instance.board:
+                return
+        try:
+                if raw_board_is_stale(instance.board.path):
+                        write_raw_board(instance.board.path)
+        except (IOError, OSError) as e:
+                logger.error("Could not write the raw board of %s: %s" % (instance, e))
+
+class LayerCache(object):
+        """ An LRU cache of composited map layers, bounded by the memory used
+        by the cached images.
+
+        Layers are keyed by their render inputs, so a layer is reused only
+        while its board, its tokens and their coordinates stay the same.
+        """
+
+        def __init__(self, maxbytes=LAYER_CACHE_BYTES):
+                self.maxbytes = maxbytes
+                self.nbytes = 0
+                self.hits = 0
+                self.misses = 0
+                self._layers = OrderedDict()
+                self._lock = threading.Lock()
+
+        def __len__(self):
+                return len(self._layers)
+
+        def get(self, key):
+                with self._lock:
+                        layer = self._layers.get(key)
+                        if layer is None:
+                                self.misses += 1
+                                return None
+                        self._layers.move_to_end(key)
+                        self.hits += 1
+                        return layer
+
+        @staticmethod
+        def _size(layer):
+                image = layer[0]
+                if image is None:
+                        return 0
+                return image.width * image.height * 4
+
+        def put(self, key, layer):
+                size = self._size(layer)
+                if size > self.maxbytes:
+                        return
+                with self._lock:
+                        old = self._layers.pop(key, None)
+                        if old is not None:
+                                self.nbytes -= self._size(old)
+                        self._layers[key] = layer
+                        self.nbytes += size
+                        while self.nbytes > self.maxbytes:
+                                self.nbytes -= self._size(self._layers.popitem(last=False)[1])
+
+        def clear(self):
+                with self._lock:
+                        self._layers.clear()
+                        self.nbytes = 0
+                        self.hits = 0
+                        self.misses = 0
+
+        def stats(self):
+                return {'hits': self.hits,
+                        'misses': self.misses,
+                        'size': len(self._layers),
+                        'bytes': self.nbytes,
+                        'maxbytes': self.maxbytes}
+
+layer_cache = LayerCache()
+
+def clear_caches():
+        """ Empties all the in-process caches of images, layers, digests and
+        coordinates """
+        token_cache.clear()
+        board_cache.clear()
+        layer_cache.clear()
+        map_cache.clear()
+        _mapped_boards.clear()
+        _file_digest.cache_clear()
+        clear_coordinate_indexes()
+
+def country_token_names(static_name):
+        """ Returns the file names of the map tokens of a country """
+        return ["%s-%s.png" % (t, static_name) for t in ("control", "flag", "A", "F", "G")]
+
+## JPEG quality of the full size maps
+MAP_QUALITY = getattr(settings, 'SCENARIOS_MAP_QUALITY', 75)
+
+## if True, make_scenario_map also writes a pyramid of tiles for each map
+MAP_TILES = getattr(settings, 'SCENARIOS_MAP_TILES', False)
+TILE_SIZE = getattr(settings, 'SCENARIOS_TILE_SIZE', 256)
+TILE_QUALITY = getattr(settings, 'SCENARIOS_TILE_QUALITY', 85)
+
+## images made from each map, besides the full size JPEG. size is the box
+## the image must fit in (None for the full size), dir the subdirectory of
+## SCENARIOS_ROOT where it is saved, and the rest are PIL save options.
+## Only the thumbnail is made by default. Other variants can be added in the
+## setting, e.g.
+##   'thumbnail@2x': {'size': (374, 534), 'format': 'JPEG', 'quality': 80},
+##   'progressive': {'size': None, 'format': 'JPEG', 'quality': 85,
+##           'progressive': True, 'optimize': True},
+##   'webp': {'size': None, 'format': 'WEBP', 'quality': 80},
+## but full size progressive JPEG and WebP variants are several times slower
+## to encode than the map itself.
+MAP_VARIANTS = getattr(settings, 'SCENARIOS_MAP_VARIANTS', {
+        'thumbnail': {'size': (187, 267), 'dir': 'thumbnails', 'format': 'JPEG', 'quality': 85},
+})
+
+VARIANT_EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+## change it when the output of the render pipeline changes, so that the
+## fingerprints of the existing maps are not valid anymore
+RENDER_VERSION = 1
+
+@lru_cache(maxsize=1024)
+def _file_digest(path, mtime, size):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                        digest.update(chunk)
+        return digest.hexdigest()
+
+def file_digest(path):
+        """ Returns the SHA1 hash of the contents of a file. The hash is only
+        computed again if the file has been modified. """
+        st = os.stat(path)
+        return _file_digest(path, st.st_mtime, st.st_size)
+
+def get_render_fingerprint(setting, plan):
+        """ Returns a hash of everything that is needed to render a map: the
+        board, the tokens and the placements of the plan """
+        digest = hashlib.sha1()
+        digest.update(("%s %r %s %s\n" % (RENDER_VERSION, sorted(MAP_VARIANTS.items()),
+                MAP_TILES, MAP_SVG and svg_board_mode(setting))).encode())
+        digest.update(("board %s\n" % file_digest(setting.board.path)).encode())
+        for name in sorted(set(token_name(p.kind, p.country) for p in plan)):
+                path = os.path.join(TOKENS_DIR, name)
+                digest.update(("%s %s\n" % (name, file_digest(path))).encode())
+        for p in plan:
+                digest.update(("%s %s %s %s\n" % p).encode())
+        return digest.hexdigest()
+
+def fingerprint_path(s):
+        """ Returns the path of the file that stores the fingerprint of the
+        map of a scenario, followed by the names of the variants that were
+        written with it """
+        return "%s.fingerprint" % s.map_path
+
+def read_render_record(s):
+        """ Returns the fingerprint of the saved map of a scenario and the
+        list of its variants that were written, or (None, []) """
+        try:
+                lines = read_output(fingerprint_path(s)).decode().splitlines()
+        except IOError:
+                return None, []
+        if not lines:
+                return None, []
+        return lines[0].strip(), lines[1].split() if len(lines) > 1 else []
+
+def read_fingerprint(s):
+        return read_render_record(s)[0]
+
 def ensure_dir(f):
         d = os.path.dirname(f)
-        if not os.path.exists(d):
-                os.makedirs(d)
+        if d:
+                os.makedirs(d, exist_ok=True)
 
-def make_scenario_map(s):
-        """ Makes the initial map for an scenario.
+##
+## Render outputs
+##
+
+## dotted path of the storage class where the maps, their variants and tiles
+## are written. If None, they are written in MEDIA_ROOT
+MAP_STORAGE = getattr(settings, 'SCENARIOS_MAP_STORAGE', None)
+## directory of the lock files that serialize the renders of each scenario.
+## It must be local to the host, and it does not need to be served
+LOCKS_DIR = getattr(settings, 'SCENARIOS_LOCKS_DIR',
+        os.path.join(tempfile.gettempdir(), 'condottieri_scenarios', 'locks'))
+
+_map_storage = None
+
+def get_map_storage():
+        """ Returns the storage of the render outputs, or None if they are
+        written directly in the file system """
+        global _map_storage
+        if MAP_STORAGE is None:
+                return None
+        if _map_storage is None:
+                _map_storage = import_string(MAP_STORAGE)()
+        return _map_storage
+
+def storage_name(path):
+        """ Returns the name, in the map storage, of a path in MEDIA_ROOT """
+        return os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/')
+
+def output_url(path, url):
+        """ Returns the URL of a render output in path. url is its URL when
+        it is written in MEDIA_ROOT. """
+        storage = get_map_storage()
+        if storage is None:
+                return url
+        if url.endswith('/'):
+                return "%s/" % storage.url(storage_name(path)).rstrip('/')
+        return storage.url(storage_name(path))
+
+def encode_image(image, **options):
+        """ Returns the image encoded with the given save options """
+        buf = io.BytesIO()
+        image.save(buf, **options)
+        return buf.getvalue()
+
+def write_output(path, data):
+        """ Writes a render output.
+
+        In the file system, data is written to a temporary file that replaces
+        the old one, so that readers see either the previous file or the new
+        one, never a partial one. In a storage that overwrites files, the
+        file is saved in place. Other storages do not let a file be replaced,
+        so the old file is deleted first, and it is missing until the new
+        one is saved.
         """
-        base_map = Image.open(s.setting.board)
+        storage = get_map_storage()
+        if storage is None:
+                ensure_dir(path)
+                tmp = "%s.%s.%s.tmp" % (path, os.getpid(), threading.get_ident())
+                try:
+                        with open(tmp, 'wb') as f:
+                                f.write(data)
+                        os.replace(tmp, path)
+                except BaseException:
+                        try:
+                                os.remove(tmp)
+                        except OSError:
+                                pass
+                        raise
+        else:
+                name = storage_name(path)
+                if storage.exists(name) and storage.get_available_name(name) != name:
+                        storage.delete(name)
+                saved = storage.save(name, ContentFile(data))
+                if saved != name:
+                        ## another process wrote the same output meanwhile
+                        storage.delete(saved)
+        count_render('bytes_written', len(data))
+
+def read_output(path):
+        """ Returns the content of a render output. Raises IOError if it does
+        not exist """
+        storage = get_map_storage()
+        if storage is None:
+                with open(path, 'rb') as f:
+                        return f.read()
+        name = storage_name(path)
+        if not storage.exists(name):
+                raise IOError("%s does not exist" % name)
+        with storage.open(name, 'rb') as f:
+                return f.read()
+
+def output_exists(path):
+        storage = get_map_storage()
+        if storage is None:
+                return os.path.exists(path)
+        return storage.exists(storage_name(path))
+
+def delete_output(path):
+        storage = get_map_storage()
+        try:
+                if storage is None:
+                        os.remove(path)
+                else:
+                        storage.delete(storage_name(path))
+        except OSError:
+                pass
+
+_scenario_locks = {}
+_scenario_locks_lock = threading.Lock()
+
+@contextmanager
+def scenario_lock(name):
+        """ Serializes the renders of a scenario made in this host, by threads
+        or processes. Yields True if the lock was held by another render, that
+        has just finished. """
+        with _scenario_locks_lock:
+                lock = _scenario_locks.setdefault(name, threading.Lock())
+        waited = not lock.acquire(blocking=False)
+        if waited:
+                lock.acquire()
+        f = None
+        try:
+                if fcntl is not None:
+                        path = os.path.join(LOCKS_DIR, "%s.lock" % name)
+                        ensure_dir(path)
+                        f = open(path, 'a')
+                        try:
+                                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except OSError:
+                                waited = True
+                                fcntl.flock(f, fcntl.LOCK_EX)
+                yield waited
+        finally:
+                if f is not None:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+                        f.close()
+                lock.release()
+
+def token_name(kind, country=None):
+        """ Returns the file name of the token of the given kind and country """
+        if kind in ("disabled", "chest"):
+                return "%s.png" % kind
+        if country is None:
+                country = "autonomous"
+        return "%s-%s.png" % (kind, country)
+
+## A Placement is a token that must be pasted on the board. kind is one of
+## 'disabled', 'chest', 'control', 'flag', 'A', 'F' or 'G'; country is the
+## static name of the owner, or None for autonomous units and markers.
+Placement = namedtuple('Placement', ['kind', 'country', 'x', 'y'])
+
+def get_render_plan(s, with_areas=False):
+        """ Returns the list of Placements needed to draw the initial map of
+        a scenario, in the order they must be pasted. If with_areas is True,
+        each item is an (area code, Placement) tuple.
+
+        All the data is fetched with a fixed number of queries, whatever the
+        size of the scenario.
+        """
+        plan = []
+        def place(code, kind, country, x, y, dx=0, dy=0):
+                ## areas without token coordinates cannot be drawn
+                if x is not None and y is not None:
+                        plan.append((code, Placement(kind, country, x + dx, y + dy)))
         ## if there are disabled areas, mark them
-        marker = Image.open("%s/disabled.png" % TOKENS_DIR)
-        for d in  s.disabledarea_set.all():
-                base_map.paste(marker, (d.area.aftoken.x, d.area.aftoken.y), marker)
+        for code, x, y in s.disabledarea_set.values_list('area__code',
+                'area__aftoken__x', 'area__aftoken__y'):
+                place(code, 'disabled', None, x, y)
         ## mark special city incomes
-        marker = Image.open("%s/chest.png" % TOKENS_DIR)
-        for i in s.cityincome_set.all():
-                base_map.paste(marker, (i.city.gtoken.x + 48, i.city.gtoken.y), marker)
-        ##
-        for c in s.contender_set.filter(country__isnull=False):
-                ## paste control markers and flags
-                marker = Image.open("%s/control-%s.png" % (TOKENS_DIR, c.country.static_name))
-                flag = Image.open("%s/flag-%s.png" % (TOKENS_DIR, c.country.static_name))
-                for h in c.home_set.all():
-                        base_map.paste(marker, (h.area.controltoken.x, h.area.controltoken.y), marker)
-                        if h.is_home:
-                                base_map.paste(flag, (h.area.controltoken.x, h.area.controltoken.y - 15), flag)
-                ## paste units
-                army = Image.open("%s/A-%s.png" % (TOKENS_DIR, c.country.static_name))
-                fleet = Image.open("%s/F-%s.png" % (TOKENS_DIR, c.country.static_name))
-                garrison = Image.open("%s/G-%s.png" % (TOKENS_DIR, c.country.static_name))
-                for setup in c.setup_set.all():
-                        if setup.unit_type == 'G':
-                                coords = (setup.area.gtoken.x, setup.area.gtoken.y)
-                                base_map.paste(garrison, coords, garrison)
-                        elif setup.unit_type == 'A':
-                                coords = (setup.area.aftoken.x, setup.area.aftoken.y)
-                                base_map.paste(army, coords, army)
-                        elif setup.unit_type == 'F':
-                                coords = (setup.area.aftoken.x, setup.area.aftoken.y)
-                                base_map.paste(fleet, coords, fleet)
-                        else:
-                                pass
-        for c in s.contender_set.filter(country__isnull=True):
-                ## paste autonomous garrisons
-                garrison = Image.open("%s/G-autonomous.png" % TOKENS_DIR)
-                for g in c.setup_set.filter(unit_type='G'):
-                        coords = (g.area.gtoken.x, g.area.gtoken.y)
-                        base_map.paste(garrison, coords, garrison)
+        for code, x, y in s.cityincome_set.values_list('city__code',
+                'city__gtoken__x', 'city__gtoken__y'):
+                place(code, 'chest', None, x, y, dx=48)
+        contenders = list(s.contender_set.values_list('id', 'country__static_name'))
+        homes = defaultdict(list)
+        for row in s.contender_set.filter(country__isnull=False,
+                home__isnull=False).order_by('home__id').values_list('id',
+                'home__area__code', 'home__area__controltoken__x',
+                'home__area__controltoken__y', 'home__is_home'):
+                homes[row[0]].append(row[1:])
+        setups = defaultdict(list)
+        for row in s.contender_set.filter(setup__isnull=False).order_by(
+                'setup__id').values_list('id', 'setup__area__code',
+                'setup__unit_type',
+                'setup__area__gtoken__x', 'setup__area__gtoken__y',
+                'setup__area__aftoken__x', 'setup__area__aftoken__y'):
+                setups[row[0]].append(row[1:])
+        for c, country in contenders:
+                if country is None:
+                        continue
+                ## control markers and flags
+                for code, x, y, is_home in homes[c]:
+                        place(code, 'control', country, x, y)
+                        if is_home:
+                                place(code, 'flag', country, x, y, dy=-15)
+                ## units
+                for code, unit_type, gx, gy, afx, afy in setups[c]:
+                        if unit_type == 'G':
+                                place(code, 'G', country, gx, gy)
+                        elif unit_type in ('A', 'F'):
+                                place(code, unit_type, country, afx, afy)
+        for c, country in contenders:
+                if country is not None:
+                        continue
+                ## autonomous garrisons
+                for code, unit_type, gx, gy, afx, afy in setups[c]:
+                        if unit_type == 'G':
+                                place(code, 'G', None, gx, gy)
+        if with_areas:
+                return plan
+        return [p for code, p in plan]
+
+## The coordinates of the tokens in an area. Each one is an (x, y) tuple, or
+## None if the area has no coordinates for that token.
+AreaCoordinates = namedtuple('AreaCoordinates', ['control', 'g', 'af'])
+
+COORDINATES_VERSION_KEY = "condottieri_scenarios:coordinates-version:%s"
+GLOBAL_COORDINATES_VERSION_KEY = "condottieri_scenarios:coordinates-version"
+
+## coordinate indexes in memory, by setting id, with the versions they were
+## built with
+_coordinate_indexes = {}
+_coordinate_lock = threading.Lock()
+
+def _get_coordinates(setting):
+        """ Returns the coordinate index of a setting and a dictionary with the
+        code of each area, by id """
+        versions = snapshots.get_versions([GLOBAL_COORDINATES_VERSION_KEY,
+                COORDINATES_VERSION_KEY % setting.pk])
+        cached = _coordinate_indexes.get(setting.pk)
+        if cached is not None and cached[0] == versions:
+                return cached[1:]
+        def point(x, y):
+                if x is None or y is None:
+                        return None
+                return (x, y)
+        index = {}
+        codes = {}
+        for row in setting.area_set.values_list('id', 'code',
+                'controltoken__x', 'controltoken__y', 'gtoken__x', 'gtoken__y',
+                'aftoken__x', 'aftoken__y'):
+                codes[row[0]] = row[1]
+                index[row[1]] = AreaCoordinates(point(*row[2:4]),
+                        point(*row[4:6]), point(*row[6:8]))
+        with _coordinate_lock:
+                _coordinate_indexes[setting.pk] = (versions, index, codes)
+        return index, codes
+
+def get_coordinate_index(setting):
+        """ Returns a dictionary with the AreaCoordinates of every area of a
+        setting, by area code.
+
+        The index is built with one query and kept in memory until a token
+        or an area of the setting is saved or deleted, in any process.
+        """
+        return _get_coordinates(setting)[0]
+
+def get_area_codes(setting):
+        """ Returns a dictionary with the code of every area of a setting, by
+        area id. It is cached with the coordinate index. """
+        return _get_coordinates(setting)[1]
+
+def clear_coordinate_indexes():
+        """ Discards the coordinate indexes kept by this process """
+        with _coordinate_lock:
+                _coordinate_indexes.clear()
+
+def clear_coordinate_index(setting_id):
+        """ Discards the coordinate index of a setting, given by its id, in
+        every process """
+        snapshots.bump_version(COORDINATES_VERSION_KEY % setting_id)
+        with _coordinate_lock:
+                _coordinate_indexes.pop(setting_id, None)
+
+def signal_handler_clear_coordinates(sender, instance, **kwargs):
+        """ Discards the coordinate index of the setting of a saved or deleted
+        area or token """
+        from condottieri_scenarios.models import Area
+        try:
+                if isinstance(instance, Area):
+                        setting_id = instance.setting_id
+                else:
+                        setting_id = instance.area.setting_id
+        except ObjectDoesNotExist:
+                snapshots.bump_version(GLOBAL_COORDINATES_VERSION_KEY)
+                clear_coordinate_indexes()
+        else:
+                clear_coordinate_index(setting_id)
+
+def get_game_plan(setting, controls=(), homes=(), units=(), markers=(),
+        with_areas=False):
+        """ Returns the render plan of an arbitrary game state, without any
+        database query once the coordinate index of the setting is built.
+        If with_areas is True, each item is an (area code, Placement) tuple.
+
+        controls and homes are iterables of (area code, country) tuples, for
+        the control markers and the home flags. units is an iterable of
+        (area code, unit type, country) tuples, where country is None for
+        autonomous units. markers is an iterable of (area code, kind) tuples,
+        where kind is 'disabled' or 'chest'. Countries are given by their
+        static name.
+        """
+        index = get_coordinate_index(setting)
+        plan = []
+        def place(code, kind, country, point, dx=0, dy=0):
+                if point is not None:
+                        plan.append((code, Placement(kind, country,
+                                point[0] + dx, point[1] + dy)))
+        def coordinates(code):
+                try:
+                        return index[code]
+                except KeyError:
+                        raise ValueError("Unknown area %s" % code)
+        for code, kind in markers:
+                if kind == 'disabled':
+                        place(code, kind, None, coordinates(code).af)
+                elif kind == 'chest':
+                        place(code, kind, None, coordinates(code).g, dx=48)
+                else:
+                        raise ValueError("Unknown marker %s" % kind)
+        ## group the tokens of each country, so that they share a layer
+        groups = OrderedDict()
+        for code, country in controls:
+                groups.setdefault(country, []).append((code, 'control', country,
+                        coordinates(code).control, 0))
+        for code, country in homes:
+                groups.setdefault(country, []).append((code, 'flag', country,
+                        coordinates(code).control, -15))
+        autonomous = []
+        for code, unit_type, country in units:
+                area = coordinates(code)
+                if unit_type == 'G':
+                        point = area.g
+                elif unit_type in ('A', 'F'):
+                        point = area.af
+                else:
+                        raise ValueError("Unknown unit type %s" % unit_type)
+                if country is None:
+                        autonomous.append((code, unit_type, None, point, 0))
+                else:
+                        groups.setdefault(country, []).append((code, unit_type,
+                                country, point, 0))
+        for group in list(groups.values()) + [autonomous]:
+                for code, kind, country, point, dy in group:
+                        place(code, kind, country, point, dy=dy)
+        if with_areas:
+                return plan
+        return [p for code, p in plan]
+
+def render_game_map(setting, controls=(), homes=(), units=(), markers=()):
+        """ Returns the RGB map of a setting with an arbitrary game state.
+        See get_game_plan for the format of the arguments.
+
+        The board, the tokens and the layers of the countries whose tokens
+        have not changed since the previous render are taken from the caches.
+        """
+        plan = get_game_plan(setting, controls, homes, units, markers)
+        return compose_map(setting, plan).convert("RGB")
+
+def composite_token(base_map, token, x, y):
+        """ Blends an RGBA token over an RGBA image, clipping it to the image
+        bounds """
+        left, top = max(x, 0), max(y, 0)
+        if left >= base_map.width or top >= base_map.height:
+                return
+        if x + token.width <= 0 or y + token.height <= 0:
+                return
+        base_map.alpha_composite(token, (left, top), (left - x, top - y))
+
+def paste_tokens(base_map, plan, offset=(0, 0)):
+        """ Blends over base_map the tokens of a render plan. The coordinates
+        of the plan are shifted by -offset. """
+        count_render('tokens_pasted', len(plan))
+        tokens = {}
+        for p in plan:
+                name = token_name(p.kind, p.country)
+                token = tokens.get(name)
+                if token is None:
+                        token = tokens[name] = get_token(name)
+                composite_token(base_map, token, p.x - offset[0], p.y - offset[1])
+
+def split_plan(plan):
+        """ Splits a render plan in the static part (disabled areas and city
+        incomes) and one group of placements for each contender """
+        static = []
+        groups = OrderedDict()
+        for p in plan:
+                if p.kind in ("disabled", "chest"):
+                        static.append(p)
+                else:
+                        groups.setdefault(p.country, []).append(p)
+        return static, list(groups.values())
+
+def _tokens_key(plan):
+        """ Returns the modification times of the tokens used in a plan """
+        names = sorted(set(token_name(p.kind, p.country) for p in plan))
+        return tuple((name, os.path.getmtime(os.path.join(TOKENS_DIR, name)))
+                for name in names)
+
+def get_static_layer(setting, static):
+        """ Returns the board of the setting with the static placements """
+        path = setting.board.path
+        key = ('static', path, os.path.getmtime(path), tuple(static),
+                _tokens_key(static))
+        layer = layer_cache.get(key)
+        if layer is None:
+                base_map = get_board(setting).copy()
+                paste_tokens(base_map, static)
+                layer = (base_map, (0, 0))
+                layer_cache.put(key, layer)
+        return layer[0]
+
+def get_overlay(group, size):
+        """ Returns a transparent layer with the placements of one contender,
+        cropped to their bounding box, and its offset in a board of the given
+        size """
+        key = ('overlay', size, tuple(group), _tokens_key(group))
+        layer = layer_cache.get(key)
+        if layer is None:
+                box = [size[0], size[1], 0, 0]
+                for p in group:
+                        token = get_token(token_name(p.kind, p.country))
+                        box[0] = min(box[0], max(p.x, 0))
+                        box[1] = min(box[1], max(p.y, 0))
+                        box[2] = max(box[2], min(p.x + token.width, size[0]))
+                        box[3] = max(box[3], min(p.y + token.height, size[1]))
+                if box[2] <= box[0] or box[3] <= box[1]:
+                        layer = (None, (0, 0))
+                else:
+                        offset = (box[0], box[1])
+                        image = Image.new("RGBA", (box[2] - box[0], box[3] - box[1]))
+                        paste_tokens(image, group, offset)
+                        layer = (image, offset)
+                layer_cache.put(key, layer)
+        return layer
+
+def compose_map(setting, plan):
+        """ Returns the RGBA map of a setting with the placements of a plan.
+
+        The board with the disabled areas and city incomes, and the tokens of
+        each contender, are cached as separate layers, so that only the
+        layers whose placements have changed are composited again.
+        """
+        static, groups = split_plan(plan)
+        base_map = get_static_layer(setting, static).copy()
+        for group in groups:
+                image, offset = get_overlay(group, base_map.size)
+                if image is not None:
+                        base_map.alpha_composite(image, offset)
+        return base_map
+
+def make_scenario_map(s, force=False):
+        """ Makes the initial map for an scenario.
+
+        If the map was already drawn with the same board, tokens and
+        placements, nothing is done, unless force is True. Concurrent renders
+        of the same scenario are serialized, and a render that has waited for
+        another one is only made if the map is still out of date. Returns
+        True if the map has been drawn.
+        """
+        with measure_render('map', s.name):
+                with scenario_lock(s.name) as waited:
+                        return _make_scenario_map(s, force and not waited)
+
+def _make_scenario_map(s, force):
+        with render_phase('plan'):
+                if MAP_SVG:
+                        placements = get_render_plan(s, with_areas=True)
+                        plan = [p for code, p in placements]
+                else:
+                        plan = get_render_plan(s)
+        with render_phase('fingerprint'):
+                fingerprint = get_render_fingerprint(s.setting, plan)
+                saved, written = read_render_record(s)
+                ## variants that could not be encoded are not expected
+                if not force and fingerprint == saved and \
+                        output_exists(s.map_path) and \
+                        all(output_exists(s.get_variant_path(name)) for name in written) and \
+                        (not MAP_TILES or output_exists(s.tiles_manifest_path)) and \
+                        (not MAP_SVG or output_exists(s.svg_path)):
+                        return False
+        with render_phase('compose'):
+                base_map = compose_map(s.setting, plan)
         ## save the map
-        result = base_map.convert("RGB")
-        filename = s.map_path
-        ensure_dir(filename)
-        result.save(filename)
-        make_scenario_thumb(s, 187, 267, "thumbnails")
+        with render_phase('convert'):
+                result = base_map.convert("RGB")
+        with render_phase('encode'):
+                data = encode_image(result, format="JPEG", quality=MAP_QUALITY)
+        write_output(s.map_path, data)
+        with render_phase('variants'):
+                written = make_scenario_variants(s, result)
+        if MAP_TILES:
+                with render_phase('tiles'):
+                        make_scenario_tiles(s, result)
+        if MAP_SVG:
+                with render_phase('svg'):
+                        write_output(s.svg_path, make_svg_map(s.setting, placements).encode('utf-8'))
+        ## the fingerprint is written last, so an interrupted render is
+        ## made again
+        write_output(fingerprint_path(s), ("%s\n%s\n" % (fingerprint,
+                " ".join(sorted(written)))).encode())
         return True
 
-def make_scenario_thumb(scenario, w, h, dirname):
-        """ Make thumbnails of the scenario map image """
-        size = w, h
-        fd = scenario.map_path
-        outfile= scenario.thumbnail_path
-        im = Image.open(fd)
-        im.thumbnail(size, Image.ANTIALIAS)
-        ensure_dir(outfile)
-        im.save(outfile, "JPEG")
+## memory used by the encoded maps that are served on demand
+MAP_CACHE_BYTES = getattr(settings, 'SCENARIOS_MAP_CACHE_BYTES', 32 * 1024 * 1024)
+
+class MapCache(LayerCache):
+        """ An LRU cache of encoded map images, keyed by their fingerprint and
+        bounded by their size in bytes """
+
+        @staticmethod
+        def _size(data):
+                return len(data)
+
+map_cache = MapCache(MAP_CACHE_BYTES)
+
+def render_scenario_map(s, plan=None, fingerprint=None):
+        """ Returns the map of a scenario, encoded as JPEG, and its
+        fingerprint.
+
+        The map is taken from the render cache, or from the saved map if it is
+        up to date. Otherwise, it is rendered in memory and nothing is written
+        to disk.
+        """
+        if plan is None:
+                plan = get_render_plan(s)
+        if fingerprint is None:
+                fingerprint = get_render_fingerprint(s.setting, plan)
+        data = map_cache.get(fingerprint)
+        if data is not None:
+                return data, fingerprint
+        try:
+                if fingerprint != read_fingerprint(s):
+                        raise IOError("The saved map is out of date")
+                data = read_output(s.map_path)
+        except IOError:
+                data = encode_image(compose_map(s.setting, plan).convert("RGB"),
+                        format="JPEG", quality=MAP_QUALITY)
+        map_cache.put(fingerprint, data)
+        return data, fingerprint
+
+## if True, make_scenario_map also writes an SVG map
+MAP_SVG = getattr(settings, 'SCENARIOS_MAP_SVG', False)
+## if True, SVG maps embed the board image instead of linking it. The
+## embedded board is base64 encoded, so the SVG map is larger than the JPEG
+## map, and it is only worth it if the SVG must stand alone
+SVG_EMBED_BOARD = getattr(settings, 'SCENARIOS_SVG_EMBED_BOARD', False)
+## JPEG quality of the embedded board
+SVG_BOARD_QUALITY = getattr(settings, 'SCENARIOS_SVG_BOARD_QUALITY', MAP_QUALITY)
+
+def _file_key(path):
+        stat = os.stat(path)
+        return path, stat.st_mtime, stat.st_size
+
+@lru_cache(maxsize=BOARD_CACHE_SIZE)
+def _board_data_uri(path, mtime, size):
+        buf = io.BytesIO()
+        Image.open(path).convert("RGB").save(buf, "JPEG", quality=SVG_BOARD_QUALITY)
+        return "data:image/jpeg;base64,%s" % base64.b64encode(buf.getvalue()).decode()
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _token_data_uri(path, mtime, size):
+        with open(path, 'rb') as f:
+                return "data:image/png;base64,%s" % base64.b64encode(f.read()).decode()
+
+def make_svg_map(setting, placements):
+        """ Returns an SVG document with the map of a setting.
+
+        placements is a list of (area code, Placement) tuples, as returned by
+        get_render_plan or get_game_plan with with_areas=True. The board and
+        each token image are included only once, and every token is a <use>
+        element with an id made of its area code and its kind, so that it can
+        be changed in the browser.
+        """
+        path = setting.board.path
+        if SVG_EMBED_BOARD:
+                board_href = _board_data_uri(*_file_key(path))
+        else:
+                board_href = setting.board.url
+        width, height = get_board(setting).size
+        symbols = OrderedDict()
+        for code, p in placements:
+                name = token_name(p.kind, p.country)
+                if not name in symbols:
+                        symbols[name] = get_token(name).size
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+                '<svg xmlns="http://www.w3.org/2000/svg" '
+                'xmlns:xlink="http://www.w3.org/1999/xlink" '
+                'width="%d" height="%d" viewBox="0 0 %d %d">' % (width, height, width, height),
+                '<defs>']
+        for name, (w, h) in symbols.items():
+                href = _token_data_uri(*_file_key(os.path.join(TOKENS_DIR, name)))
+                lines.append('<symbol id=%s viewBox="0 0 %d %d">'
+                        '<image width="%d" height="%d" xlink:href="%s"/></symbol>' %
+                        (quoteattr("token-%s" % os.path.splitext(name)[0]), w, h, w, h, href))
+        lines.append('</defs>')
+        lines.append('<image id="board" width="%d" height="%d" xlink:href=%s/>' %
+                (width, height, quoteattr(board_href)))
+        for code, p in placements:
+                name = token_name(p.kind, p.country)
+                w, h = symbols[name]
+                lines.append('<use id=%s class=%s data-area=%s data-country=%s '
+                        'x="%d" y="%d" width="%d" height="%d" xlink:href=%s/>' %
+                        (quoteattr("%s-%s" % (code, p.kind)),
+                        quoteattr("token token-%s" % p.kind), quoteattr(code),
+                        quoteattr(p.country or ""), p.x, p.y, w, h,
+                        quoteattr("#token-%s" % os.path.splitext(name)[0])))
+        lines.append('</svg>')
+        return "\n".join(lines)
+
+def svg_board_mode(setting):
+        """ Returns how the board is included in the SVG maps of a setting """
+        if SVG_EMBED_BOARD:
+                return "embed"
+        return "link %s" % setting.board.url
+
+def svg_fingerprint(setting, fingerprint):
+        """ Returns the fingerprint of an SVG map, given the render fingerprint
+        of the map. It also covers the way the board is included. """
+        return hashlib.sha1(("%s svg %s" % (fingerprint,
+                svg_board_mode(setting))).encode()).hexdigest()
+
+def render_scenario_svg(s, placements=None, fingerprint=None):
+        """ Returns the SVG map of a scenario and its SVG fingerprint, taken
+        from the render cache or made in memory. fingerprint is the render
+        fingerprint of the map. """
+        if placements is None:
+                placements = get_render_plan(s, with_areas=True)
+        if fingerprint is None:
+                fingerprint = get_render_fingerprint(s.setting, [p for code, p in placements])
+        fingerprint = svg_fingerprint(s.setting, fingerprint)
+        key = "%s.svg" % fingerprint
+        data = map_cache.get(key)
+        if data is None:
+                data = make_svg_map(s.setting, placements).encode('utf-8')
+                map_cache.put(key, data)
+        return data, fingerprint
+
+## maximum size of the previews of the maps shown while editing a scenario
+PREVIEW_SIZE = getattr(settings, 'SCENARIOS_PREVIEW_SIZE', (800, 800))
+PREVIEW_QUALITY = getattr(settings, 'SCENARIOS_PREVIEW_QUALITY', 70)
+
+def render_preview(setting, plan, size=None):
+        """ Returns a low resolution JPEG of the map of a setting with the
+        placements of a plan. Nothing is written, and only the layers that
+        are not in the cache are composited. """
+        image = compose_map(setting, plan).convert("RGB")
+        image.thumbnail(size or PREVIEW_SIZE, Image.BILINEAR)
+        return encode_image(image, format="JPEG", quality=PREVIEW_QUALITY)
+
+def make_scenario_thumb(scenario, w, h, dirname, image=None):
+        """ Make thumbnails of the scenario map image. If image is not given,
+        the map is read from disk. """
+        with measure_render('thumbnail', scenario.name):
+                size = w, h
+                outfile= scenario.thumbnail_path
+                with render_phase('decode'):
+                        if image is None:
+                                im = Image.open(io.BytesIO(read_output(scenario.map_path)))
+                                im.load()
+                        else:
+                                im = image.copy()
+                with render_phase('resize'):
+                        im.thumbnail(size, Image.ANTIALIAS)
+                with render_phase('encode'):
+                        data = encode_image(im, format="JPEG")
+                write_output(outfile, data)
+
+def make_scenario_variants(scenario, image, variants=None):
+        """ Saves the variants of the map of a scenario, all of them made from
+        the map in memory.
+
+        The variants are made from the largest to the smallest, and each one
+        is scaled down from the previous one when it is big enough, instead
+        of from the full size map. Returns the names of the variants that were
+        written.
+        """
+        if variants is None:
+                variants = MAP_VARIANTS
+        def area(item):
+                size = item[1].get('size')
+                return size[0] * size[1] if size else image.width * image.height
+        source = image
+        written = []
+        for name, options in sorted(variants.items(), key=area, reverse=True):
+                options = dict(options)
+                size = options.pop('size', None)
+                options.pop('dir', None)
+                options.setdefault('format', 'JPEG')
+                if size is None:
+                        im = image
+                else:
+                        if source.width < min(size[0], image.width) or \
+                                source.height < min(size[1], image.height):
+                                source = image
+                        im = source.copy()
+                        im.thumbnail(size, Image.ANTIALIAS)
+                        source = im
+                try:
+                        write_output(scenario.get_variant_path(name), encode_image(im, **options))
+                except (KeyError, IOError) as e:
+                        logger.error("Could not save the %s variant of %s: %s" % (name, scenario, e))
+                else:
+                        written.append(name)
+        return written
+
+def tile_levels(width, height, tile_size=TILE_SIZE):
+        """ Returns the size of each zoom level of a tile pyramid, from the
+        level that fits in one tile (0) to the full size image """
+        levels = [(width, height)]
+        while width > tile_size or height > tile_size:
+                width, height = (width + 1) // 2, (height + 1) // 2
+                levels.insert(0, (width, height))
+        return levels
+
+def make_scenario_tiles(scenario, image, tile_size=TILE_SIZE):
+        """ Writes the map of a scenario as a pyramid of tiles, and a manifest
+        describing the levels.
+
+        The manifest keeps a hash of each tile, so tiles whose pixels have not
+        changed since the last render are not written again. Returns the
+        number of tiles written.
+        """
+        tiles_dir = scenario.tiles_path
+        manifest_path = scenario.tiles_manifest_path
+        try:
+                old_tiles = json.loads(read_output(manifest_path).decode())['tiles']
+        except (IOError, ValueError, KeyError):
+                old_tiles = {}
+        levels = tile_levels(image.width, image.height, tile_size)
+        manifest = {'width': image.width,
+                'height': image.height,
+                'tile_size': tile_size,
+                'format': 'jpg',
+                'levels': [],
+                'tiles': {}}
+        written = 0
+        level = image
+        for z in reversed(range(len(levels))):
+                if level.size != levels[z]:
+                        level = level.resize(levels[z], Image.ANTIALIAS)
+                columns = (level.width + tile_size - 1) // tile_size
+                rows = (level.height + tile_size - 1) // tile_size
+                manifest['levels'].insert(0, {'z': z,
+                        'width': level.width,
+                        'height': level.height,
+                        'columns': columns,
+                        'rows': rows})
+                for row in range(rows):
+                        for column in range(columns):
+                                box = (column * tile_size, row * tile_size,
+                                        min((column + 1) * tile_size, level.width),
+                                        min((row + 1) * tile_size, level.height))
+                                tile = level.crop(box)
+                                name = "%s/%s_%s.jpg" % (z, column, row)
+                                digest = hashlib.sha1(tile.tobytes()).hexdigest()
+                                manifest['tiles'][name] = digest
+                                path = os.path.join(tiles_dir, name)
+                                if old_tiles.get(name) == digest and output_exists(path):
+                                        continue
+                                write_output(path, encode_image(tile, format="JPEG", quality=TILE_QUALITY))
+                                written += 1
+        ## remove the tiles of levels that do not exist anymore
+        for name in set(old_tiles) - set(manifest['tiles']):
+                delete_output(os.path.join(tiles_dir, name))
+        write_output(manifest_path, json.dumps(manifest).encode())
+        return written
 
 def round_corner(radius, fill):
         """ Draw a round corner
@@ -127,64 +1307,286 @@ def make_flag(fill):
         del draw
         return flag
 
-def signal_handler_make_country_tokens(sender, instance, created, raw, **kwargs):
-    make_country_tokens(sender, instance, created, raw, **kwargs)
+## Sprite atlases
+##
+## The tokens of a country are packed in TOKENS_DIR/atlas-<country>.png, and
+## the tokens of all the enabled countries, plus the markers, in
+## TOKENS_DIR/atlas.png. Each atlas has a JSON index with the box of each
+## token, named as its file. The global atlas has also a CSS sprite sheet.
 
-def make_country_tokens(sender, instance, created, raw, **kwargs):
-        """ Generate all the tokens for a country """
-        if raw:
-            return
-        if instance.protected:
-            return
-        #try:
-        coat = Image.open(instance.coat_of_arms)
-        #except:
-        #       coat = None
-        ## generate 48x48 Badge
+ATLAS_WIDTH = 512
+
+def country_atlas_files(static_name):
+        """ Returns the paths of the images packed in the atlas of a country """
+        files = [os.path.join(BADGES_DIR, "%s-%s.png" % (t, static_name)) for t in ("badge", "icon")]
+        return files + [os.path.join(TOKENS_DIR, name) for name in country_token_names(static_name)]
+
+def pack_images(images, width=ATLAS_WIDTH, padding=1):
+        """ Packs a list of (name, image) in rows of at most width pixels.
+        Returns the atlas image and a dictionary with the box of each name. """
+        index = OrderedDict()
+        x = y = row_height = atlas_width = 0
+        for name, im in images:
+                if x > 0 and x + im.width > width:
+                        x, y, row_height = 0, y + row_height + padding, 0
+                index[name] = (x, y, im.width, im.height)
+                atlas_width = max(atlas_width, x + im.width)
+                x += im.width + padding
+                row_height = max(row_height, im.height)
+        atlas = Image.new("RGBA", (max(atlas_width, 1), max(y + row_height, 1)))
+        for name, im in images:
+                box = index[name]
+                atlas.paste(im, box[:2])
+        return atlas, index
+
+def write_atlas(basename, paths):
+        """ Packs the images in paths that exist, and writes the atlas and its
+        index in TOKENS_DIR. Returns the index. """
+        images = [(os.path.basename(p), Image.open(p).convert("RGBA"))
+                for p in paths if os.path.exists(p)]
+        atlas, index = pack_images(images)
+        atlas.save(os.path.join(TOKENS_DIR, "%s.png" % basename))
+        with open(os.path.join(TOKENS_DIR, "%s.json" % basename), 'w') as f:
+                json.dump(index, f)
+        return index
+
+def make_country_atlas(static_name):
+        """ Packs all the tokens of a country in one atlas """
+        return write_atlas("atlas-%s" % static_name, country_atlas_files(static_name))
+
+def make_tokens_atlas(static_names):
+        """ Packs in one atlas the tokens of the given countries, the
+        autonomous garrison and the markers, and writes the CSS sprite sheet
+        with one class for each token, e.g. 'token-badge-venice' """
+        paths = [os.path.join(TOKENS_DIR, name)
+                for name in ("disabled.png", "chest.png", "G-autonomous.png")]
+        for static_name in static_names:
+                paths += country_atlas_files(static_name)
+        index = write_atlas("atlas", paths)
+        rules = [".token { display: inline-block; background: url(atlas.png) no-repeat; }"]
+        for name, (x, y, w, h) in index.items():
+                rules.append(".token-%s { width: %spx; height: %spx; background-position: -%spx -%spx; }" % (
+                        os.path.splitext(name)[0], w, h, x, y))
+        with open(os.path.join(TOKENS_DIR, "atlas.css"), 'w') as f:
+                f.write("\n".join(rules) + "\n")
+        return index
+
+def in_tokens_atlas(static_name):
+        """ Returns True if the tokens of a country are in the global atlas """
+        try:
+                mtime, index = _get_atlas_index(os.path.join(TOKENS_DIR, "atlas.json"))
+        except (OSError, ValueError):
+                return False
+        return "A-%s.png" % static_name in index
+
+def atlas_countries():
+        """ Returns the set of static names of the countries whose badge and
+        icon are in the global atlas """
+        try:
+                mtime, index = _get_atlas_index(os.path.join(TOKENS_DIR, "atlas.json"))
+        except (OSError, ValueError):
+                return set()
+        return set(name[len("badge-"):-len(".png")] for name in index
+                if name.startswith("badge-") and "icon-%s" % name[len("badge-"):] in index)
+
+def atlas_css_url():
+        return os.path.join(settings.MEDIA_URL, 'scenarios', 'tokens', 'atlas.css')
+
+_atlas_indexes = {}
+_atlas_tokens = {}
+
+def _get_atlas_index(path):
+        """ Returns the modification time and the contents of an atlas index """
+        mtime = os.path.getmtime(path)
+        cached = _atlas_indexes.get(path)
+        if cached is None or cached[0] != mtime:
+                with open(path) as f:
+                        cached = _atlas_indexes[path] = (mtime, json.load(f))
+                ## forget the tokens cropped from the previous version
+                for key in [k for k in _atlas_tokens if k[0] == path]:
+                        del _atlas_tokens[key]
+        return cached
+
+def get_atlas_token(name):
+        """ Returns a token cropped from the global atlas, or from the atlas of
+        its country, or None if the token is in no atlas.
+
+        An atlas that is older than the file of the token is not used, so
+        that a token is never drawn from an atlas that has not been packed
+        again yet.
+        """
+        atlases = ["atlas"]
+        if "-" in name:
+                atlases.append("atlas-%s" % os.path.splitext(name)[0].split("-", 1)[1])
+        try:
+                token_mtime = os.path.getmtime(os.path.join(TOKENS_DIR, name))
+        except OSError:
+                token_mtime = None
+        for basename in atlases:
+                path = os.path.join(TOKENS_DIR, "%s.json" % basename)
+                try:
+                        mtime, index = _get_atlas_index(path)
+                except (OSError, ValueError):
+                        continue
+                box = index.get(name)
+                if box is None:
+                        continue
+                if token_mtime is not None and token_mtime > mtime:
+                        continue
+                key = (path, mtime, name)
+                token = _atlas_tokens.get(key)
+                if token is None:
+                        x, y, w, h = box
+                        atlas = token_cache.get(os.path.join(TOKENS_DIR, "%s.png" % basename))
+                        token = _atlas_tokens[key] = atlas.crop((x, y, x + w, y + h))
+                return token
+        return None
+
+def make_badge(coat, fill):
+        """ Make the 48x48 badge """
         badge_base = Image.open(os.path.join(TEMPLATES_DIR, "badge-base.png"))
         if coat:
                 badge_base.paste(coat, (4,4), coat)
-        badge_base.save(os.path.join(BADGES_DIR, "badge-%s.png" % instance.static_name))
-        ## generate 24x24 icon
-        if coat:
-                icon = coat.copy()
-                icon.thumbnail((24,24), Image.ANTIALIAS)
-                icon.save(os.path.join(BADGES_DIR, "icon-%s.png" % instance.static_name))
-        ## generate Army token
+        return badge_base
+
+def make_icon(coat, fill):
+        """ Make the 24x24 icon """
+        icon = coat.copy()
+        icon.thumbnail((24,24), Image.ANTIALIAS)
+        return icon
+
+def make_army(coat, fill):
         army_base = Image.open(os.path.join(TEMPLATES_DIR, "army-base.png"))
         draw = ImageDraw.Draw(army_base)
-        draw.ellipse((5, 5, 45, 45), fill="#%s" % instance.color)
+        draw.ellipse((5, 5, 45, 45), fill=fill)
         del draw
         if coat:
                 a_coat = coat.copy()
                 a_coat.thumbnail((26,26), Image.ANTIALIAS)
                 army_base.paste(a_coat, (12,12), a_coat)
-        army_base.save(os.path.join(TOKENS_DIR, "A-%s.png" % instance.static_name))
-        ## generate Garrison token
+        return army_base
+
+def _garrison_coat(coat):
+        g_coat = coat.copy()
+        g_coat.thumbnail((19, 19), Image.ANTIALIAS)
+        return g_coat
+
+def make_garrison(coat, fill):
         garrison_base = Image.open(os.path.join(TEMPLATES_DIR, "garrison-base.png"))
         draw = ImageDraw.Draw(garrison_base)
-        draw.ellipse((3, 3, 30, 30), fill="#%s" % instance.color)
+        draw.ellipse((3, 3, 30, 30), fill=fill)
         del draw
         if coat:
-                g_coat = coat.copy()
-                g_coat.thumbnail((19, 19), Image.ANTIALIAS)
+                g_coat = _garrison_coat(coat)
                 garrison_base.paste(g_coat, (8,8), g_coat)
-        garrison_base.save(os.path.join(TOKENS_DIR, "G-%s.png" % instance.static_name))
-        ## generate Fleet token
+        return garrison_base
+
+def make_fleet(coat, fill):
         fleet_base = Image.open(os.path.join(TEMPLATES_DIR, "fleet-base.png"))
-        rectangle = round_rectangle((49,24), 7, "#%s" % instance.color)
+        rectangle = round_rectangle((49,24), 7, fill)
         fleet_base.paste(rectangle, (2, 2), rectangle)
         ship = Image.open(os.path.join(TEMPLATES_DIR, "ship-icon.png"))
         fleet_base.paste(ship, (0,0), ship)
         if coat:
+                g_coat = _garrison_coat(coat)
                 fleet_base.paste(g_coat, (6, 5), g_coat)
-        fleet_base.save(os.path.join(TOKENS_DIR, "F-%s.png" % instance.static_name))
-        ## generate Control token
+        return fleet_base
+
+def make_control(coat, fill):
         control = Image.new("RGBA", (24, 24))
         draw = ImageDraw.Draw(control)
-        draw.ellipse((0, 0, 24, 24), fill="#%s" % instance.color, outline="#000000")
+        draw.ellipse((0, 0, 24, 24), fill=fill, outline="#000000")
         del draw
-        control.save(os.path.join(TOKENS_DIR, "control-%s.png" % instance.static_name))
-        ## generate Home flag
-        flag = make_flag("#%s" % instance.color)
-        flag.save(os.path.join(TOKENS_DIR, "flag-%s.png" % instance.static_name))
+        return control
+
+def make_home_flag(coat, fill):
+        return make_flag(fill)
+
+## For each token of a country: the function that draws it, whether it
+## depends on the coat of arms and on the color, and the templates it uses
+COUNTRY_TOKENS = OrderedDict((
+        ('badge', (make_badge, True, False, ("badge-base.png",))),
+        ('icon', (make_icon, True, False, ())),
+        ('A', (make_army, True, True, ("army-base.png",))),
+        ('G', (make_garrison, True, True, ("garrison-base.png",))),
+        ('F', (make_fleet, True, True, ("fleet-base.png", "ship-icon.png"))),
+        ('control', (make_control, False, True, ())),
+        ('flag', (make_home_flag, False, True, ())),
+))
+
+def country_token_path(kind, static_name):
+        if kind in ("badge", "icon"):
+                return os.path.join(BADGES_DIR, "%s-%s.png" % (kind, static_name))
+        return os.path.join(TOKENS_DIR, "%s-%s.png" % (kind, static_name))
+
+def country_token_fingerprints(coat_path, color):
+        """ Returns a hash of the inputs of each token of a country """
+        coat = file_digest(coat_path)
+        fingerprints = {}
+        for kind, (maker, uses_coat, uses_color, templates) in COUNTRY_TOKENS.items():
+                digest = hashlib.sha1(("%s %s\n" % (RENDER_VERSION, kind)).encode())
+                if uses_coat:
+                        digest.update(("coat %s\n" % coat).encode())
+                if uses_color:
+                        digest.update(("color %s\n" % color.upper()).encode())
+                for name in templates:
+                        digest.update(("%s %s\n" % (name, file_digest(os.path.join(TEMPLATES_DIR, name)))).encode())
+                fingerprints[kind] = digest.hexdigest()
+        return fingerprints
+
+def token_fingerprints_path(static_name):
+        return os.path.join(TOKENS_DIR, "tokens-%s.json" % static_name)
+
+def read_token_fingerprints(static_name):
+        try:
+                with open(token_fingerprints_path(static_name)) as f:
+                        return json.load(f)
+        except (IOError, ValueError):
+                return {}
+
+def make_country_tokens(sender, instance, created, raw, update_atlas=True, **kwargs):
+        """ Generate the tokens of a country whose coat of arms, color or
+        templates have changed since they were last generated. Returns the
+        list of generated tokens.
+
+        If update_atlas is False, the global atlas is not packed again.
+        """
+        if raw:
+            return []
+        if instance.protected:
+            return []
+        with measure_render('tokens', instance.static_name):
+                return _make_country_tokens(sender, instance, update_atlas)
+
+def _make_country_tokens(sender, instance, update_atlas):
+        coat_path = instance.coat_of_arms.path
+        with render_phase('fingerprint'):
+                fingerprints = country_token_fingerprints(coat_path, instance.color)
+                stored = read_token_fingerprints(instance.static_name)
+                changed = [kind for kind in COUNTRY_TOKENS
+                        if stored.get(kind) != fingerprints[kind] or
+                        not os.path.exists(country_token_path(kind, instance.static_name))]
+        if changed:
+                with render_phase('decode'):
+                        coat = Image.open(coat_path)
+                        coat.load()
+                for kind in changed:
+                        maker = COUNTRY_TOKENS[kind][0]
+                        path = country_token_path(kind, instance.static_name)
+                        with render_phase('draw'):
+                                token = maker(coat, "#%s" % instance.color)
+                        with render_phase('encode'):
+                                token.save(path)
+                        count_written(path)
+                with open(token_fingerprints_path(instance.static_name), 'w') as f:
+                        json.dump(fingerprints, f)
+                ## forget the previous versions of the tokens
+                token_cache.invalidate([country_token_path(kind, instance.static_name)
+                        for kind in changed])
+        if TOKEN_ATLAS:
+                with render_phase('atlas'):
+                        if changed:
+                                make_country_atlas(instance.static_name)
+                        if update_atlas and (changed or instance.enabled != in_tokens_atlas(instance.static_name)):
+                                make_tokens_atlas(sender.objects.filter(enabled=True).values_list('static_name', flat=True))
+        return changed
@@ -0,0 +1,328 @@
+## Copyright (c) 2012 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" Benchmarks the rendering of maps and tokens with a synthetic setting.
+
+All the synthetic objects are created in a transaction that is rolled back,
+and all the images are written in a temporary directory, so the command can
+be run against any database.
+"""
+
+from io import BytesIO
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+import uuid
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+from PIL import Image, ImageDraw
+import PIL
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from django.contrib.auth.models import User
+
+from condottieri_scenarios.models import Setting, Scenario, Country, \
+	Contender, Area, Home, Setup, CityIncome, DisabledArea, ControlToken, \
+	GToken, AFToken
+import condottieri_scenarios.graphics as graphics
+
+## the token templates that are distributed with the application
+SHIPPED_TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.dirname(
+	os.path.dirname(os.path.abspath(__file__)))), 'media',
+	'condottieri_scenarios', 'token_templates')
+
+def max_rss():
+	""" Returns the peak resident memory of the whole life of the process in
+	KiB, or None """
+	if resource is None:
+		return None
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if platform.system() == 'Darwin':
+		rss //= 1024
+	return rss
+
+def reset_peak_rss():
+	""" Sets the peak resident memory of the process to its current size,
+	so that the peak of each run can be measured. Returns False if the
+	system cannot do it. Only Linux can. """
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5')
+	except (IOError, OSError):
+		return False
+	return True
+
+def peak_rss():
+	""" Returns the peak resident memory of the process in KiB since the
+	last reset_peak_rss, or None """
+	try:
+		with open('/proc/self/status') as f:
+			for line in f:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1])
+	except (IOError, OSError, ValueError):
+		pass
+	return None
+
+def drop_from_page_cache(path):
+	""" Asks the system to forget the cached pages of a file, so that the
+	next read comes from the disk. Only some systems can do it. """
+	if not hasattr(os, 'posix_fadvise') or not os.path.exists(path):
+		return
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+		os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+	except OSError:
+		pass
+	finally:
+		os.close(fd)
+
+def png(image):
+	buf = BytesIO()
+	image.save(buf, "PNG")
+	return ContentFile(buf.getvalue())
+
+def board_size(value):
+	try:
+		width, height = [int(v) for v in value.lower().split('x')]
+	except ValueError:
+		raise CommandError("The board size must be given as WIDTHxHEIGHT")
+	return width, height
+
+class Command(BaseCommand):
+	help = "Times the rendering of maps, thumbnails and tokens with synthetic data"
+
+	def add_arguments(self, parser):
+		parser.add_argument('--areas', type=int, default=80,
+			help="number of areas of the synthetic setting")
+		parser.add_argument('--contenders', type=int, default=8,
+			help="number of countries in the synthetic scenario")
+		parser.add_argument('--units', type=int, default=6,
+			help="number of home areas and units of each country")
+		parser.add_argument('--board-size', type=board_size, default=(1600, 1200),
+			help="size of the synthetic board, as WIDTHxHEIGHT")
+		parser.add_argument('--repeat', type=int, default=3,
+			help="number of runs of each benchmark")
+		parser.add_argument('--seed', type=int, default=0)
+		parser.add_argument('--output', default='graphics-benchmark.json',
+			help="JSON file where the results are written")
+
+	def handle(self, *args, **options):
+		if options['contenders'] * options['units'] > options['areas']:
+			raise CommandError("There are not enough areas for all the units")
+		self.random = random.Random(options['seed'])
+		tmpdir = tempfile.mkdtemp()
+		saved = dict((name, getattr(graphics, name))
+			for name in ('TOKENS_DIR', 'BADGES_DIR', 'TEMPLATES_DIR', 'LOCKS_DIR'))
+		try:
+			graphics.TOKENS_DIR = os.path.join(tmpdir, 'tokens')
+			graphics.BADGES_DIR = os.path.join(tmpdir, 'badges')
+			graphics.LOCKS_DIR = os.path.join(tmpdir, 'locks')
+			if not os.path.isdir(graphics.TEMPLATES_DIR):
+				graphics.TEMPLATES_DIR = SHIPPED_TEMPLATES_DIR
+			for d in (graphics.TOKENS_DIR, graphics.BADGES_DIR):
+				os.makedirs(d)
+			self.make_common_tokens(saved['TOKENS_DIR'])
+			with override_settings(MEDIA_ROOT=tmpdir):
+				with transaction.atomic():
+					scenario, countries = self.make_data(options)
+					results = self.run_benchmarks(scenario, countries, options['repeat'])
+					transaction.set_rollback(True)
+		finally:
+			for name, value in saved.items():
+				setattr(graphics, name, value)
+			graphics.clear_caches()
+			shutil.rmtree(tmpdir)
+		report = {'parameters': {
+				'areas': options['areas'],
+				'contenders': options['contenders'],
+				'units': options['units'],
+				'board_size': options['board_size'],
+				'repeat': options['repeat'],
+				'seed': options['seed']},
+			'environment': {
+				'python': platform.python_version(),
+				'pil': PIL.__version__,
+				'database': connection.vendor,
+				'board_mmap': graphics.BOARD_MMAP,
+				'token_atlas': graphics.TOKEN_ATLAS},
+			'results': results}
+		with open(options['output'], 'w') as f:
+			json.dump(report, f, indent=1)
+		self.stdout.write("Results written to %s" % options['output'])
+
+	def make_common_tokens(self, tokens_dir):
+		""" Copies the tokens that do not belong to any country, or draws
+		them if they are not installed """
+		coat = Image.new("RGBA", (40, 40), (160, 160, 160, 255))
+		makers = {'G': graphics.make_garrison, 'A': graphics.make_army,
+			'F': graphics.make_fleet}
+		for kind in ('disabled', 'chest', 'G', 'A', 'F'):
+			name = graphics.token_name(kind)
+			path = os.path.join(tokens_dir, name)
+			if os.path.exists(path):
+				shutil.copy(path, graphics.TOKENS_DIR)
+			elif kind in makers:
+				makers[kind](coat, "#A0A0A0").save(os.path.join(graphics.TOKENS_DIR, name))
+			else:
+				Image.new("RGBA", (30, 30), (0, 0, 0, 128)).save(
+					os.path.join(graphics.TOKENS_DIR, name))
+
+	def make_data(self, options):
+		""" Creates a setting with a generated board, a scenario and its
+		countries, with their coats of arms """
+		rnd = self.random
+		width, height = options['board_size']
+		user = User.objects.create(username="benchmark-%s" % uuid.uuid4().hex[:8])
+		board = Image.new("RGB", (width, height), (240, 230, 200))
+		draw = ImageDraw.Draw(board)
+		for i in range(options['areas']):
+			x, y = rnd.randrange(width), rnd.randrange(height)
+			draw.ellipse((x - 40, y - 40, x + 40, y + 40), outline=(120, 100, 80))
+		setting = Setting(title_en="Benchmark setting", description_en="", editor=user)
+		setting.board.save("board.png", png(board), save=False)
+		setting.save()
+		areas = []
+		for i in range(options['areas']):
+			areas.append(Area.objects.create(setting=setting,
+				name_en="Area %s" % i,
+				code="B%s" % i,
+				is_coast=True,
+				has_city=True,
+				is_fortified=True))
+		def point(token, area):
+			return token(area=area, x=rnd.randrange(width - 48), y=rnd.randrange(15, height - 48))
+		ControlToken.objects.bulk_create([point(ControlToken, a) for a in areas])
+		GToken.objects.bulk_create([point(GToken, a) for a in areas])
+		AFToken.objects.bulk_create([point(AFToken, a) for a in areas])
+		scenario = Scenario.objects.create(setting=setting,
+			title_en="Benchmark scenario",
+			description_en="",
+			start_year=1454,
+			editor=user)
+		countries = []
+		homes, setups = [], []
+		for i in range(options['contenders']):
+			color = rnd.randrange(0x1000000)
+			country = Country(name_en="Benchmark %s %s" % (i, uuid.uuid4().hex[:6]),
+				color="%06X" % color,
+				editor=user,
+				enabled=True)
+			country.save()
+			coat = Image.new("RGBA", (40, 40), (color >> 16, (color >> 8) & 255, color & 255, 255))
+			country.coat_of_arms.save("coat.png", png(coat))
+			countries.append(country)
+			contender = Contender.objects.create(country=country, scenario=scenario)
+			for j in range(options['units']):
+				area = areas[i + j * options['contenders']]
+				homes.append(Home(contender=contender, area=area, is_home=j % 2 == 0))
+				setups.append(Setup(contender=contender, area=area, unit_type="AFG"[j % 3]))
+		Home.objects.bulk_create(homes)
+		autonomous = scenario.contender_set.get(country__isnull=True)
+		free = areas[options['contenders'] * options['units']:]
+		setups += [Setup(contender=autonomous, area=a, unit_type='G') for a in free[::2]]
+		Setup.objects.bulk_create(setups)
+		CityIncome.objects.bulk_create([CityIncome(scenario=scenario, city=a) for a in free[1::4]])
+		DisabledArea.objects.bulk_create([DisabledArea(scenario=scenario, area=a) for a in free[3::4]])
+		return scenario, countries
+
+	def run_benchmarks(self, scenario, countries, repeat):
+		def make_tokens():
+			for country in countries:
+				graphics.make_country_tokens(Country, country, False, False)
+		def forget_tokens():
+			for country in countries:
+				try:
+					os.remove(graphics.token_fingerprints_path(country.static_name))
+				except OSError:
+					pass
+		def forget_map():
+			graphics.clear_caches()
+			drop_from_page_cache(scenario.map_path)
+		def make_thumb():
+			graphics.make_scenario_thumb(scenario, 187, 267, 'thumbnails')
+		map_image = []
+		def make_thumb_from_memory():
+			if not map_image:
+				map_image.append(Image.open(scenario.map_path).convert("RGB"))
+			graphics.make_scenario_thumb(scenario, 187, 267, 'thumbnails', image=map_image[0])
+		benchmarks = (
+			('tokens_cold', make_tokens, lambda: (forget_tokens(), graphics.clear_caches())),
+			('tokens_warm', make_tokens, None),
+			('map_cold', lambda: graphics.make_scenario_map(scenario, force=True), graphics.clear_caches),
+			('map_warm', lambda: graphics.make_scenario_map(scenario, force=True), None),
+			('map_up_to_date', lambda: graphics.make_scenario_map(scenario), None),
+			('thumbnail_cold', make_thumb, forget_map),
+			('thumbnail_warm', make_thumb, None),
+			('thumbnail_from_memory', make_thumb_from_memory, None),
+		)
+		results = {}
+		for name, run, prepare in benchmarks:
+			runs = []
+			for i in range(repeat):
+				if prepare is not None:
+					prepare()
+				runs.append(self.measure(run))
+			times = [r['time'] for r in runs]
+			results[name] = {'runs': runs,
+				'time_min': min(times),
+				'time_mean': sum(times) / len(times),
+				'queries': runs[-1]['queries']}
+			for key in ('peak_rss_kb', 'peak_rss_growth_kb'):
+				values = [r[key] for r in runs if r[key] is not None]
+				results[name][key] = max(values) if values else None
+			self.stdout.write("%-24s min %.4fs  mean %.4fs  %4s queries  peak RSS %s KiB" % (
+				name, results[name]['time_min'], results[name]['time_mean'],
+				results[name]['queries'], results[name]['peak_rss_kb']))
+		return results
+
+	def measure(self, run):
+		""" Runs a benchmark once and returns its wall time, its queries and
+		its memory use.
+
+		peak_rss_kb is the peak resident memory during the run, or None if
+		the peak of the process cannot be reset. peak_rss_growth_kb is how
+		much the run raised the peak of the whole process, so it is 0 when
+		an earlier run used more memory.
+		"""
+		gc.collect()
+		reset = reset_peak_rss()
+		before = max_rss()
+		with CaptureQueriesContext(connection) as queries:
+			start = time.perf_counter()
+			run()
+			elapsed = time.perf_counter() - start
+		after = max_rss()
+		return {'time': elapsed,
+			'queries': len(queries),
+			'peak_rss_kb': peak_rss() if reset else None,
+			'peak_rss_growth_kb': after - before if before is not None else None}
@@ -0,0 +1,38 @@
+## Copyright (c) 2012 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+from django.core.management.base import BaseCommand
+
+from condottieri_scenarios.models import Country
+import condottieri_scenarios.graphics as graphics
+
+class Command(BaseCommand):
+	help = "Packs the tokens of the enabled countries in the global atlas"
+
+	def add_arguments(self, parser):
+		parser.add_argument('--countries', action='store_true',
+			help="pack also the atlas of each country")
+
+	def handle(self, *args, **options):
+		names = list(Country.objects.filter(enabled=True).values_list(
+			'static_name', flat=True))
+		if options['countries']:
+			for name in names:
+				graphics.make_country_atlas(name)
+		index = graphics.make_tokens_atlas(names)
+		self.stdout.write("Packed %s tokens of %s countries" % (len(index), len(names)))
@@ -0,0 +1,116 @@
+## Copyright (c) 2012 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import os
+import time
+import traceback
+
+from django.core.management.base import BaseCommand, CommandError
+from django import db
+
+from condottieri_scenarios.models import Scenario
+import condottieri_scenarios.graphics as graphics
+
+def available_cores():
+	try:
+		return len(os.sched_getaffinity(0))
+	except AttributeError:
+		return os.cpu_count() or 1
+
+def render_scenario(pk, force):
+	""" Renders the map of a scenario. Returns whether the map was drawn, the
+	elapsed time and the error, if any. """
+	start = time.time()
+	try:
+		drawn = graphics.make_scenario_map(Scenario.objects.get(pk=pk), force=force)
+	except Exception:
+		return pk, False, time.time() - start, traceback.format_exc()
+	return pk, drawn, time.time() - start, None
+
+class Command(BaseCommand):
+	help = "Renders the initial maps of all the scenarios, or the given ones"
+
+	def add_arguments(self, parser):
+		parser.add_argument('scenarios', nargs='*', metavar='scenario',
+			help="slugs of the scenarios to render")
+		parser.add_argument('--setting', action='append', default=[],
+			help="render only the scenarios of this setting (slug)")
+		parser.add_argument('--enabled', action='store_true',
+			help="render only the enabled scenarios")
+		parser.add_argument('--force', action='store_true',
+			help="render the maps even if they are up to date")
+		parser.add_argument('--workers', type=int, default=available_cores(),
+			help="number of worker processes (default: available cores)")
+
+	def handle(self, *args, **options):
+		scenarios = Scenario.objects.select_related('setting')
+		if options['scenarios']:
+			scenarios = scenarios.filter(name__in=options['scenarios'])
+		if options['setting']:
+			scenarios = scenarios.filter(setting__slug__in=options['setting'])
+		if options['enabled']:
+			scenarios = scenarios.filter(enabled=True)
+		scenarios = dict((s.pk, s) for s in scenarios.order_by('setting', 'pk'))
+		if not scenarios:
+			raise CommandError("No scenarios found")
+		## decode each board once, before forking, so that all the workers
+		## share it
+		for s in scenarios.values():
+			try:
+				graphics.get_board(s.setting)
+			except (IOError, ValueError):
+				pass
+		start = time.time()
+		results = []
+		if options['workers'] > 1:
+			## each worker must open its own database connection
+			db.connections.close_all()
+			with ProcessPoolExecutor(max_workers=options['workers'],
+				mp_context=multiprocessing.get_context('fork')) as pool:
+				futures = [pool.submit(render_scenario, pk, options['force'])
+					for pk in scenarios]
+				for future in as_completed(futures):
+					results.append(self.report(scenarios, future.result()))
+		else:
+			for pk in scenarios:
+				results.append(self.report(scenarios,
+					render_scenario(pk, options['force'])))
+		elapsed = time.time() - start
+		drawn = len([r for r in results if r == 'drawn'])
+		failed = len([r for r in results if r == 'failed'])
+		self.stdout.write("%s maps: %s drawn, %s up to date, %s failed in %.2fs (%.2f maps/s, %s workers)" % (
+			len(results), drawn, len(results) - drawn - failed, failed,
+			elapsed, len(results) / elapsed if elapsed else 0,
+			options['workers']))
+		if failed:
+			raise CommandError("%s maps could not be rendered" % failed)
+
+	def report(self, scenarios, result):
+		pk, drawn, elapsed, error = result
+		name = scenarios[pk].name
+		if error:
+			self.stderr.write(self.style.ERROR("%-40s failed after %.2fs" % (name, elapsed)))
+			self.stderr.write(error)
+			return 'failed'
+		if drawn:
+			self.stdout.write("%-40s drawn in %.2fs" % (name, elapsed))
+			return 'drawn'
+		self.stdout.write("%-40s up to date (%.2fs)" % (name, elapsed))
+		return 'skipped'
@@ -19,7 +19,6 @@
 import os.path
 
 from django.db import models
-from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
@@ -34,7 +33,10 @@ import logging
 logger = logging.getLogger(__name__)
 
 import condottieri_scenarios.managers as managers
+import condottieri_scenarios.boards as boards
+import condottieri_scenarios.snapshots as snapshots
 import condottieri_scenarios.graphics as graphics
+import condottieri_scenarios.renderqueue as renderqueue
 import machiavelli.slugify as slugify
 
 class Error(Exception):
@@ -120,6 +122,7 @@ def create_configuration(sender, instance, created, raw, **kwargs):
         config.save()
 
 models.signals.post_save.connect(create_configuration, sender=Setting)
+models.signals.post_save.connect(graphics.signal_handler_make_raw_board, sender=Setting)
 
 class Scenario(models.Model, metaclass=TransMeta):
     """ This class defines a Condottieri scenario. """
@@ -173,11 +176,22 @@ class Scenario(models.Model, metaclass=TransMeta):
     map_path = property(_get_map_path)
 
     def _get_map_url(self):
-        return os.path.join(settings.MEDIA_URL, settings.SCENARIOS_ROOT,
-            self.map_name)
+        return graphics.output_url(self.map_path, os.path.join(settings.MEDIA_URL,
+            settings.SCENARIOS_ROOT, self.map_name))
 
     map_url = property(_get_map_url)
 
+    def _get_svg_path(self):
+        return "%s.svg" % os.path.splitext(self.map_path)[0]
+
+    svg_path = property(_get_svg_path)
+
+    def _get_svg_url(self):
+        return graphics.output_url(self.svg_path, "%s.svg" % os.path.splitext(
+            os.path.join(settings.MEDIA_URL, settings.SCENARIOS_ROOT, self.map_name))[0])
+
+    svg_url = property(_get_svg_url)
+
     def _get_thumbnail_path(self):
         return os.path.join(settings.MEDIA_ROOT, settings.SCENARIOS_ROOT,
             "thumbnails", self.map_name)
@@ -185,10 +199,62 @@ class Scenario(models.Model, metaclass=TransMeta):
     thumbnail_path = property(_get_thumbnail_path)
 
     def _get_thumbnail_url(self):
-        return os.path.join(settings.MEDIA_URL, settings.SCENARIOS_ROOT,
-            "thumbnails", self.map_name)
+        return graphics.output_url(self.thumbnail_path, os.path.join(settings.MEDIA_URL,
+            settings.SCENARIOS_ROOT, "thumbnails", self.map_name))
     
     thumbnail_url = property(_get_thumbnail_url)
+
+    def _get_variant_name(self, variant):
+        options = graphics.MAP_VARIANTS[variant]
+        name = os.path.splitext(self.map_name)[0]
+        extension = graphics.VARIANT_EXTENSIONS[options.get('format', 'JPEG')]
+        return os.path.join(options.get('dir', variant), "%s.%s" % (name, extension))
+
+    def get_variant_path(self, variant):
+        """ Returns the path of a variant of the map, as defined in
+        graphics.MAP_VARIANTS """
+        return os.path.join(settings.MEDIA_ROOT, settings.SCENARIOS_ROOT,
+            self._get_variant_name(variant))
+
+    def get_variant_url(self, variant):
+        return graphics.output_url(self.get_variant_path(variant),
+            os.path.join(settings.MEDIA_URL, settings.SCENARIOS_ROOT,
+            self._get_variant_name(variant)))
+
+    def _get_variant_urls(self):
+        return dict((variant, self.get_variant_url(variant))
+            for variant in graphics.MAP_VARIANTS)
+
+    variant_urls = property(_get_variant_urls)
+
+    def _get_tiles_path(self):
+        return os.path.join(settings.MEDIA_ROOT, settings.SCENARIOS_ROOT,
+            "tiles", self.name)
+
+    tiles_path = property(_get_tiles_path)
+
+    def _get_tiles_url(self):
+        return graphics.output_url(self.tiles_path, os.path.join(settings.MEDIA_URL,
+            settings.SCENARIOS_ROOT, "tiles", self.name, ""))
+
+    tiles_url = property(_get_tiles_url)
+
+    def _get_tiles_manifest_path(self):
+        return os.path.join(self.tiles_path, "manifest.json")
+
+    tiles_manifest_path = property(_get_tiles_manifest_path)
+
+    def _get_tiles_manifest_url(self):
+        return "%smanifest.json" % self.tiles_url
+
+    tiles_manifest_url = property(_get_tiles_manifest_url)
+
+    def _get_tile_url_template(self):
+        """ URL of the tiles, with {z}, {x} and {y} placeholders for the zoom
+        level, column and row """
+        return "%s{z}/{x}_{y}.jpg" % self.tiles_url
+
+    tile_url_template = property(_get_tile_url_template)
     
     def _get_in_use(self):
         return self.game_set.count() > 0
@@ -206,18 +272,23 @@ class Scenario(models.Model, metaclass=TransMeta):
     #countries = property(_get_countries)
 
     def _get_setup_dict(self):
-        """ Returns a dictionary with all the setup data for the scenario."""
-        _setup_dict = {}
-        for c in self.countries:
-            treasury = c.treasury_set.get(scenario=self)
-            c_dict = {
+        """ Returns a dictionary with all the setup data for the scenario,
+        by country static name. homes is a tuple of (area id, is_home) and
+        setups a tuple of (area id, unit type) tuples. ducats is None if the
+        country has no treasury.
+
+        The data is read from the snapshot of the scenario, so it needs no
+        queries once the snapshot is built.
+        """
+        setup = {}
+        for c in snapshots.get_snapshot(self).countries:
+            setup[c.country] = {
                 'name': c.name,
-                'homes': c.home_set.select_related().filter(scenario=self),
-                'setups': c.setup_set.select_related().filter(scenario=self),
-                'ducats': treasury.ducats,      
-                'double': treasury.double,}
-            _setup_dict.update({c.static_name: c_dict})
-        return _setup_dict
+                'homes': tuple((h.area, h.is_home) for h in c.homes),
+                'setups': tuple((u.area, u.unit_type) for u in c.setups),
+                'ducats': c.ducats,
+                'double': c.double,}
+        return setup
 
     setup_dict = property(_get_setup_dict)
 
@@ -345,7 +416,7 @@ class Country(models.Model, metaclass=TransMeta):
 
     in_play = property(_get_in_play)
 
-models.signals.post_save.connect(graphics.signal_handler_make_country_tokens, sender=Country)
+models.signals.post_save.connect(renderqueue.signal_handler_make_country_tokens, sender=Country)
 
 class Contender(models.Model):
     """ A Contender object defines a relationship between an Scenario and a
@@ -434,15 +505,12 @@ class Area(models.Model, metaclass=TransMeta):
     objects = managers.AreaManager()
 
     def is_adjacent(self, area, fleet=False):
-        """ Two areas can be adjacent through land, but not through a coast."""
+        """ Two areas can be adjacent through land, but not through a coast.
+        The borders are read from the BoardGraph of the setting, so no query
+        is made once it is built. """
         
-        if fleet:
-            borders = Border.objects.filter(Q(from_area=self, to_area=area)|
-                                        Q(from_area=area, to_area=self))
-            for b in borders:
-                if b.only_land:
-                    return False
-        return area in self.borders.all()
+        graph = boards.get_board_graph(self.setting_id)
+        return graph.is_adjacent(self.pk, area.pk, fleet)
 
     def build_possible(self, type):
         """ Returns True if the given type of Unit can be built in the Area. """
@@ -513,6 +581,10 @@ def symmetric_border(sender, instance, created, raw, **kwargs):
 
 models.signals.post_save.connect(symmetric_border, sender=Border)
 
+for model in (Area, Border):
+    models.signals.post_save.connect(boards.signal_handler_clear_board_graphs, sender=model)
+    models.signals.post_delete.connect(boards.signal_handler_clear_board_graphs, sender=model)
+
 class DisabledArea(models.Model):
     """ A DisabledArea is an Area that is not used in a given Scenario. """
     scenario = models.ForeignKey(Scenario, verbose_name=_("scenario"), on_delete=models.CASCADE)
@@ -774,6 +846,18 @@ class AFToken(models.Model):
     def __str__(self):
         return "%s, %s" % (self.x, self.y)
 
+for model in (Area, ControlToken, GToken, AFToken):
+    models.signals.post_save.connect(graphics.signal_handler_clear_coordinates, sender=model)
+    models.signals.post_delete.connect(graphics.signal_handler_clear_coordinates, sender=model)
+
+for model in (Scenario, Contender, Treasury, Home, Setup, CityIncome, DisabledArea):
+    models.signals.post_save.connect(snapshots.signal_handler_clear_snapshot, sender=model)
+    models.signals.post_delete.connect(snapshots.signal_handler_clear_snapshot, sender=model)
+
+for model in (Country, Area):
+    models.signals.post_save.connect(snapshots.signal_handler_clear_snapshots, sender=model)
+    models.signals.post_delete.connect(snapshots.signal_handler_clear_snapshots, sender=model)
+
 ##
 ## Natural disasters
 ##
@@ -0,0 +1,294 @@
+## Copyright (c) 2012 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module renders the scenario maps and the country tokens in a local
+pool of worker processes, out of the request/response cycle.
+
+The status of the last render job of each scenario is kept in a JSON file, so
+that it can be read from any web process. A render requested while another
+one is pending for the same scenario is merged with the pending job.
+
+While the tokens of a country are being generated, a marker file exists in
+the tokens directory, so that maps rendered in any process wait for them.
+"""
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
+import json
+import multiprocessing
+import os
+import os.path
+import tempfile
+import threading
+import time
+import uuid
+
+import django
+from django.conf import settings
+from django.db import transaction
+
+import condottieri_scenarios.graphics as graphics
+
+import logging
+logger = logging.getLogger(__name__)
+
+## number of worker processes. If 0, maps are rendered in the calling thread
+RENDER_WORKERS = getattr(settings, 'SCENARIOS_RENDER_WORKERS', 2)
+## seconds after which a pending job is considered lost
+JOB_TIMEOUT = getattr(settings, 'SCENARIOS_RENDER_JOB_TIMEOUT', 600)
+## seconds that a map job waits for the tokens of its countries. If they are
+## not ready by then, for example because the worker that was making them
+## died, the map is drawn with the current tokens
+TOKENS_WAIT = getattr(settings, 'SCENARIOS_RENDER_TOKENS_WAIT', 30)
+## directory of the job files. They may hold error messages, so it must not
+## be served to the public
+JOBS_DIR = getattr(settings, 'SCENARIOS_RENDER_JOBS_DIR',
+	os.path.join(tempfile.gettempdir(), 'condottieri_scenarios', 'jobs'))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_lock = threading.Lock()
+_executor = None
+
+def _init_worker():
+	django.setup()
+
+def get_executor():
+	""" Returns the pool of worker processes, creating it if needed.
+
+	Workers are spawned, not forked, so that they do not share the database
+	connections of the web process.
+	"""
+	global _executor
+	if _executor is None:
+		_executor = ProcessPoolExecutor(max_workers=RENDER_WORKERS,
+			mp_context=multiprocessing.get_context('spawn'),
+			initializer=_init_worker)
+	return _executor
+
+def submit(fn, *args):
+	""" Submits a call to the pool, replacing the pool if it is broken """
+	global _executor
+	try:
+		return get_executor().submit(fn, *args)
+	except BrokenProcessPool:
+		logger.error("The render pool was broken and has been restarted")
+		_executor = None
+		return get_executor().submit(fn, *args)
+
+def job_path(name):
+	return os.path.join(JOBS_DIR, "%s.json" % name)
+
+def read_job(name):
+	""" Returns the status of the last render job of a scenario, or None """
+	try:
+		with open(job_path(name)) as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return None
+
+def write_job(job):
+	path = job_path(job['scenario'])
+	os.makedirs(JOBS_DIR, exist_ok=True)
+	tmp = "%s.%s.tmp" % (path, os.getpid())
+	with open(tmp, 'w') as f:
+		json.dump(job, f)
+	os.replace(tmp, path)
+
+def _update_job(name, job_id, **kwargs):
+	""" Updates the status of a job, if it is still the last job of the
+	scenario """
+	job = read_job(name)
+	if job is None or job['job_id'] != job_id:
+		return
+	job.update(kwargs)
+	write_job(job)
+
+def is_pending(job):
+	if job is None or job['state'] not in (QUEUED, RUNNING):
+		return False
+	return time.time() - job['queued'] < JOB_TIMEOUT
+
+def run_job(pk, name, job_id, force=False):
+	""" Renders the map of a scenario and records the result in its job """
+	from condottieri_scenarios.models import Scenario
+	from condottieri_scenarios.graphics import make_scenario_map
+	_update_job(name, job_id, state=RUNNING, started=time.time())
+	try:
+		scenario = Scenario.objects.get(pk=pk)
+		if not wait_for_tokens(scenario_countries(scenario), timeout=TOKENS_WAIT):
+			logger.warning("Rendering %s before its tokens are ready" % name)
+		drawn = make_scenario_map(scenario, force=force)
+	except Exception as e:
+		logger.exception("Could not render the map of %s" % name)
+		_update_job(name, job_id, state=FAILED, finished=time.time(),
+			error=str(e))
+	else:
+		_update_job(name, job_id, state=DONE, finished=time.time(),
+			drawn=drawn)
+
+def enqueue_map(scenario, force=False):
+	""" Queues the rendering of the map of a scenario and returns its job.
+
+	If a job for the same scenario is queued and has not started yet, that
+	job is returned instead of creating a new one. A running job may have
+	read the scenario before the last changes, so a new job is queued after
+	it. The scenario lock makes the new job wait for the running one.
+	"""
+	with _lock:
+		job = read_job(scenario.name)
+		if is_pending(job) and job['state'] == QUEUED and \
+			(job['force'] or not force):
+			return job
+		job = {'job_id': uuid.uuid4().hex,
+			'scenario': scenario.name,
+			'state': QUEUED,
+			'force': force,
+			'queued': time.time()}
+		write_job(job)
+	if RENDER_WORKERS > 0:
+		## do not take a worker until the tokens queued by this process
+		## are ready
+		pending = [_token_jobs[c] for c in scenario_countries(scenario)
+			if c in _token_jobs]
+		when_done(pending, submit, run_job, scenario.pk, scenario.name,
+			job['job_id'], force)
+	else:
+		run_job(scenario.pk, scenario.name, job['job_id'], force)
+	return read_job(scenario.name)
+
+def when_done(futures, fn, *args):
+	""" Calls fn(*args) when all the futures are done """
+	remaining = [len(futures)]
+	lock = threading.Lock()
+	def done(future):
+		with lock:
+			remaining[0] -= 1
+			if remaining[0] > 0:
+				return
+		fn(*args)
+	if not futures:
+		fn(*args)
+	for future in futures:
+		future.add_done_callback(done)
+
+def scenario_countries(scenario):
+	return list(scenario.contender_set.filter(country__isnull=False).values_list(
+		'country__static_name', flat=True))
+
+##
+## Country tokens
+##
+
+## futures of the token jobs queued by this process, by country
+_token_jobs = {}
+
+def tokens_marker_path(static_name):
+	return os.path.join(graphics.TOKENS_DIR, "tokens-%s.pending" % static_name)
+
+def tokens_pending(static_name):
+	""" Returns True if the tokens of a country are being generated by any
+	process """
+	try:
+		mtime = os.path.getmtime(tokens_marker_path(static_name))
+	except OSError:
+		return False
+	return time.time() - mtime < JOB_TIMEOUT
+
+def run_tokens_job(pk, update_atlas=True):
+	""" Generates the tokens of a country """
+	from condottieri_scenarios.models import Country
+	country = Country.objects.get(pk=pk)
+	try:
+		return graphics.make_country_tokens(Country, country, False, False,
+			update_atlas=update_atlas)
+	finally:
+		try:
+			os.remove(tokens_marker_path(country.static_name))
+		except OSError:
+			pass
+
+def run_atlas_job():
+	""" Packs the tokens of all the enabled countries in the global atlas """
+	from condottieri_scenarios.models import Country
+	graphics.make_tokens_atlas(Country.objects.filter(enabled=True).values_list(
+		'static_name', flat=True))
+
+def enqueue_tokens(country, update_atlas=True):
+	""" Queues the generation of the tokens of a country and returns a
+	future """
+	name = country.static_name
+	os.makedirs(graphics.TOKENS_DIR, exist_ok=True)
+	with open(tokens_marker_path(name), 'w'):
+		pass
+	if RENDER_WORKERS > 0:
+		future = submit(run_tokens_job, country.pk, update_atlas)
+	else:
+		future = Future()
+		try:
+			future.set_result(run_tokens_job(country.pk, update_atlas))
+		except Exception as e:
+			future.set_exception(e)
+	_token_jobs[name] = future
+	def forget(f):
+		if _token_jobs.get(name) is f:
+			del _token_jobs[name]
+	future.add_done_callback(forget)
+	return future
+
+def make_tokens_batch(countries, wait=True, timeout=None):
+	""" Generates in parallel the tokens of several countries. The global
+	atlas, if used, is packed once, when all of them are done.
+
+	Returns a dictionary with the future of each country. If wait is True,
+	waits for the tokens before returning.
+	"""
+	futures = dict((c.static_name, enqueue_tokens(c, update_atlas=False))
+		for c in countries)
+	if graphics.TOKEN_ATLAS:
+		if RENDER_WORKERS > 0:
+			when_done(list(futures.values()), submit, run_atlas_job)
+		else:
+			run_atlas_job()
+	if wait:
+		wait_for_tokens(list(futures), timeout=timeout)
+	return futures
+
+def wait_for_tokens(static_names, timeout=None, poll=0.2):
+	""" Waits until the tokens of the given countries are generated, by this
+	or by any other process. Returns False on timeout. """
+	deadline = None if timeout is None else time.time() + timeout
+	futures = [_token_jobs[n] for n in static_names if n in _token_jobs]
+	if futures:
+		wait_futures(futures, timeout=timeout)
+	while any(tokens_pending(n) for n in static_names):
+		if deadline is not None and time.time() >= deadline:
+			return False
+		time.sleep(poll)
+	return True
+
+def signal_handler_make_country_tokens(sender, instance, created, raw, **kwargs):
+	""" Queues the generation of the tokens of a saved country, once the
+	transaction is committed """
+	if raw or instance.protected:
+		return
+	transaction.on_commit(lambda: enqueue_tokens(instance))
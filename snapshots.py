@@ -0,0 +1,239 @@
+## Copyright (c) 2012 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module compiles all the setup data of a scenario in an immutable
+ScenarioSnapshot, built from tuples, that can be read without any query.
+
+Snapshots are kept in the Django cache and in the memory of each process.
+Names are translated, so there is a snapshot for each language. When any
+part of a scenario is saved or deleted, a new version of the scenario is
+written in the cache, so that every process stops using its old snapshots.
+"""
+
+from collections import namedtuple
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils.translation import get_language, ugettext as _
+
+## seconds that a snapshot is kept in the Django cache. None means forever
+SNAPSHOT_TIMEOUT = getattr(settings, 'SCENARIOS_SNAPSHOT_TIMEOUT', None)
+
+SNAPSHOT_KEY = "condottieri_scenarios:snapshot:%s:%s:%s:%s"
+VERSION_KEY = "condottieri_scenarios:snapshot-version:%s"
+GLOBAL_VERSION_KEY = "condottieri_scenarios:snapshot-version"
+
+class AreaItem(namedtuple('AreaItem', ['code', 'name'])):
+	""" An area of the scenario, such as a city income or a disabled area """
+	__slots__ = ()
+
+	def __str__(self):
+		return self.name
+
+class HomeItem(namedtuple('HomeItem', ['area', 'code', 'name', 'is_home'])):
+	""" An area controlled by a contender. area is the id of the area """
+	__slots__ = ()
+
+	def __str__(self):
+		return self.name
+
+class UnitItem(namedtuple('UnitItem', ['area', 'code', 'name', 'unit_type'])):
+	""" A unit of a contender. area is the id of the area """
+	__slots__ = ()
+
+	def __str__(self):
+		from condottieri_scenarios.models import UNIT_TYPES
+		return _("%(unit)s in %(area)s") % {
+			'unit': dict(UNIT_TYPES)[self.unit_type],
+			'area': self.name }
+
+class ContenderSnapshot(namedtuple('ContenderSnapshot', ['id', 'country',
+	'name', 'priority', 'homes', 'setups', 'ducats', 'double'])):
+	""" The setup of a contender. country is the static name of the country,
+	or None for the autonomous units, and ducats is None if the contender
+	has no treasury. """
+	__slots__ = ()
+
+	def __str__(self):
+		return self.name
+
+class ScenarioSnapshot(namedtuple('ScenarioSnapshot', ['id', 'name',
+	'setting_id', 'contenders', 'cities', 'disabled'])):
+	""" All the setup data of a scenario. contenders is a tuple of
+	ContenderSnapshot, in the order of Contender, and cities and disabled
+	are tuples of AreaItem. """
+	__slots__ = ()
+
+	def _get_countries(self):
+		return tuple(c for c in self.contenders if c.country is not None)
+
+	countries = property(_get_countries)
+
+	def _get_autonomous(self):
+		for c in self.contenders:
+			if c.country is None:
+				return c
+		return None
+
+	autonomous = property(_get_autonomous)
+
+	def _get_number_of_players(self):
+		return len(self.countries)
+
+	number_of_players = property(_get_number_of_players)
+
+	def get_contender(self, country):
+		""" Returns the ContenderSnapshot of a country, given by its static
+		name, or None """
+		for c in self.contenders:
+			if c.country == country:
+				return c
+		return None
+
+	def get_game_state(self):
+		""" Returns the initial state of the scenario as the keyword
+		arguments of graphics.get_game_plan """
+		controls, homes, units = [], [], []
+		for c in self.countries:
+			for h in c.homes:
+				controls.append((h.code, c.country))
+				if h.is_home:
+					homes.append((h.code, c.country))
+			units += [(u.code, u.unit_type, c.country) for u in c.setups]
+		autonomous = self.autonomous
+		if autonomous is not None:
+			units += [(u.code, 'G', None) for u in autonomous.setups
+				if u.unit_type == 'G']
+		markers = [(a.code, 'disabled') for a in self.disabled] + \
+			[(a.code, 'chest') for a in self.cities]
+		return {'controls': controls, 'homes': homes, 'units': units,
+			'markers': markers}
+
+def build_snapshot(scenario):
+	""" Builds the ScenarioSnapshot of a scenario with five queries """
+	from condottieri_scenarios.models import Home, Setup
+	contenders = list(scenario.contender_set.select_related('country', 'treasury'))
+	homes = dict((c.id, []) for c in contenders)
+	for h in Home.objects.filter(contender__scenario=scenario).select_related(
+		'area').order_by('id'):
+		homes[h.contender_id].append(HomeItem(h.area_id, h.area.code,
+			str(h.area.name), h.is_home))
+	setups = dict((c.id, []) for c in contenders)
+	for s in Setup.objects.filter(contender__scenario=scenario).select_related(
+		'area').order_by('id'):
+		setups[s.contender_id].append(UnitItem(s.area_id, s.area.code,
+			str(s.area.name), s.unit_type))
+	items = []
+	for c in contenders:
+		try:
+			ducats, double = c.treasury.ducats, c.treasury.double
+		except ObjectDoesNotExist:
+			ducats, double = None, False
+		items.append(ContenderSnapshot(c.id,
+			c.country.static_name if c.country else None,
+			str(c),
+			c.priority,
+			tuple(homes[c.id]),
+			tuple(setups[c.id]),
+			ducats,
+			double))
+	cities = tuple(AreaItem(i.city.code, str(i.city.name))
+		for i in scenario.cityincome_set.select_related('city').order_by('city__code'))
+	disabled = tuple(AreaItem(d.area.code, str(d.area.name))
+		for d in scenario.disabledarea_set.select_related('area').order_by('area__code'))
+	return ScenarioSnapshot(scenario.id, scenario.name, scenario.setting_id,
+		tuple(items), cities, disabled)
+
+## snapshots in memory, by (scenario id, language, global version, version)
+_snapshots = {}
+_lock = threading.Lock()
+
+def get_versions(keys):
+	""" Returns a tuple with the versions kept in the Django cache under the
+	given keys, creating the missing ones.
+
+	Data that is kept in the memory of each process is stored with the
+	versions that were current when it was built, and it is out of date when
+	they change. """
+	versions = cache.get_many(keys)
+	for key in keys:
+		if key not in versions:
+			cache.add(key, uuid.uuid4().hex, None)
+			versions[key] = cache.get(key)
+	return tuple(versions[key] for key in keys)
+
+def bump_version(key):
+	""" Sets a new version under a key, so that every process discards the
+	data built with the old one """
+	cache.set(key, uuid.uuid4().hex, None)
+
+def _get_versions(pk):
+	""" Returns the current global version and the version of a scenario """
+	return get_versions([GLOBAL_VERSION_KEY, VERSION_KEY % pk])
+
+def get_snapshot(scenario):
+	""" Returns the ScenarioSnapshot of a scenario in the active language,
+	building it if it is neither in memory nor in the cache """
+	language = get_language() or settings.LANGUAGE_CODE
+	versions = _get_versions(scenario.pk)
+	key = (scenario.pk, language) + versions
+	snapshot = _snapshots.get(key)
+	if snapshot is not None:
+		return snapshot
+	cache_key = SNAPSHOT_KEY % ((scenario.pk, language) + versions)
+	snapshot = cache.get(cache_key)
+	if snapshot is None:
+		snapshot = build_snapshot(scenario)
+		cache.set(cache_key, snapshot, SNAPSHOT_TIMEOUT)
+	with _lock:
+		for old in [k for k in _snapshots if k[:2] == key[:2]]:
+			del _snapshots[old]
+		_snapshots[key] = snapshot
+	return snapshot
+
+def clear_snapshot(pk):
+	""" Discards the snapshots of a scenario, given by its id """
+	bump_version(VERSION_KEY % pk)
+	with _lock:
+		for key in [k for k in _snapshots if k[0] == pk]:
+			del _snapshots[key]
+
+def clear_snapshots():
+	""" Discards the snapshots of all the scenarios """
+	bump_version(GLOBAL_VERSION_KEY)
+	with _lock:
+		_snapshots.clear()
+
+def signal_handler_clear_snapshot(sender, instance, **kwargs):
+	""" Discards the snapshots of the scenario of a saved or deleted object """
+	from condottieri_scenarios.models import Scenario
+	if isinstance(instance, Scenario):
+		clear_snapshot(instance.pk)
+	elif hasattr(instance, 'scenario_id'):
+		clear_snapshot(instance.scenario_id)
+	else:
+		try:
+			clear_snapshot(instance.contender.scenario_id)
+		except ObjectDoesNotExist:
+			clear_snapshots()
+
+def signal_handler_clear_snapshots(sender, instance, **kwargs):
+	clear_snapshots()
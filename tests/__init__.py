@@ -1,2 +1,7 @@
+from .boards import *
+from .commands import *
 from .graphics import *
 from .models import *
+from .renderqueue import *
+from .snapshots import *
+from .views import *
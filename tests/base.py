@@ -0,0 +1,52 @@
+from django.contrib.auth.models import User
+
+from condottieri_scenarios.models import Setting, Scenario, Country, \
+    Contender, Area, Home, Setup, Treasury, CityIncome, DisabledArea, \
+    ControlToken, GToken, AFToken
+
+class ScenarioFixtureMixin(object):
+    """ Creates a setting with three areas and their tokens, and a scenario
+    with a country and the autonomous units:
+
+    * areas ALI, MUR and ALB, named Ali, Mur and Alb.
+    * Albacete has its home and an army in ALI, and a treasury of 12 ducats.
+    * The autonomous contender has a garrison in MUR.
+    * MUR is a city income and ALB is disabled.
+    """
+
+    fixtures = ['users.yaml',]
+
+    def setUp(self):
+        self.user = User.objects.first()
+        self.setting = Setting.objects.create(title_en = 'dummy setting',
+                description_en = 'description',
+                editor = self.user)
+        self.areas = []
+        for i, code in enumerate(("ALI", "MUR", "ALB")):
+            area = Area.objects.create(setting=self.setting,
+                    name_en=code.title(),
+                    code=code,
+                    has_city=True,
+                    is_fortified=True)
+            ControlToken.objects.create(area=area, x=10 * i, y=100 + i)
+            GToken.objects.create(area=area, x=20 * i, y=200 + i)
+            AFToken.objects.create(area=area, x=30 * i, y=300 + i)
+            self.areas.append(area)
+        self.country = Country.objects.create(name_en = "Albacete",
+                color = "000000",
+                coat_of_arms = "",
+                editor = self.user)
+        self.scenario = Scenario.objects.create(setting = self.setting,
+                title_en = "dummy scenario",
+                description_en = "description",
+                start_year = 0,
+                editor = self.user)
+        self.contender = Contender.objects.create(country=self.country,
+                scenario=self.scenario)
+        Treasury.objects.create(contender=self.contender, ducats=12)
+        self.autonomous = self.scenario.contender_set.get(country__isnull=True)
+        Home.objects.create(contender=self.contender, area=self.areas[0])
+        Setup.objects.create(contender=self.contender, area=self.areas[0], unit_type='A')
+        Setup.objects.create(contender=self.autonomous, area=self.areas[1], unit_type='G')
+        CityIncome.objects.create(scenario=self.scenario, city=self.areas[1])
+        DisabledArea.objects.create(scenario=self.scenario, area=self.areas[2])
@@ -0,0 +1,181 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from unittest import mock
+
+from django.contrib.auth.models import User
+
+import condottieri_scenarios.boards as boards
+from condottieri_scenarios.boards import *
+from condottieri_scenarios.models import Setting, Scenario, Area, Border, \
+    DisabledArea
+
+class BoardGraphTestCase(TestCase):
+
+    def setUp(self):
+        areas = ((10, "MUR"), (11, "ALI"), (12, "ALB"), (13, "VAL"))
+        borders = ((11, 10, False), (10, 11, False),
+            (11, 12, True), (12, 11, False),
+            (10, 12, False))
+        self.graph = BoardGraph(areas, borders)
+
+    def test_indices(self):
+        self.assertEqual(len(self.graph), 4)
+        self.assertEqual(self.graph.codes, ("ALB", "ALI", "MUR", "VAL"))
+        self.assertEqual(self.graph.index[11], 1)
+        self.assertEqual(self.graph.code_index["VAL"], 3)
+
+    def test_adjacency(self):
+        self.assertEqual(self.graph.adjacency, ((1,), (0, 2), (0, 1), ()))
+        self.assertEqual(self.graph.neighbors(1, fleet=True), frozenset([2]))
+
+    def test_is_adjacent(self):
+        self.assertTrue(self.graph.is_adjacent(11, 10, fleet=True))
+        self.assertTrue(self.graph.is_adjacent(10, 12))
+        self.assertFalse(self.graph.is_adjacent(12, 10))
+        self.assertFalse(self.graph.is_adjacent(10, 13))
+        self.assertFalse(self.graph.is_adjacent(10, 99))
+
+    def test_only_land_in_either_direction(self):
+        self.assertTrue(self.graph.is_adjacent(12, 11))
+        self.assertFalse(self.graph.is_adjacent(12, 11, fleet=True))
+        self.assertFalse(self.graph.is_adjacent(11, 12, fleet=True))
+
+    def test_masks(self):
+        self.assertEqual(self.graph.mask([0, 2]), 0b101)
+        self.assertEqual(self.graph.ids_mask([12, 10]), 0b101)
+        self.assertEqual(self.graph.indices(0b1010), [1, 3])
+
+    def test_neighbors_mask(self):
+        self.assertEqual(self.graph.neighbors_mask(1), 0b101)
+        self.assertEqual(self.graph.neighbors_mask(1, 'fleet'), 0b100)
+        self.assertEqual(self.graph.neighbors_mask(1, 'land'), 0b001)
+        self.assertEqual(self.graph.neighbors_mask(0, 'land'), 0b010)
+
+    def test_neighbors_union(self):
+        self.assertEqual(self.graph.neighbors_union(0b101), 0b011)
+        self.assertEqual(self.graph.neighbors_union(0b001, 'fleet'), 0)
+        self.assertEqual(self.graph.neighbors_union(0b110, 'fleet'), 0b111)
+        self.assertEqual(self.graph.neighbors_union(0), 0)
+
+    def test_any_adjacent(self):
+        self.assertTrue(self.graph.any_adjacent(0b1100, 0))
+        self.assertFalse(self.graph.any_adjacent(0b1001, 0))
+        self.assertFalse(self.graph.any_adjacent(0b0001, 1, 'fleet'))
+
+    def test_reachable(self):
+        self.assertEqual(self.graph.reachable(0b001, 0), 0b001)
+        self.assertEqual(self.graph.reachable(0b001, 1), 0b011)
+        self.assertEqual(self.graph.reachable(0b001, 2), 0b111)
+        self.assertEqual(self.graph.reachable(0b001, 5, 'fleet'), 0b001)
+        self.assertEqual(self.graph.reachable(0b1000, 3), 0b1000)
+
+class DistanceTableTestCase(TestCase):
+
+    def setUp(self):
+        ## ALB - ALI - MUR - SEA, with a land only border between ALI and MUR
+        ## and a sea that only fleets can cross
+        areas = ((1, "ALB"), (2, "ALI"), (3, "MUR"), (4, "SEA"))
+        borders = ((1, 2, False), (2, 1, False), (2, 3, True), (3, 2, True),
+            (3, 4, False), (4, 3, False), (2, 4, False), (4, 2, False))
+        accepts = {'A': (1, 2, 3), 'F': (2, 3, 4), 'G': ()}
+        self.graph = BoardGraph(areas, borders, accepts)
+
+    def test_army_distances(self):
+        table = compute_distances(self.graph, 'A')
+        self.assertEqual(table.distances_from(0), [0, 1, 2, None])
+        self.assertEqual(table.path(0, 2), [0, 1, 2])
+        self.assertIsNone(table.path(0, 3))
+        self.assertEqual(table.distance_between(3, 1), 2)
+        self.assertEqual(table.path_between(3, 1), [3, 2, 1])
+
+    def test_fleet_distances(self):
+        table = compute_distances(self.graph, 'F')
+        self.assertEqual(table.distances_from(1), [None, 0, 2, 1])
+        self.assertEqual(table.path(1, 2), [1, 3, 2])
+        self.assertIsNone(table.distance(0, 0))
+
+    def test_disabled_areas(self):
+        table = compute_distances(self.graph, 'A', disabled=self.graph.mask([1]))
+        self.assertIsNone(table.distance(0, 2))
+        self.assertIsNone(table.distance(1, 1))
+        self.assertEqual(table.distance(0, 0), 0)
+
+    def test_garrisons(self):
+        self.assertRaises(ValueError, compute_distances, self.graph, 'G')
+
+    def test_fingerprint(self):
+        same = BoardGraph(((11, "ALB"), (12, "ALI"), (13, "MUR"), (14, "SEA")),
+            ((11, 12, False), (12, 11, False), (12, 13, True), (13, 12, True),
+            (13, 14, False), (14, 13, False), (12, 14, False), (14, 12, False)),
+            {'A': (11, 12, 13), 'F': (12, 13, 14), 'G': ()})
+        self.assertEqual(self.graph.fingerprint, same.fingerprint)
+        other = BoardGraph(((1, "ALB"), (2, "ALI"), (3, "MUR"), (4, "SEA")),
+            ((1, 2, False), (2, 1, False)), {'A': (1, 2, 3)})
+        self.assertNotEqual(self.graph.fingerprint, other.fingerprint)
+
+class DistanceCacheTestCase(TestCase):
+
+    fixtures = ['users.yaml',]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = mock.patch("condottieri_scenarios.boards.DISTANCES_DIR", self.tmpdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(clear_board_graphs)
+        user = User.objects.first()
+        self.setting = Setting.objects.create(title_en='dummy setting',
+                description_en='description',
+                editor=user)
+        self.scenario = Scenario.objects.create(setting=self.setting,
+                title_en="dummy scenario",
+                description_en="description",
+                start_year=0,
+                editor=user)
+        self.areas = [Area.objects.create(setting=self.setting, name_en=code,
+                code=code) for code in ("ALB", "ALI", "MUR")]
+        Border.objects.create(from_area=self.areas[0], to_area=self.areas[1])
+        Border.objects.create(from_area=self.areas[1], to_area=self.areas[2])
+
+    def test_get_distance_table(self):
+        table = get_distance_table(self.setting.pk, 'A')
+        self.assertEqual(table.distance_between(self.areas[0].pk, self.areas[2].pk), 2)
+        self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+        with self.assertNumQueries(0):
+            self.assertIs(get_distance_table(self.setting.pk, 'A'), table)
+
+    def test_read_from_disk(self):
+        table = get_distance_table(self.setting.pk, 'A')
+        clear_board_graphs()
+        with mock.patch("condottieri_scenarios.boards.compute_distances") as compute:
+            cached = get_distance_table(self.setting.pk, 'A')
+        self.assertFalse(compute.called)
+        self.assertEqual(cached.path(0, 2), table.path(0, 2))
+
+    def test_border_change(self):
+        get_distance_table(self.setting.pk, 'A')
+        Border.objects.filter(to_area=self.areas[2]).delete()
+        table = get_distance_table(self.setting.pk, 'A')
+        self.assertIsNone(table.distance_between(self.areas[0].pk, self.areas[2].pk))
+
+    def test_border_change_in_other_process(self):
+        graph = get_board_graph(self.setting.pk)
+        ## the graphs of another process are not cleared by the signals of
+        ## this one
+        stale = dict(boards._graphs)
+        Border.objects.filter(to_area=self.areas[2]).delete()
+        boards._graphs.update(stale)
+        other = get_board_graph(self.setting.pk)
+        self.assertIsNot(other, graph)
+        self.assertFalse(other.is_adjacent(self.areas[1].pk, self.areas[2].pk))
+        with self.assertNumQueries(0):
+            self.assertIs(get_board_graph(self.setting.pk), other)
+
+    def test_scenario_distance_table(self):
+        DisabledArea.objects.create(scenario=self.scenario, area=self.areas[1])
+        table = get_scenario_distance_table(self.scenario, 'A')
+        self.assertIsNone(table.distance_between(self.areas[0].pk, self.areas[2].pk))
@@ -0,0 +1,98 @@
+from io import StringIO
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from unittest import mock
+
+from django.contrib.auth.models import User
+
+from condottieri_scenarios.models import Setting, Scenario, Country
+
+@mock.patch("condottieri_scenarios.graphics.get_board")
+class RenderScenarioMapsTestCase(TestCase):
+
+    fixtures = ['users.yaml',]
+
+    def setUp(self):
+        self.user = User.objects.first()
+        self.setting = Setting.objects.create(title_en = 'dummy setting',
+                description_en = 'description',
+                editor = self.user)
+        for title in ("first scenario", "second scenario"):
+            Scenario.objects.create(setting = self.setting,
+                title_en = title,
+                description_en = "description",
+                start_year = 0,
+                editor = self.user)
+
+    @mock.patch("condottieri_scenarios.graphics.make_scenario_map")
+    def test_render_all(self, make_scenario_map_mock, get_board_mock):
+        make_scenario_map_mock.return_value = True
+        out = StringIO()
+        call_command("render_scenario_maps", workers=1, stdout=out)
+        self.assertEqual(make_scenario_map_mock.call_count, 2)
+        self.assertIn("2 maps: 2 drawn, 0 up to date, 0 failed", out.getvalue())
+
+    @mock.patch("condottieri_scenarios.graphics.make_scenario_map")
+    def test_render_failure(self, make_scenario_map_mock, get_board_mock):
+        make_scenario_map_mock.side_effect = IOError("no board")
+        with self.assertRaises(CommandError):
+            call_command("render_scenario_maps", "first-scenario", workers=1,
+                stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(make_scenario_map_mock.call_count, 1)
+
+class BenchmarkGraphicsTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_benchmark(self):
+        output = os.path.join(self.tmpdir, "benchmark.json")
+        call_command("benchmark_graphics", areas=12, contenders=2, units=3,
+            board_size=(200, 150), repeat=1, output=output, stdout=StringIO())
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual(report['parameters']['areas'], 12)
+        for name in ("tokens_cold", "tokens_warm", "map_cold", "map_warm",
+                "map_up_to_date", "thumbnail_cold", "thumbnail_warm",
+                "thumbnail_from_memory"):
+            self.assertIn(name, report['results'])
+            self.assertIn('peak_rss_kb', report['results'][name])
+            self.assertIn('peak_rss_growth_kb', report['results'][name])
+        self.assertEqual(report['results']['map_cold']['queries'], 5)
+        ## the synthetic data is not kept
+        self.assertFalse(Setting.objects.exists())
+        self.assertFalse(Country.objects.exists())
+
+    def test_too_many_units(self):
+        with self.assertRaises(CommandError):
+            call_command("benchmark_graphics", areas=4, contenders=2, units=3,
+                output=os.path.join(self.tmpdir, "benchmark.json"), stdout=StringIO())
+
+class MakeTokensAtlasTestCase(TestCase):
+
+    fixtures = ['users.yaml',]
+
+    def setUp(self):
+        self.user = User.objects.first()
+        for name, enabled in (("Venice", True), ("Milan", False)):
+            with mock.patch("condottieri_scenarios.renderqueue.enqueue_tokens"):
+                Country.objects.create(name_en=name, color="000000",
+                    coat_of_arms="", editor=self.user, enabled=enabled,
+                    protected=True)
+
+    @mock.patch("condottieri_scenarios.graphics.make_country_atlas")
+    @mock.patch("condottieri_scenarios.graphics.make_tokens_atlas")
+    def test_make_tokens_atlas(self, make_tokens_atlas_mock, make_country_atlas_mock):
+        make_tokens_atlas_mock.return_value = {"badge-venice.png": (0, 0, 1, 1)}
+        out = StringIO()
+        call_command("make_tokens_atlas", countries=True, stdout=out)
+        make_tokens_atlas_mock.assert_called_once_with(["venice"])
+        make_country_atlas_mock.assert_called_once_with("venice")
+        self.assertIn("Packed 1 tokens of 1 countries", out.getvalue())
@@ -1,7 +1,20 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
 from django.test import TestCase
 from unittest import mock
+from PIL import Image, ImageChops
 
 from condottieri_scenarios.graphics import *
+from condottieri_scenarios.models import Setup
+
+from .base import ScenarioFixtureMixin
 
 class GraphicsTestCase(TestCase):
 
@@ -9,3 +22,620 @@ class GraphicsTestCase(TestCase):
     def test_ensure_dir(self, mock_makedirs):
         mock_makedirs.return_value = None
         self.assertIsNone(ensure_dir(''))
+
+class TokenCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "token.png")
+        Image.new("RGBA", (4, 4), (255, 0, 0, 255)).save(self.path)
+        self.cache = TokenCache(maxsize=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_counts_hits_and_misses(self):
+        first = self.cache.get(self.path)
+        second = self.cache.get(self.path)
+        self.assertIs(first, second)
+        self.assertEqual(first.mode, "RGBA")
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_invalidate(self):
+        self.cache.get(self.path)
+        self.cache.invalidate([self.path])
+        self.assertEqual(len(self.cache), 0)
+        self.cache.get(self.path)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_rewritten_file_is_decoded_again(self):
+        self.cache.get(self.path)
+        Image.new("RGBA", (4, 4), (0, 255, 0, 255)).save(self.path)
+        os.utime(self.path, (0, 0))
+        im = self.cache.get(self.path)
+        self.assertEqual(im.getpixel((0, 0)), (0, 255, 0, 255))
+        self.assertEqual(len(self.cache), 1)
+
+    def test_lru_eviction(self):
+        paths = []
+        for i in range(3):
+            path = os.path.join(self.tmpdir, "token-%s.png" % i)
+            Image.new("RGBA", (4, 4)).save(path)
+            paths.append(path)
+            self.cache.get(path)
+        self.assertEqual(len(self.cache), 2)
+        self.cache.get(paths[0])
+        self.assertEqual(self.cache.misses, 4)
+
+class RenderPlanTestCase(ScenarioFixtureMixin, TestCase):
+
+    def test_token_name(self):
+        self.assertEqual(token_name('chest'), "chest.png")
+        self.assertEqual(token_name('A', 'albacete'), "A-albacete.png")
+        self.assertEqual(token_name('G'), "G-autonomous.png")
+
+    def test_get_render_plan(self):
+        self.assertEqual(get_render_plan(self.scenario), [
+            Placement('disabled', None, 60, 302),
+            Placement('chest', None, 68, 201),
+            Placement('control', 'albacete', 0, 100),
+            Placement('flag', 'albacete', 0, 85),
+            Placement('A', 'albacete', 0, 300),
+            Placement('G', None, 20, 201),
+        ])
+
+    def test_get_render_plan_queries(self):
+        self.assertNumQueries(5, get_render_plan, self.scenario)
+        Setup.objects.create(contender=self.contender, area=self.areas[1], unit_type='A')
+        self.assertNumQueries(5, get_render_plan, self.scenario)
+
+    def test_get_game_plan(self):
+        plan = get_game_plan(self.setting,
+            controls=[("ALI", "albacete")],
+            homes=[("ALI", "albacete")],
+            units=[("MUR", "G", None), ("ALI", "A", "albacete")],
+            markers=[("ALB", "disabled"), ("MUR", "chest")])
+        self.assertEqual(plan, get_render_plan(self.scenario))
+        self.assertRaises(ValueError, get_game_plan, self.setting, units=[("XXX", "A", None)])
+
+    def test_get_area_codes(self):
+        self.assertEqual(get_area_codes(self.setting)[self.areas[1].pk], "MUR")
+
+    def test_coordinate_index_in_other_process(self):
+        get_coordinate_index(self.setting)
+        ## save the token in a process with its own indexes
+        with mock.patch("condottieri_scenarios.graphics._coordinate_indexes", {}):
+            token = self.areas[0].aftoken
+            token.x = 5
+            token.save()
+        self.assertEqual(get_game_plan(self.setting, units=[("ALI", "F", "albacete")]),
+            [Placement('F', 'albacete', 5, 300)])
+
+    def test_coordinate_index_queries(self):
+        self.assertNumQueries(1, get_coordinate_index, self.setting)
+        self.assertNumQueries(0, get_game_plan, self.setting,
+            units=[("ALI", "F", "albacete")])
+        token = self.areas[0].aftoken
+        token.x = 5
+        token.save()
+        self.assertEqual(get_game_plan(self.setting, units=[("ALI", "F", "albacete")]),
+            [Placement('F', 'albacete', 5, 300)])
+
+class TokensDirMixin(object):
+    """ Creates a temporary board and a set of plain tokens """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name in ("TOKENS_DIR", "LOCKS_DIR"):
+            patcher = mock.patch("condottieri_scenarios.graphics.%s" % name, self.tmpdir)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        colors = {'disabled': (0, 0, 255, 128), 'chest': (255, 255, 0, 255)}
+        for kind in ("disabled", "chest"):
+            Image.new("RGBA", (20, 20), colors[kind]).save(os.path.join(self.tmpdir, token_name(kind)))
+        for country, color in (("venice", (255, 0, 0, 200)), (None, (90, 90, 90, 255))):
+            for kind in ("control", "flag", "A", "F", "G"):
+                Image.new("RGBA", (24, 24), color).save(os.path.join(self.tmpdir, token_name(kind, country)))
+        board = os.path.join(self.tmpdir, "board.png")
+        Image.new("RGB", (200, 100), (240, 230, 200)).save(board)
+        self.setting = mock.Mock()
+        self.setting.board.path = board
+        layer_cache.clear()
+
+class LayeredRenderTestCase(TokensDirMixin, TestCase):
+
+    plan = [Placement('disabled', None, 5, 5),
+        Placement('chest', None, 190, 90),
+        Placement('control', 'venice', 40, 40),
+        Placement('flag', 'venice', 40, 25),
+        Placement('A', 'venice', 50, 50),
+        Placement('G', None, -10, 80)]
+
+    def test_compose_map_matches_sequential_paste(self):
+        expected = get_board(self.setting).copy()
+        paste_tokens(expected, self.plan)
+        result = compose_map(self.setting, self.plan)
+        for low, high in ImageChops.difference(result, expected).getextrema():
+            self.assertLessEqual(high, 1)
+
+    def test_only_changed_overlay_is_composited(self):
+        compose_map(self.setting, self.plan)
+        self.assertEqual(layer_cache.stats()['misses'], 3)
+        moved = self.plan[:4] + [Placement('A', 'venice', 60, 50)] + self.plan[5:]
+        compose_map(self.setting, moved)
+        self.assertEqual(layer_cache.stats()['hits'], 2)
+        self.assertEqual(layer_cache.stats()['misses'], 4)
+
+    @mock.patch("condottieri_scenarios.graphics.get_coordinate_index")
+    def test_render_game_map(self, get_coordinate_index_mock):
+        get_coordinate_index_mock.return_value = {
+            'VEN': AreaCoordinates((40, 40), (10, 10), (50, 50))}
+        image = render_game_map(self.setting, controls=[('VEN', 'venice')],
+            units=[('VEN', 'A', 'venice')])
+        self.assertEqual(image.mode, "RGB")
+        expected = compose_map(self.setting, [Placement('control', 'venice', 40, 40),
+            Placement('A', 'venice', 50, 50)]).convert("RGB")
+        self.assertIsNone(ImageChops.difference(image, expected).getbbox())
+        self.assertNotEqual(image.getpixel((55, 55)), (240, 230, 200))
+
+    def test_render_preview(self):
+        data = render_preview(self.setting, self.plan, size=(100, 100))
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (100, 50))
+
+class MapFingerprintTestCase(TokensDirMixin, TestCase):
+
+    plan = LayeredRenderTestCase.plan
+
+    def setUp(self):
+        super(MapFingerprintTestCase, self).setUp()
+        self.scenario = mock.Mock()
+        self.scenario.setting = self.setting
+        self.scenario.map_path = os.path.join(self.tmpdir, "map", "scenario.jpg")
+        self.scenario.get_variant_path = lambda name: os.path.join(self.tmpdir, name, "scenario.jpg")
+
+    def test_fingerprint_depends_on_placements(self):
+        fingerprint = get_render_fingerprint(self.setting, self.plan)
+        self.assertEqual(fingerprint, get_render_fingerprint(self.setting, list(self.plan)))
+        moved = self.plan[:-1] + [Placement('G', None, -10, 81)]
+        self.assertNotEqual(fingerprint, get_render_fingerprint(self.setting, moved))
+
+    def test_fingerprint_depends_on_tokens(self):
+        fingerprint = get_render_fingerprint(self.setting, self.plan)
+        path = os.path.join(self.tmpdir, token_name('A', 'venice'))
+        Image.new("RGBA", (24, 24), (0, 0, 0, 255)).save(path)
+        os.utime(path, (0, 0))
+        self.assertNotEqual(fingerprint, get_render_fingerprint(self.setting, self.plan))
+
+    @mock.patch("condottieri_scenarios.graphics.get_render_plan")
+    def test_make_scenario_map_skips_unchanged_map(self, get_render_plan_mock):
+        get_render_plan_mock.return_value = self.plan
+        self.assertTrue(make_scenario_map(self.scenario))
+        self.assertTrue(os.path.exists(self.scenario.get_variant_path('thumbnail')))
+        self.assertFalse(make_scenario_map(self.scenario))
+        self.assertTrue(make_scenario_map(self.scenario, force=True))
+
+    @mock.patch("condottieri_scenarios.graphics.get_render_plan")
+    def test_failed_variant_does_not_force_redraws(self, get_render_plan_mock):
+        get_render_plan_mock.return_value = self.plan
+        variants = {'thumbnail': {'size': (20, 20)}, 'broken': {'size': None, 'format': 'NOPE'}}
+        with mock.patch.dict("condottieri_scenarios.graphics.MAP_VARIANTS", variants, clear=True):
+            self.assertTrue(make_scenario_map(self.scenario))
+            self.assertEqual(read_render_record(self.scenario)[1], ['thumbnail'])
+            self.assertFalse(make_scenario_map(self.scenario))
+            os.remove(self.scenario.get_variant_path('thumbnail'))
+            self.assertTrue(make_scenario_map(self.scenario))
+
+    @mock.patch("condottieri_scenarios.graphics.get_render_plan")
+    def test_render_scenario_map_in_memory(self, get_render_plan_mock):
+        get_render_plan_mock.return_value = self.plan
+        map_cache.clear()
+        data, fingerprint = render_scenario_map(self.scenario)
+        self.assertEqual(fingerprint, get_render_fingerprint(self.setting, self.plan))
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (200, 100))
+        self.assertFalse(os.path.exists(self.scenario.map_path))
+        self.assertEqual(render_scenario_map(self.scenario), (data, fingerprint))
+        self.assertEqual(map_cache.stats()['hits'], 1)
+
+    @mock.patch("condottieri_scenarios.graphics.get_render_plan")
+    def test_render_scenario_map_reads_saved_map(self, get_render_plan_mock):
+        get_render_plan_mock.return_value = self.plan
+        map_cache.clear()
+        make_scenario_map(self.scenario)
+        with open(self.scenario.map_path, 'rb') as f:
+            saved = f.read()
+        self.assertEqual(render_scenario_map(self.scenario)[0], saved)
+
+class MemoryStorage(Storage):
+    """ A storage that keeps the files in a dictionary """
+
+    def __init__(self):
+        self.files = {}
+
+    def _open(self, name, mode='rb'):
+        return ContentFile(self.files[name], name=name)
+
+    def _save(self, name, content):
+        self.files[name] = content.read()
+        return name
+
+    def exists(self, name):
+        return name in self.files
+
+    def delete(self, name):
+        self.files.pop(name, None)
+
+    def url(self, name):
+        return "https://cdn.example.com/%s" % name
+
+class OverwritingStorage(MemoryStorage):
+    """ A storage that overwrites existing files """
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+class RenderOutputTestCase(TokensDirMixin, TestCase):
+
+    def setUp(self):
+        super(RenderOutputTestCase, self).setUp()
+        self.scenario = mock.Mock()
+        self.scenario.name = "dummy"
+        self.scenario.setting = self.setting
+        self.scenario.map_path = os.path.join(self.tmpdir, "map", "scenario.jpg")
+        self.scenario.get_variant_path = lambda name: os.path.join(self.tmpdir, name, "scenario.jpg")
+
+    def test_write_output_replaces_file(self):
+        path = os.path.join(self.tmpdir, "out", "file.bin")
+        write_output(path, b"first")
+        write_output(path, b"second")
+        self.assertEqual(read_output(path), b"second")
+        self.assertEqual(os.listdir(os.path.dirname(path)), ["file.bin"])
+
+    @mock.patch("condottieri_scenarios.graphics.get_render_plan")
+    def test_storage(self, get_render_plan_mock):
+        get_render_plan_mock.return_value = LayeredRenderTestCase.plan
+        storage = MemoryStorage()
+        with self.settings(MEDIA_ROOT=self.tmpdir), \
+                mock.patch("condottieri_scenarios.graphics.get_map_storage", return_value=storage):
+            self.assertTrue(make_scenario_map(self.scenario))
+            self.assertFalse(make_scenario_map(self.scenario))
+            self.assertEqual(read_fingerprint(self.scenario),
+                get_render_fingerprint(self.setting, LayeredRenderTestCase.plan))
+            self.assertIn("map/scenario.jpg", storage.files)
+        self.assertFalse(os.path.exists(self.scenario.map_path))
+
+    def test_storage_overwrites_in_place(self):
+        storage = OverwritingStorage()
+        path = os.path.join(self.tmpdir, "out", "file.bin")
+        with self.settings(MEDIA_ROOT=self.tmpdir), \
+                mock.patch("condottieri_scenarios.graphics.get_map_storage", return_value=storage), \
+                mock.patch.object(storage, 'delete') as delete_mock:
+            write_output(path, b"first")
+            write_output(path, b"second")
+            self.assertEqual(read_output(path), b"second")
+        self.assertFalse(delete_mock.called)
+
+    def test_output_url(self):
+        path = os.path.join(self.tmpdir, "tiles", "dummy")
+        self.assertEqual(output_url(path, "/media/tiles/dummy/"), "/media/tiles/dummy/")
+        with self.settings(MEDIA_ROOT=self.tmpdir), \
+                mock.patch("condottieri_scenarios.graphics.get_map_storage", return_value=MemoryStorage()):
+            self.assertEqual(output_url(path, "/media/tiles/dummy/"),
+                "https://cdn.example.com/tiles/dummy/")
+            self.assertEqual(output_url(path + ".jpg", "/media/tiles/dummy.jpg"),
+                "https://cdn.example.com/tiles/dummy.jpg")
+
+    @mock.patch("condottieri_scenarios.graphics._make_scenario_map")
+    def test_concurrent_renders_collapse(self, make_mock):
+        started, release = threading.Event(), threading.Event()
+        def render(s, force):
+            if not started.is_set():
+                started.set()
+                release.wait(5)
+            return force
+        make_mock.side_effect = render
+        first = threading.Thread(target=make_scenario_map, args=(self.scenario, True))
+        first.start()
+        started.wait(5)
+        results = []
+        second = threading.Thread(target=lambda: results.append(make_scenario_map(self.scenario, True)))
+        second.start()
+        release.set()
+        first.join()
+        second.join()
+        ## the second render waited for the first one, so it was not forced
+        self.assertEqual(results, [False])
+
+class RenderMetricsTestCase(TokensDirMixin, TestCase):
+
+    def setUp(self):
+        super(RenderMetricsTestCase, self).setUp()
+        self.scenario = mock.Mock()
+        self.scenario.name = "dummy"
+        self.scenario.setting = self.setting
+        self.scenario.map_path = os.path.join(self.tmpdir, "map", "scenario.jpg")
+        self.scenario.get_variant_path = lambda name: os.path.join(self.tmpdir, name, "scenario.jpg")
+        self.callback = mock.Mock()
+        patcher = mock.patch("condottieri_scenarios.graphics.RENDER_METRICS_CALLBACK", self.callback)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch("condottieri_scenarios.graphics.get_render_plan")
+    def test_make_scenario_map_metrics(self, get_render_plan_mock):
+        get_render_plan_mock.return_value = LayeredRenderTestCase.plan
+        token_cache.clear()
+        make_scenario_map(self.scenario)
+        metrics = self.callback.call_args[0][0]
+        self.assertEqual(metrics.operation, "map")
+        for phase in ("plan", "fingerprint", "compose", "decode", "convert", "encode", "variants"):
+            self.assertIn(phase, metrics.phases)
+        self.assertEqual(metrics.counters['tokens_pasted'], len(LayeredRenderTestCase.plan))
+        self.assertGreater(metrics.counters['bytes_written'], os.path.getsize(self.scenario.map_path))
+
+    def test_failed_render_is_reported(self):
+        with self.assertRaises(IOError):
+            with measure_render("map", "dummy"):
+                with render_phase("encode"):
+                    raise IOError("disk full")
+        metrics = self.callback.call_args[0][0]
+        self.assertEqual(metrics.error, "disk full")
+        self.assertEqual(metrics.phases["encode"]["calls"], 1)
+
+    def test_json_report(self):
+        with mock.patch("condottieri_scenarios.graphics.RENDER_REPORTS_DIR", self.tmpdir):
+            with measure_render("thumbnail", "dummy") as metrics:
+                metrics.count("bytes_written", 10)
+        with open(os.path.join(self.tmpdir, "thumbnail-dummy.json")) as f:
+            report = json.load(f)
+        self.assertEqual(report['counters']['bytes_written'], 10)
+        self.assertIsNotNone(report['elapsed'])
+
+    def test_no_metrics_outside_renders(self):
+        self.assertIsNone(current_metrics())
+        with render_phase("compose"):
+            count_render("tokens_pasted")
+
+class SvgMapTestCase(TokensDirMixin, TestCase):
+
+    placements = [('ALB', Placement('disabled', None, 5, 5)),
+        ('VEN', Placement('control', 'venice', 40, 40)),
+        ('VEN', Placement('A', 'venice', 50, 50)),
+        ('MUR', Placement('A', 'venice', 90, 50))]
+
+    def noisy_board(self):
+        Image.effect_noise((200, 100), 64).convert("RGB").save(self.setting.board.path)
+        self.setting.board.url = "/media/board.png"
+
+    def test_svg_map_size(self):
+        self.noisy_board()
+        jpeg = encode_image(compose_map(self.setting,
+            [p for code, p in self.placements]).convert("RGB"),
+            format="JPEG", quality=MAP_QUALITY)
+        linked = make_svg_map(self.setting, self.placements).encode('utf-8')
+        self.assertLess(len(linked), len(jpeg))
+        with mock.patch("condottieri_scenarios.graphics.SVG_EMBED_BOARD", True):
+            embedded = make_svg_map(self.setting, self.placements).encode('utf-8')
+        ## the board is encoded as the map, and base64 takes a third more
+        self.assertLess(len(embedded) - len(linked), len(jpeg) * 1.5)
+
+    @mock.patch("condottieri_scenarios.graphics.SVG_EMBED_BOARD", True)
+    def test_make_svg_map(self):
+        svg = make_svg_map(self.setting, self.placements)
+        self.assertEqual(svg.count("data:image/jpeg"), 1)
+        self.assertEqual(svg.count("<symbol"), 3)
+        self.assertEqual(svg.count('xlink:href="#token-A-venice"'), 2)
+        self.assertIn('id="MUR-A"', svg)
+        self.assertIn('width="200" height="100"', svg)
+
+    def test_linked_board(self):
+        self.setting.board.url = "/media/board.png"
+        svg = make_svg_map(self.setting, self.placements)
+        self.assertNotIn("data:image/jpeg", svg)
+        self.assertIn('xlink:href="/media/board.png"', svg)
+
+    def test_svg_mode_in_fingerprint(self):
+        self.addCleanup(map_cache.clear)
+        self.setting.board.url = "/media/board.png"
+        scenario = mock.Mock()
+        scenario.setting = self.setting
+        linked, fingerprint = render_scenario_svg(scenario, self.placements, "abc")
+        self.assertNotEqual(fingerprint, "abc")
+        self.assertEqual(fingerprint, svg_fingerprint(self.setting, "abc"))
+        with mock.patch("condottieri_scenarios.graphics.SVG_EMBED_BOARD", True):
+            embedded, other = render_scenario_svg(scenario, self.placements, "abc")
+        self.assertNotEqual(other, fingerprint)
+        self.assertIn(b"data:image/jpeg", embedded)
+        self.setting.board.url = "/static/board.png"
+        self.assertNotEqual(svg_fingerprint(self.setting, "abc"), fingerprint)
+
+    @mock.patch("condottieri_scenarios.graphics.MAP_SVG", True)
+    @mock.patch("condottieri_scenarios.graphics.get_render_plan")
+    def test_make_scenario_map_writes_svg(self, get_render_plan_mock):
+        get_render_plan_mock.return_value = self.placements
+        self.setting.board.url = "/media/board.png"
+        scenario = mock.Mock()
+        scenario.setting = self.setting
+        scenario.map_path = os.path.join(self.tmpdir, "scenario.jpg")
+        scenario.svg_path = os.path.join(self.tmpdir, "scenario.svg")
+        scenario.get_variant_path = lambda name: os.path.join(self.tmpdir, name, "scenario.jpg")
+        self.assertTrue(make_scenario_map(scenario))
+        get_render_plan_mock.assert_called_with(scenario, with_areas=True)
+        self.assertTrue(os.path.exists(scenario.svg_path))
+        self.assertFalse(make_scenario_map(scenario))
+
+class TilesTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.scenario = mock.Mock()
+        self.scenario.tiles_path = self.tmpdir
+        self.scenario.tiles_manifest_path = os.path.join(self.tmpdir, "manifest.json")
+        self.image = Image.new("RGB", (100, 60), (240, 230, 200))
+
+    def test_tile_levels(self):
+        self.assertEqual(tile_levels(100, 60, 32), [(25, 15), (50, 30), (100, 60)])
+        self.assertEqual(tile_levels(20, 20, 32), [(20, 20)])
+
+    def test_make_scenario_tiles(self):
+        self.assertEqual(make_scenario_tiles(self.scenario, self.image, 32), 8 + 2 + 1)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, "2", "3_1.jpg")))
+        with open(self.scenario.tiles_manifest_path) as f:
+            manifest = json.load(f)
+        self.assertEqual(len(manifest['levels']), 3)
+        self.assertEqual(manifest['levels'][2]['columns'], 4)
+
+    def test_unchanged_tiles_are_not_written(self):
+        make_scenario_tiles(self.scenario, self.image, 32)
+        self.assertEqual(make_scenario_tiles(self.scenario, self.image, 32), 0)
+        self.image.paste((0, 0, 0), (0, 0, 10, 10))
+        ## one tile of each level covers the changed pixels
+        self.assertEqual(make_scenario_tiles(self.scenario, self.image, 32), 3)
+
+class VariantsTestCase(TestCase):
+
+    variants = {'small': {'size': (20, 20), 'format': 'JPEG', 'quality': 50},
+        'medium': {'size': (50, 50), 'format': 'PNG'},
+        'progressive': {'size': None, 'format': 'JPEG', 'progressive': True}}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.scenario = mock.Mock()
+        self.scenario.get_variant_path = lambda name: os.path.join(self.tmpdir, name, "scenario")
+        self.image = Image.new("RGB", (100, 60), (240, 230, 200))
+
+    def test_make_scenario_variants(self):
+        make_scenario_variants(self.scenario, self.image, self.variants)
+        sizes = {'small': (20, 12), 'medium': (50, 30), 'progressive': (100, 60)}
+        for name, size in sizes.items():
+            im = Image.open(self.scenario.get_variant_path(name))
+            self.assertEqual(im.size, size)
+            self.assertEqual(im.format, self.variants[name]['format'])
+        self.assertEqual(self.image.size, (100, 60))
+
+    def test_make_scenario_thumb_from_image(self):
+        self.scenario.thumbnail_path = os.path.join(self.tmpdir, "thumbnail.jpg")
+        make_scenario_thumb(self.scenario, 10, 10, "thumbnails", image=self.image)
+        self.assertEqual(Image.open(self.scenario.thumbnail_path).size, (10, 6))
+
+class AtlasTestCase(TokensDirMixin, TestCase):
+
+    def setUp(self):
+        super(AtlasTestCase, self).setUp()
+        for name, value in (("BADGES_DIR", self.tmpdir), ("TOKEN_ATLAS", True)):
+            patcher = mock.patch("condottieri_scenarios.graphics.%s" % name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        Image.new("RGBA", (48, 48), (0, 255, 0, 255)).save(os.path.join(self.tmpdir, "badge-venice.png"))
+
+    def test_pack_images(self):
+        images = [("a", Image.new("RGBA", (30, 10))), ("b", Image.new("RGBA", (30, 20))),
+            ("c", Image.new("RGBA", (10, 10)))]
+        atlas, index = pack_images(images, width=64)
+        self.assertEqual(index, {"a": (0, 0, 30, 10), "b": (31, 0, 30, 20), "c": (0, 21, 10, 10)})
+        self.assertEqual(atlas.size, (61, 31))
+
+    def test_make_tokens_atlas(self):
+        index = make_tokens_atlas(["venice"])
+        self.assertIn("badge-venice.png", index)
+        self.assertNotIn("icon-venice.png", index)
+        with open(os.path.join(self.tmpdir, "atlas.css")) as f:
+            self.assertIn(".token-badge-venice {", f.read())
+
+    def test_atlas_countries(self):
+        self.assertEqual(atlas_countries(), set())
+        make_tokens_atlas(["venice"])
+        self.assertEqual(atlas_countries(), set())
+        Image.new("RGBA", (24, 24)).save(os.path.join(self.tmpdir, "icon-venice.png"))
+        make_tokens_atlas(["venice"])
+        self.assertEqual(atlas_countries(), set(["venice"]))
+
+    def test_get_token_from_atlas(self):
+        make_country_atlas("venice")
+        token = get_token("A-venice.png")
+        self.assertEqual(token.size, (24, 24))
+        self.assertEqual(token.getpixel((0, 0)), (255, 0, 0, 200))
+        self.assertIs(get_token("A-venice.png"), token)
+        self.assertIsNone(get_atlas_token("chest.png"))
+
+    def test_stale_atlas_is_not_used(self):
+        make_country_atlas("venice")
+        path = os.path.join(self.tmpdir, "A-venice.png")
+        Image.new("RGBA", (24, 24), (0, 0, 255, 255)).save(path)
+        mtime = os.path.getmtime(os.path.join(self.tmpdir, "atlas-venice.json"))
+        os.utime(path, (mtime + 10, mtime + 10))
+        self.assertIsNone(get_atlas_token("A-venice.png"))
+        self.assertEqual(get_token("A-venice.png").getpixel((0, 0)), (0, 0, 255, 255))
+
+class MappedBoardTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "board.png")
+        Image.new("RGB", (30, 20), (10, 20, 30)).save(self.path)
+
+    def test_get_mapped_board(self):
+        board = get_mapped_board(self.path)
+        self.assertTrue(os.path.exists(raw_board_path(self.path)))
+        self.assertEqual(board.size, (30, 20))
+        self.assertEqual(board.getpixel((3, 3)), (10, 20, 30, 255))
+        self.assertIs(get_mapped_board(self.path), board)
+
+    def test_changed_board_is_mapped_again(self):
+        get_mapped_board(self.path)
+        os.utime(raw_board_path(self.path), (0, 0))
+        Image.new("RGB", (30, 20), (0, 0, 0)).save(self.path)
+        self.assertEqual(get_mapped_board(self.path).getpixel((3, 3)), (0, 0, 0, 255))
+
+    @mock.patch("condottieri_scenarios.graphics.write_raw_board")
+    def test_setting_save_skips_up_to_date_board(self, write_raw_board_mock):
+        setting = mock.Mock()
+        setting.board.path = self.path
+        signal_handler_make_raw_board(None, setting, False, False)
+        self.assertEqual(write_raw_board_mock.call_count, 1)
+        with open(raw_board_path(self.path), 'wb'):
+            pass
+        signal_handler_make_raw_board(None, setting, False, False)
+        self.assertEqual(write_raw_board_mock.call_count, 1)
+
+class CountryTokensTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        templates = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+            "media", "condottieri_scenarios", "token_templates")
+        for name, value in (("TOKENS_DIR", self.tmpdir), ("BADGES_DIR", self.tmpdir),
+            ("TEMPLATES_DIR", templates), ("TOKEN_ATLAS", False)):
+            patcher = mock.patch("condottieri_scenarios.graphics.%s" % name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.country = mock.Mock(static_name="albacete", color="FF0000", protected=False)
+        self.country.coat_of_arms.path = os.path.join(self.tmpdir, "coat.png")
+        Image.new("RGBA", (40, 40), (0, 0, 255, 255)).save(self.country.coat_of_arms.path)
+
+    def make_tokens(self):
+        return make_country_tokens(None, self.country, False, False)
+
+    def test_make_country_tokens(self):
+        self.assertEqual(self.make_tokens(), list(COUNTRY_TOKENS))
+        for kind in COUNTRY_TOKENS:
+            self.assertTrue(os.path.exists(country_token_path(kind, "albacete")))
+
+    def test_unchanged_tokens_are_not_generated(self):
+        self.make_tokens()
+        self.assertEqual(self.make_tokens(), [])
+
+    def test_color_change(self):
+        self.make_tokens()
+        self.country.color = "00FF00"
+        self.assertEqual(self.make_tokens(), ['A', 'G', 'F', 'control', 'flag'])
+
+    def test_coat_change(self):
+        self.make_tokens()
+        Image.new("RGBA", (40, 40), (0, 0, 0, 255)).save(self.country.coat_of_arms.path)
+        os.utime(self.country.coat_of_arms.path, (0, 0))
+        self.assertEqual(self.make_tokens(), ['badge', 'icon', 'A', 'G', 'F'])
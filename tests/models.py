@@ -4,6 +4,7 @@ from unittest import skip, mock
 from django.contrib.auth.models import User
 
 from condottieri_scenarios.models import *
+import condottieri_scenarios.snapshots as snapshots
 
 class SettingTestCase(TestCase):
 
@@ -30,6 +31,12 @@ class SettingTestCase(TestCase):
     def test_configuration_str(self):
         self.assertEqual(str(self.setting.configuration), "dummy setting")
 
+## map variants that are not made by default
+VARIANTS = {
+    'thumbnail@2x': {'size': (374, 534), 'format': 'JPEG', 'quality': 80},
+    'webp': {'size': None, 'format': 'WEBP', 'quality': 80},
+}
+
 class ScenarioTestCase(TestCase):
 
     fixtures = ['users.yaml',]
@@ -84,6 +91,49 @@ class ScenarioTestCase(TestCase):
         self.assertEqual(self.scenario.thumbnail_url,
                 "media/scenarios/thumbnails/scenario-dummy-scenario.jpg")
 
+    @override_settings(MEDIA_ROOT="media")
+    @override_settings(SCENARIOS_ROOT="scenarios")
+    def test_tiles_manifest_path(self):
+        self.assertEqual(self.scenario.tiles_manifest_path,
+                "media/scenarios/tiles/dummy-scenario/manifest.json")
+
+    @override_settings(MEDIA_URL="media/")
+    @override_settings(SCENARIOS_ROOT="scenarios")
+    def test_tile_url_template(self):
+        self.assertEqual(self.scenario.tile_url_template,
+                "media/scenarios/tiles/dummy-scenario/{z}/{x}_{y}.jpg")
+
+    @override_settings(MEDIA_ROOT="media")
+    @override_settings(SCENARIOS_ROOT="scenarios")
+    @mock.patch.dict("condottieri_scenarios.graphics.MAP_VARIANTS", VARIANTS)
+    def test_get_variant_path(self):
+        self.assertEqual(self.scenario.get_variant_path('thumbnail'),
+                self.scenario.thumbnail_path)
+        self.assertEqual(self.scenario.get_variant_path('webp'),
+                "media/scenarios/webp/scenario-dummy-scenario.webp")
+
+    @override_settings(MEDIA_URL="media")
+    @override_settings(SCENARIOS_ROOT="scenarios")
+    @mock.patch.dict("condottieri_scenarios.graphics.MAP_VARIANTS", VARIANTS)
+    def test_variant_urls(self):
+        self.assertEqual(self.scenario.variant_urls['thumbnail@2x'],
+                "media/scenarios/thumbnail@2x/scenario-dummy-scenario.jpg")
+
+    @override_settings(MEDIA_ROOT="media")
+    @override_settings(SCENARIOS_ROOT="scenarios")
+    def test_urls_in_map_storage(self):
+        storage = mock.Mock()
+        storage.url.side_effect = lambda name: "https://cdn.example.com/%s" % name
+        with mock.patch("condottieri_scenarios.graphics.get_map_storage", return_value=storage):
+            self.assertEqual(self.scenario.map_url,
+                "https://cdn.example.com/scenarios/scenario-dummy-scenario.jpg")
+            self.assertEqual(self.scenario.thumbnail_url,
+                "https://cdn.example.com/scenarios/thumbnails/scenario-dummy-scenario.jpg")
+            self.assertEqual(self.scenario.svg_url,
+                "https://cdn.example.com/scenarios/scenario-dummy-scenario.svg")
+            self.assertEqual(self.scenario.tile_url_template,
+                "https://cdn.example.com/scenarios/tiles/dummy-scenario/{z}/{x}_{y}.jpg")
+
     def test_in_use(self):
         self.assertFalse(self.scenario.in_use)
     
@@ -99,6 +149,33 @@ class ScenarioTestCase(TestCase):
     def test_times_played(self):
         self.assertEqual(self.scenario.times_played, 0)
 
+    def test_setup_dict(self):
+        area = Area.objects.create(setting=self.setting,
+                name_en="Alicante",
+                code="ALI",
+                is_coast=True,
+                has_city=True,
+                is_fortified=True)
+        country = Country.objects.create(name_en="Albacete",
+                color="000000",
+                coat_of_arms="",
+                editor=self.user)
+        contender = Contender.objects.create(country=country, scenario=self.scenario)
+        Home.objects.create(contender=contender, area=area)
+        Setup.objects.create(contender=contender, area=area, unit_type='G')
+        self.addCleanup(snapshots.clear_snapshots)
+        self.assertIsNone(self.scenario.setup_dict[country.static_name]['ducats'])
+        Treasury.objects.create(contender=contender, ducats=12, double=True)
+        setup_dict = self.scenario.setup_dict
+        self.assertEqual(setup_dict, {country.static_name: {
+                'name': "Albacete",
+                'homes': ((area.pk, True),),
+                'setups': ((area.pk, 'G'),),
+                'ducats': 12,
+                'double': True}})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.scenario.setup_dict, setup_dict)
+
 class SpecialUnitTestCase(TestCase):
 
     def setUp(self):
@@ -126,9 +203,7 @@ class CountryTestCase(TestCase):
 
     fixtures = ['users.yaml',]
     
-    @mock.patch("condottieri_scenarios.graphics.make_country_tokens")
-    def setUp(self, make_country_tokens_mock):
-        make_country_tokens_mock.return_value = None
+    def setUp(self):
         self.user = User.objects.first()
         self.setting = Setting.objects.create(title_en = 'dummy setting',
                 description_en = 'description',
@@ -162,9 +237,7 @@ class ContenderTestCase(TestCase):
 
     fixtures = ['users.yaml',]
     
-    @mock.patch("condottieri_scenarios.graphics.make_country_tokens")
-    def setUp(self, make_country_tokens_mock):
-        make_country_tokens_mock.return_value = None
+    def setUp(self):
         self.user = User.objects.first()
         self.setting = Setting.objects.create(title_en = 'dummy setting',
                 description_en = 'description',
@@ -238,6 +311,18 @@ class AreaTestCase(TestCase):
         self.assertFalse(self.area_1.is_adjacent(self.area_3, fleet=True))
         self.assertFalse(self.area_3.is_adjacent(self.area_1, fleet=True))
 
+    def test_is_adjacent_without_queries(self):
+        self.area_1.is_adjacent(self.area_2)
+        with self.assertNumQueries(0):
+            self.assertTrue(self.area_1.is_adjacent(self.area_2, fleet=True))
+            self.assertFalse(self.area_1.is_adjacent(self.area_3, fleet=True))
+
+    def test_is_adjacent_after_border_change(self):
+        self.assertTrue(self.area_1.is_adjacent(self.area_2))
+        Border.objects.get(from_area=self.area_1, to_area=self.area_2).delete()
+        self.assertFalse(self.area_1.is_adjacent(self.area_2))
+        self.assertTrue(self.area_2.is_adjacent(self.area_1))
+
     def test_build_possible(self):
         self.assertTrue(self.area_1.build_possible('A'))
         self.assertTrue(self.area_1.build_possible('F'))
@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import Future
+
+from django.test import TestCase
+from unittest import mock
+
+from condottieri_scenarios.renderqueue import *
+
+class RenderQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        for name, value in (("JOBS_DIR", self.tmpdir), ("RENDER_WORKERS", 0)):
+            patcher = mock.patch("condottieri_scenarios.renderqueue.%s" % name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.scenario = mock.Mock(pk=1)
+        self.scenario.name = "dummy-scenario"
+
+    @mock.patch("condottieri_scenarios.models.Scenario.objects.get")
+    @mock.patch("condottieri_scenarios.graphics.make_scenario_map")
+    def test_enqueue_map(self, make_scenario_map_mock, get_mock):
+        make_scenario_map_mock.return_value = True
+        job = enqueue_map(self.scenario)
+        self.assertEqual(job['state'], DONE)
+        self.assertTrue(job['drawn'])
+        self.assertEqual(read_job("dummy-scenario")['job_id'], job['job_id'])
+
+    @mock.patch("condottieri_scenarios.models.Scenario.objects.get")
+    @mock.patch("condottieri_scenarios.graphics.make_scenario_map")
+    def test_enqueue_map_failure(self, make_scenario_map_mock, get_mock):
+        make_scenario_map_mock.side_effect = IOError("no board")
+        job = enqueue_map(self.scenario)
+        self.assertEqual(job['state'], FAILED)
+        self.assertEqual(job['error'], "no board")
+
+    @mock.patch("condottieri_scenarios.renderqueue.TOKENS_WAIT", 0.1)
+    @mock.patch("condottieri_scenarios.renderqueue.scenario_countries")
+    @mock.patch("condottieri_scenarios.models.Scenario.objects.get")
+    @mock.patch("condottieri_scenarios.graphics.make_scenario_map")
+    def test_map_is_drawn_with_pending_tokens(self, make_scenario_map_mock,
+            get_mock, scenario_countries_mock):
+        scenario_countries_mock.return_value = ["venice"]
+        make_scenario_map_mock.return_value = True
+        with mock.patch("condottieri_scenarios.graphics.TOKENS_DIR", self.tmpdir):
+            with open(tokens_marker_path("venice"), 'w'):
+                pass
+            start = time.time()
+            job = enqueue_map(self.scenario)
+        self.assertLess(time.time() - start, JOB_TIMEOUT)
+        self.assertEqual(job['state'], DONE)
+        self.assertTrue(make_scenario_map_mock.called)
+
+    @mock.patch("condottieri_scenarios.renderqueue.run_job")
+    def test_pending_jobs_are_merged(self, run_job_mock):
+        pending = {'job_id': 'pending', 'scenario': 'dummy-scenario',
+            'state': QUEUED, 'force': False, 'queued': time.time()}
+        write_job(pending)
+        self.assertEqual(enqueue_map(self.scenario)['job_id'], 'pending')
+        self.assertFalse(run_job_mock.called)
+        self.assertNotEqual(enqueue_map(self.scenario, force=True)['job_id'], 'pending')
+
+    @mock.patch("condottieri_scenarios.renderqueue.run_job")
+    def test_running_jobs_are_not_merged(self, run_job_mock):
+        running = {'job_id': 'running', 'scenario': 'dummy-scenario',
+            'state': RUNNING, 'force': True, 'queued': time.time()}
+        write_job(running)
+        self.assertNotEqual(enqueue_map(self.scenario)['job_id'], 'running')
+        self.assertTrue(run_job_mock.called)
+
+    @mock.patch("condottieri_scenarios.renderqueue.run_job")
+    def test_lost_jobs_are_not_merged(self, run_job_mock):
+        pending = {'job_id': 'lost', 'scenario': 'dummy-scenario',
+            'state': RUNNING, 'force': True, 'queued': time.time() - JOB_TIMEOUT - 1}
+        write_job(pending)
+        self.assertNotEqual(enqueue_map(self.scenario)['job_id'], 'lost')
+        self.assertTrue(run_job_mock.called)
+
+class TokensQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        for target, value in (("renderqueue.RENDER_WORKERS", 0),
+                ("graphics.TOKENS_DIR", self.tmpdir)):
+            patcher = mock.patch("condottieri_scenarios.%s" % target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.countries = [mock.Mock(pk=i, static_name=name)
+            for i, name in enumerate(("venice", "milano"))]
+        patcher = mock.patch("condottieri_scenarios.models.Country.objects.get",
+            side_effect=lambda pk: self.countries[pk])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch("condottieri_scenarios.graphics.make_country_tokens")
+    def test_enqueue_tokens(self, make_country_tokens_mock):
+        make_country_tokens_mock.return_value = ['icon']
+        future = enqueue_tokens(self.countries[0])
+        self.assertEqual(future.result(), ['icon'])
+        self.assertFalse(tokens_pending("venice"))
+        self.assertTrue(make_country_tokens_mock.call_args[1]['update_atlas'])
+
+    @mock.patch("condottieri_scenarios.graphics.TOKEN_ATLAS", True)
+    @mock.patch("condottieri_scenarios.renderqueue.run_atlas_job")
+    @mock.patch("condottieri_scenarios.graphics.make_country_tokens")
+    def test_batch_packs_atlas_once(self, make_country_tokens_mock, run_atlas_job_mock):
+        futures = make_tokens_batch(self.countries)
+        self.assertEqual(sorted(futures), ["milano", "venice"])
+        self.assertEqual(make_country_tokens_mock.call_count, 2)
+        for call in make_country_tokens_mock.call_args_list:
+            self.assertFalse(call[1]['update_atlas'])
+        self.assertEqual(run_atlas_job_mock.call_count, 1)
+
+    def test_wait_for_tokens_of_other_process(self):
+        with open(tokens_marker_path("venice"), 'w'):
+            pass
+        self.assertTrue(tokens_pending("venice"))
+        self.assertFalse(wait_for_tokens(["venice"], timeout=0.1, poll=0.05))
+        self.assertTrue(wait_for_tokens(["milano"], timeout=0.1))
+
+    def test_stale_marker_is_ignored(self):
+        path = tokens_marker_path("venice")
+        with open(path, 'w'):
+            pass
+        old = time.time() - JOB_TIMEOUT - 1
+        os.utime(path, (old, old))
+        self.assertTrue(wait_for_tokens(["venice"], timeout=0.1))
+
+    def test_when_done(self):
+        first, second = Future(), Future()
+        callback = mock.Mock()
+        when_done([first, second], callback, 'arg')
+        first.set_result(None)
+        self.assertFalse(callback.called)
+        second.set_result(None)
+        callback.assert_called_once_with('arg')
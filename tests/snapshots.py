@@ -0,0 +1,70 @@
+import pickle
+
+from django.test import TestCase
+from unittest import mock
+
+from condottieri_scenarios.graphics import get_game_plan, get_render_plan
+from condottieri_scenarios.models import *
+from condottieri_scenarios.snapshots import *
+
+from .base import ScenarioFixtureMixin
+
+class ScenarioSnapshotTestCase(ScenarioFixtureMixin, TestCase):
+
+    def setUp(self):
+        super(ScenarioSnapshotTestCase, self).setUp()
+        self.addCleanup(clear_snapshots)
+
+    def test_build_snapshot(self):
+        with self.assertNumQueries(5):
+            snapshot = build_snapshot(self.scenario)
+        self.assertEqual(snapshot.number_of_players, 1)
+        contender = snapshot.get_contender(self.country.static_name)
+        self.assertEqual(contender.id, self.contender.pk)
+        self.assertEqual(contender.homes, (HomeItem(self.areas[0].pk, "ALI", "Ali", True),))
+        self.assertEqual(contender.setups, (UnitItem(self.areas[0].pk, "ALI", "Ali", 'A'),))
+        self.assertEqual((contender.ducats, contender.double), (12, False))
+        self.assertEqual(snapshot.autonomous.setups, (UnitItem(self.areas[1].pk, "MUR", "Mur", 'G'),))
+        self.assertIsNone(snapshot.autonomous.ducats)
+        self.assertEqual(snapshot.cities, (AreaItem("MUR", "Mur"),))
+        self.assertEqual(snapshot.disabled, (AreaItem("ALB", "Alb"),))
+        self.assertEqual(str(contender.setups[0]), "Army in Ali")
+
+    def test_immutable(self):
+        snapshot = build_snapshot(self.scenario)
+        self.assertRaises(AttributeError, setattr, snapshot, 'name', 'other')
+        self.assertRaises(AttributeError, setattr, snapshot.contenders[0], 'ducats', 0)
+        self.assertEqual(pickle.loads(pickle.dumps(snapshot)), snapshot)
+
+    def test_game_state(self):
+        snapshot = build_snapshot(self.scenario)
+        self.assertEqual(get_game_plan(self.setting, **snapshot.get_game_state()),
+            get_render_plan(self.scenario))
+
+    def test_get_snapshot_without_queries(self):
+        snapshot = get_snapshot(self.scenario)
+        with self.assertNumQueries(0):
+            self.assertIs(get_snapshot(self.scenario), snapshot)
+
+    def test_get_snapshot_from_cache(self):
+        snapshot = get_snapshot(self.scenario)
+        with mock.patch("condottieri_scenarios.snapshots._snapshots", {}):
+            with self.assertNumQueries(0):
+                self.assertEqual(get_snapshot(self.scenario), snapshot)
+
+    def test_invalidation(self):
+        get_snapshot(self.scenario)
+        Setup.objects.create(contender=self.contender, area=self.areas[1], unit_type='A')
+        self.assertEqual(len(get_snapshot(self.scenario).countries[0].setups), 2)
+        Treasury.objects.filter(contender=self.contender).update(ducats=20)
+        self.assertEqual(get_snapshot(self.scenario).countries[0].ducats, 12)
+        Treasury.objects.get(contender=self.contender).save()
+        self.assertEqual(get_snapshot(self.scenario).countries[0].ducats, 20)
+        DisabledArea.objects.get(scenario=self.scenario).delete()
+        self.assertEqual(get_snapshot(self.scenario).disabled, ())
+
+    def test_area_change(self):
+        get_snapshot(self.scenario)
+        self.areas[0].name_en = "Alicante"
+        self.areas[0].save()
+        self.assertEqual(get_snapshot(self.scenario).countries[0].homes[0].name, "Alicante")
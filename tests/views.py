@@ -0,0 +1,187 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from unittest import mock
+
+from django.contrib.auth.models import User
+
+from condottieri_scenarios.graphics import get_game_plan
+from condottieri_scenarios.models import Setting, Scenario, Home, Setup, \
+    DisabledArea
+
+from .base import ScenarioFixtureMixin
+
+@mock.patch("condottieri_scenarios.graphics.render_scenario_map",
+    return_value=(b"jpeg data", "abc"))
+@mock.patch("condottieri_scenarios.graphics.get_render_fingerprint",
+    return_value="abc")
+class ScenarioMapImageViewTestCase(TestCase):
+
+    fixtures = ['users.yaml',]
+
+    def setUp(self):
+        self.user = User.objects.first()
+        self.setting = Setting.objects.create(title_en = 'dummy setting',
+                description_en = 'description',
+                editor = self.user)
+        self.scenario = Scenario.objects.create(setting = self.setting,
+                title_en = "dummy scenario",
+                description_en = "description",
+                start_year = 0,
+                editor = self.user,
+                enabled = True)
+        self.url = reverse('scenario_map_image',
+            kwargs={'slug': self.scenario.name, 'format': 'jpg'})
+
+    def test_map(self, fingerprint_mock, render_mock):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "image/jpeg")
+        self.assertEqual(response['ETag'], '"abc.jpg"')
+        self.assertEqual(b"".join(response.streaming_content), b"jpeg data")
+
+    @mock.patch("condottieri_scenarios.graphics.render_scenario_svg")
+    def test_svg_etag_covers_board_mode(self, render_svg_mock, fingerprint_mock,
+            render_mock):
+        self.setting.board.name = "boards/board.png"
+        self.setting.save()
+        render_svg_mock.return_value = (b"<svg/>", "svg")
+        url = reverse('scenario_map_image',
+            kwargs={'slug': self.scenario.name, 'format': 'svg'})
+        linked = self.client.get(url)
+        self.assertEqual(linked.status_code, 200)
+        self.assertEqual(linked['Content-Type'], "image/svg+xml")
+        self.assertNotEqual(linked['ETag'], '"abc.svg"')
+        with mock.patch("condottieri_scenarios.graphics.SVG_EMBED_BOARD", True):
+            embedded = self.client.get(url, HTTP_IF_NONE_MATCH=linked['ETag'])
+        self.assertEqual(embedded.status_code, 200)
+        self.assertNotEqual(embedded['ETag'], linked['ETag'])
+
+    def test_not_modified(self, fingerprint_mock, render_mock):
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"abc.jpg"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], '"abc.jpg"')
+        self.assertFalse(render_mock.called)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"old.jpg"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_disabled_scenario(self, fingerprint_mock, render_mock):
+        self.scenario.enabled = False
+        self.scenario.save()
+        other = User.objects.create_user("other", "other@example.com", "secret")
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.client.force_login(self.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("private", response['Cache-Control'])
+
+@mock.patch("condottieri_scenarios.graphics.render_preview", return_value=b"preview")
+class MapPreviewViewsTestCase(ScenarioFixtureMixin, TestCase):
+
+    def setUp(self):
+        super(MapPreviewViewsTestCase, self).setUp()
+        ## the profiles are made by another application
+        patcher = mock.patch.object(User, "profile", mock.Mock(is_editor=True),
+            create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_login(self.user)
+
+    def formset_data(self, prefix, initial, *rows):
+        """ Returns the data of a formset. The first rows are the initial
+        forms of the saved objects """
+        data = {"%s-TOTAL_FORMS" % prefix: len(rows),
+            "%s-INITIAL_FORMS" % prefix: len(initial),
+            "%s-MIN_NUM_FORMS" % prefix: 0,
+            "%s-MAX_NUM_FORMS" % prefix: 1000}
+        for i, row in enumerate(rows):
+            if i < len(initial):
+                data["%s-%s-id" % (prefix, i)] = initial[i].pk
+            for field, value in row.items():
+                data["%s-%s-%s" % (prefix, i, field)] = value
+        return data
+
+    def post_preview(self, render_mock, url, data, **state):
+        counts = [m.objects.count() for m in (Home, Setup, DisabledArea)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "image/jpeg")
+        self.assertEqual(response.content, b"preview")
+        for query in queries.captured_queries:
+            self.assertFalse(query['sql'].startswith(("INSERT", "UPDATE", "DELETE")))
+        self.assertEqual([m.objects.count() for m in (Home, Setup, DisabledArea)], counts)
+        expected = {'controls': [("ALI", self.country.static_name)],
+            'homes': [("ALI", self.country.static_name)],
+            'units': [("ALI", 'A', self.country.static_name), ("MUR", 'G', None)],
+            'markers': [("ALB", 'disabled'), ("MUR", 'chest')]}
+        expected.update(state)
+        self.assertCountEqual(render_mock.call_args[0][1],
+            get_game_plan(self.setting, **expected))
+
+    def homes_url(self):
+        return reverse('scenario_contender_homes_preview', args=[self.contender.pk])
+
+    def setup_url(self):
+        return reverse('scenario_contender_setup_preview', args=[self.contender.pk])
+
+    def test_home_preview(self, render_mock):
+        country = self.country.static_name
+        home = Home.objects.get(contender=self.contender)
+        self.post_preview(render_mock, self.homes_url(),
+            self.formset_data("home_set", [home],
+                {'area': self.areas[0].pk, 'contender': self.contender.pk,
+                'is_home': 'on'},
+                {'area': self.areas[1].pk, 'is_home': 'on'},
+                {'area': self.areas[2].pk, 'DELETE': 'on'}),
+            controls=[("ALI", country), ("MUR", country)],
+            homes=[("ALI", country), ("MUR", country)])
+
+    def test_home_preview_replaces_saved_homes(self, render_mock):
+        country = self.country.static_name
+        home = Home.objects.get(contender=self.contender)
+        self.post_preview(render_mock, self.homes_url(),
+            self.formset_data("home_set", [home],
+                {'area': self.areas[2].pk, 'contender': self.contender.pk}),
+            controls=[("ALB", country)], homes=[])
+        self.post_preview(render_mock, self.homes_url(),
+            self.formset_data("home_set", [home],
+                {'area': self.areas[0].pk, 'contender': self.contender.pk,
+                'is_home': 'on', 'DELETE': 'on'}),
+            controls=[], homes=[])
+
+    def test_setup_preview(self, render_mock):
+        setup = Setup.objects.get(contender=self.contender)
+        self.post_preview(render_mock, self.setup_url(),
+            self.formset_data("setup_set", [setup],
+                {'area': self.areas[0].pk, 'contender': self.contender.pk,
+                'unit_type': 'A'},
+                {'area': self.areas[1].pk, 'unit_type': 'F'},
+                {'area': self.areas[2].pk}),
+            units=[("ALI", 'A', self.country.static_name),
+                ("MUR", 'F', self.country.static_name), ("MUR", 'G', None)])
+
+    def test_setup_preview_replaces_saved_units(self, render_mock):
+        setup = Setup.objects.get(contender=self.contender)
+        self.post_preview(render_mock, self.setup_url(),
+            self.formset_data("setup_set", [setup],
+                {'area': self.areas[2].pk, 'contender': self.contender.pk,
+                'unit_type': 'F'}),
+            units=[("ALB", 'F', self.country.static_name), ("MUR", 'G', None)])
+        self.post_preview(render_mock, self.setup_url(),
+            self.formset_data("setup_set", [setup],
+                {'area': self.areas[0].pk, 'contender': self.contender.pk,
+                'unit_type': 'A', 'DELETE': 'on'}),
+            units=[("MUR", 'G', None)])
+
+    def test_disabled_areas_preview(self, render_mock):
+        disabled = DisabledArea.objects.get(scenario=self.scenario)
+        self.post_preview(render_mock,
+            reverse('scenario_disabled_preview', args=[self.scenario.name]),
+            self.formset_data("disabledarea_set", [disabled],
+                {'area': self.areas[2].pk, 'scenario': self.scenario.pk,
+                'DELETE': 'on'},
+                {'area': self.areas[0].pk}),
+            markers=[("ALI", 'disabled'), ("MUR", 'chest')])
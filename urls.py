@@ -16,6 +16,10 @@ urlpatterns = [
 		views.ScenarioView.as_view(), name='scenario_detail'),
 	url(r'^make_map/(?P<slug>[-\w]+)/$',
 		views.ScenarioRedrawMapView.as_view(), name='scenario_make_map'),
+	url(r'^make_map/status/(?P<slug>[-\w]+)/$',
+		views.ScenarioMapJobView.as_view(), name='scenario_map_job'),
+	url(r'^map/(?P<slug>[-\w]+)\.(?P<format>jpg|svg)$',
+		views.ScenarioMapImageView.as_view(), name='scenario_map_image'),
 	url(r'^toggle/(?P<slug>[-\w]+)/$',
 		views.ScenarioToggleView.as_view(), name='scenario_toggle'),
 	url(r'^stats/(?P<slug>[-\w]+)/$',
@@ -30,16 +34,22 @@ urlpatterns = [
 		views.CityIncomeDeleteView.as_view(), name='scenario_cityincome_delete'),
 	url(r'^disabled/(?P<slug>[-\w]+)/$',
 		views.DisabledAreasEditView.as_view(), name='scenario_disabled_edit'),
+	url(r'^disabled/preview/(?P<slug>[-\w]+)/$',
+		views.DisabledAreasPreviewView.as_view(), name='scenario_disabled_preview'),
 	url(r'^disabled/delete/(?P<pk>\d+)/$',
 		views.DisabledAreaDeleteView.as_view(), name='scenario_disabled_delete'),
 	url(r'^contender/delete/(?P<pk>\d+)/$',
 		views.ContenderDeleteView.as_view(), name='scenario_contender_delete'),
 	url(r'^contender/homes/(?P<pk>\d+)/$',
 		views.ContenderHomeView.as_view(), name='scenario_contender_homes'),
+	url(r'^contender/homes/preview/(?P<pk>\d+)/$',
+		views.ContenderHomePreviewView.as_view(), name='scenario_contender_homes_preview'),
 	url(r'^home/delete/(?P<pk>\d+)/$',
 		views.HomeDeleteView.as_view(), name='scenario_home_delete'),
 	url(r'^contender/setup/(?P<pk>\d+)/$',
 		views.ContenderSetupView.as_view(), name='scenario_contender_setup'),
+	url(r'^contender/setup/preview/(?P<pk>\d+)/$',
+		views.ContenderSetupPreviewView.as_view(), name='scenario_contender_setup_preview'),
 	url(r'^setup/delete/(?P<pk>\d+)/$',
 		views.SetupDeleteView.as_view(), name='scenario_setup_delete'),
 	url(r'^contender/treasury/(?P<pk>\d+)/$',
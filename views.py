@@ -17,6 +17,8 @@
 ## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
 
 from datetime import datetime
+from io import BytesIO
+from wsgiref.util import FileWrapper
 
 from django.views.generic.list import ListView
 from django.views.generic.detail import DetailView
@@ -28,12 +30,17 @@ from django.utils.functional import lazy
 from django.urls import reverse
 from django.core.exceptions import ObjectDoesNotExist
 from django.forms import ValidationError
+from django.forms.formsets import DELETION_FIELD_NAME
 from django.utils.translation import ugettext_lazy as _
 from django.contrib import messages
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.views.generic.base import View
 
 import condottieri_scenarios.models as models
 import condottieri_scenarios.forms as forms
-from condottieri_scenarios.graphics import make_scenario_map
+import condottieri_scenarios.renderqueue as renderqueue
+import condottieri_scenarios.graphics as graphics
+import condottieri_scenarios.snapshots as snapshots
 
 reverse_lazy = lambda name=None, *args : lazy(reverse, str)(name, args=args)
 
@@ -140,7 +147,20 @@ class CountryView(DetailView):
 			context.update({'user_can_edit': user_can_edit})
 		return context
 
-class CountryListView(ListView):
+class TokenAtlasMixin(object):
+	""" A mixin that adds to the context the URL of the CSS sprite sheet of the
+	tokens, if the tokens are packed in atlases, and the set of countries
+	that are in the sprite sheet. Other countries must use their images. """
+	def get_context_data(self, **kwargs):
+		context = super(TokenAtlasMixin, self).get_context_data(**kwargs)
+		if graphics.TOKEN_ATLAS:
+			countries = graphics.atlas_countries()
+			if countries:
+				context['atlas_css_url'] = graphics.atlas_css_url()
+				context['atlas_countries'] = countries
+		return context
+
+class CountryListView(TokenAtlasMixin, ListView):
 	model = models.Country
 	
 	def get_queryset(self):
@@ -200,13 +220,14 @@ class ScenarioListView(ListView):
 		else:
 			return models.Scenario.objects.filter(Q(enabled=True)|Q(editor=self.request.user))
 	
-class ScenarioView(DetailView):
+class ScenarioView(TokenAtlasMixin, DetailView):
 	model = models.Scenario
 	slug_field = 'name'
 	context_object_name = 'scenario'
 
 	def get_context_data(self, **kwargs):
 		context = super(ScenarioView, self).get_context_data(**kwargs)
+		context['snapshot'] = snapshots.get_snapshot(self.object)
 		if self.request.user.is_authenticated:
 			user_can_edit = self.request.user.profile.is_editor
 			context.update({'user_can_edit': user_can_edit})
@@ -254,10 +275,60 @@ class ScenarioToggleView(EditionAllowedMixin, UpdateView):
 		return super(ScenarioToggleView, self).form_valid(form=form)
 
 class ScenarioRedrawMapView(EditionAllowedMixin, ScenarioView):
-	def get(self, request, **kwargs):
-		obj = self.get_object()
-		make_scenario_map(obj)
-		return super(ScenarioRedrawMapView, self).get(request, **kwargs)
+	def get_context_data(self, **kwargs):
+		context = super(ScenarioRedrawMapView, self).get_context_data(**kwargs)
+		job = renderqueue.enqueue_map(self.object, force='force' in self.request.GET)
+		messages.info(self.request, _("The map will be redrawn in a few moments (job %s)") % job['job_id'])
+		context['render_job'] = job
+		return context
+
+class ScenarioMapJobView(EditionAllowedMixin, ScenarioView):
+	""" Returns, in JSON, the status of the last map render of a scenario """
+	def render_to_response(self, context, **response_kwargs):
+		job = renderqueue.read_job(self.object.name)
+		if job is None:
+			raise http.Http404
+		return http.JsonResponse(job)
+
+class ScenarioMapImageView(View):
+	""" Returns the map of a scenario, rendered on demand, as JPEG or SVG.
+
+	The ETag of the response is the fingerprint of the render inputs, so
+	clients and proxies can revalidate the map without downloading it again.
+	The ETag of the SVG map also covers the way the board is included.
+	"""
+	content_types = {'jpg': 'image/jpeg', 'svg': 'image/svg+xml'}
+
+	def get(self, request, slug, format='jpg'):
+		try:
+			scenario = models.Scenario.objects.select_related('setting').get(name=slug)
+		except ObjectDoesNotExist:
+			raise http.Http404
+		if not scenario.enabled and not request.user.is_staff and \
+			scenario.editor != request.user:
+			raise http.Http404
+		placements = graphics.get_render_plan(scenario, with_areas=True)
+		plan = [p for code, p in placements]
+		fingerprint = graphics.get_render_fingerprint(scenario.setting, plan)
+		if format == 'svg':
+			etag = '"%s.svg"' % graphics.svg_fingerprint(scenario.setting, fingerprint)
+		else:
+			etag = '"%s.%s"' % (fingerprint, format)
+		response = get_conditional_response(request, etag=etag)
+		if response is None:
+			if format == 'svg':
+				data, fingerprint = graphics.render_scenario_svg(scenario, placements, fingerprint)
+			else:
+				data, fingerprint = graphics.render_scenario_map(scenario, plan, fingerprint)
+			response = http.StreamingHttpResponse(FileWrapper(BytesIO(data)),
+				content_type=self.content_types[format])
+			response['Content-Length'] = len(data)
+		response['ETag'] = etag
+		if scenario.enabled:
+			patch_cache_control(response, public=True, no_cache=True)
+		else:
+			patch_cache_control(response, private=True, no_cache=True)
+		return response
 
 class ScenarioCreateView(CreationAllowedMixin, CreateView):
 	model = models.Scenario
@@ -435,6 +506,98 @@ class ContenderTreasuryView(ContenderUpdateView):
 			context['formset'] = forms.TreasuryFormSet(instance=self.object)
 		return context
 
+def pending_areas(codes, forms, field='area'):
+	""" Yields each form of a formset with an area, and the code of the area """
+	for form in forms:
+		try:
+			code = codes.get(int(form[field].value()))
+		except (TypeError, ValueError):
+			continue
+		if code is not None:
+			yield form, code
+
+def pending_homes(contender, state, codes, forms):
+	""" Replaces the homes of a contender in the initial state of a scenario
+	with the homes posted to its formset """
+	if contender.country is None:
+		return state
+	country = contender.country.static_name
+	controls = [c for c in state['controls'] if c[1] != country]
+	homes = [h for h in state['homes'] if h[1] != country]
+	for form, code in pending_areas(codes, forms):
+		controls.append((code, country))
+		if form['is_home'].value():
+			homes.append((code, country))
+	return dict(state, controls=controls, homes=homes)
+
+def pending_setups(contender, state, codes, forms):
+	""" Replaces the units of a contender in the initial state of a scenario
+	with the units posted to its formset """
+	country = None
+	if contender.country is not None:
+		country = contender.country.static_name
+	units = [u for u in state['units'] if u[2] != country]
+	units += [(code, form['unit_type'].value(), country)
+		for form, code in pending_areas(codes, forms)
+		if form['unit_type'].value() in ('A', 'F', 'G')]
+	return dict(state, units=units)
+
+def pending_disabled_areas(scenario, state, codes, forms):
+	""" Replaces the disabled areas in the initial state of a scenario with
+	the areas posted to its formset """
+	markers = [m for m in state['markers'] if m[1] != 'disabled']
+	markers += [(code, 'disabled') for form, code in pending_areas(codes, forms)]
+	return dict(state, markers=markers)
+
+class MapPreviewMixin(object):
+	""" A mixin that, instead of saving the data posted to a formset, draws
+	it over the current map of the scenario and returns a low resolution
+	preview. Nothing is written to the database.
+
+	formset_factory takes the setting of the scenario and returns the class
+	of the formset. pending_plan takes the object, the initial state of the
+	scenario, as given by ScenarioSnapshot.get_game_state, the area codes of
+	the setting and the forms that are not deleted, and returns the state
+	with the saved rows of the formset replaced by the posted ones. """
+	formset_factory = None
+	pending_plan = None
+
+	def get_scenario(self):
+		return self.object.scenario
+
+	def post(self, request, *args, **kwargs):
+		self.object = self.get_object()
+		if self.object.editor != request.user and not request.user.is_staff:
+			raise http.Http404
+		scenario = self.get_scenario()
+		formset = self.formset_factory(scenario.setting)(instance=self.object,
+			data=request.POST)
+		try:
+			forms = [f for f in formset.forms if not f[DELETION_FIELD_NAME].value()]
+		except ValidationError:
+			return http.HttpResponseBadRequest()
+		codes = graphics.get_area_codes(scenario.setting)
+		state = snapshots.get_snapshot(scenario).get_game_state()
+		plan = graphics.get_game_plan(scenario.setting,
+			**self.pending_plan(self.object, state, codes, forms))
+		return http.HttpResponse(graphics.render_preview(scenario.setting, plan),
+			content_type='image/jpeg')
+
+class ContenderHomePreviewView(MapPreviewMixin, ContenderUpdateView):
+	formset_factory = staticmethod(forms.homeformset_factory)
+	pending_plan = staticmethod(pending_homes)
+
+class ContenderSetupPreviewView(MapPreviewMixin, ContenderUpdateView):
+	formset_factory = staticmethod(forms.setupformset_factory)
+	pending_plan = staticmethod(pending_setups)
+
+class DisabledAreasPreviewView(MapPreviewMixin, ScenarioUpdateView):
+	formset_factory = staticmethod(forms.disabledareaformset_factory)
+	pending_plan = staticmethod(pending_disabled_areas)
+
+	def get_scenario(self):
+		return self.object
+
 class ContenderItemDeleteView(EditionAllowedMixin, DeleteView):
 	def delete(self, request, *args, **kwargs):
 		contender = self.get_object().contender